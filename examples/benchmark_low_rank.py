@@ -0,0 +1,47 @@
+"""
+Compare a model with a low-rank weight matrix with and without the
+low-rank pass (passes.factor_low_rank): weight memory and step time.
+
+    python benchmark_low_rank.py [n] [rank]
+
+"""
+import sys
+import time
+import numpy as np
+
+import nengo
+from nengo_ocl import sim_ocl
+
+
+def make_model(n, rank):
+    rng = np.random.RandomState(0)
+    model = nengo.Model('low_rank')
+    model.make_node('in', output=lambda t: np.sin(t * np.arange(n)))
+    model.make_node('out', output=lambda t, x: x)
+    model.connect('in', 'out',
+                  transform=np.dot(rng.randn(n, rank), rng.randn(rank, n)))
+    return model
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rank = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    model = make_model(n, rank)
+    print '%-10s %14s %14s' % ('', 'weights (MB)', 'step (ms)')
+    for tol in [None, 1e-5]:
+        sim = sim_ocl.Simulator(model, low_rank_tol=tol)
+        if sim.low_rank_report:
+            n_elements = sum(r['elements_after'] for r in sim.low_rank_report)
+        else:
+            n_elements = n * n
+        sim.run_steps(10)
+        t0 = time.time()
+        sim.run_steps(1000)
+        t1 = time.time()
+        print '%-10s %14.2f %14.4f' % (
+            'factored' if tol else 'dense',
+            n_elements * 4 / 2. ** 20, t1 - t0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+Step time of the same model with 32-bit and with 64-bit buffer offsets
+(sim_ocl.Simulator(offset_bits=...)), to see what 64-bit mode costs.
+Models only get it by default once a buffer has 2**31 elements.
+
+    python benchmark_offsets.py [n_ensembles] [n_neurons]
+
+"""
+import sys
+import time
+import numpy as np
+
+import nengo
+from nengo_ocl import sim_ocl
+
+
+def make_model(n_ensembles, n_neurons):
+    model = nengo.Model('offsets')
+    model.make_node('in', output=np.sin)
+    for ii in range(n_ensembles):
+        model.make_ensemble('A%i' % ii, nengo.LIF(n_neurons), 1)
+        model.connect('in' if ii == 0 else 'A%i' % (ii - 1), 'A%i' % ii)
+    model.probe('A%i' % (n_ensembles - 1), filter=0.01)
+    return model
+
+
+def main():
+    n_ensembles = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    n_neurons = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    model = make_model(n_ensembles, n_neurons)
+    print '%-8s %14s %10s' % ('offsets', 'step (ms)', 'overhead')
+    times = {}
+    for bits in [32, 64]:
+        sim = sim_ocl.Simulator(model, offset_bits=bits)
+        sim.run_steps(10)
+        t0 = time.time()
+        sim.run_steps(1000)
+        times[bits] = time.time() - t0
+        print '%-8s %14.4f %9.1f%%' % (
+            '%i-bit' % bits, times[bits],
+            100 * (times[bits] / times[32] - 1))
+
+
+if __name__ == '__main__':
+    main()
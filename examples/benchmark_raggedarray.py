@@ -0,0 +1,88 @@
+"""
+Compare RaggedArray construction against the old list-extend method.
+
+Each construction runs in a fresh child process so that the peak resident
+set size (ru_maxrss) can be attributed to it alone.
+
+    python benchmark_raggedarray.py [total_MB]
+
+"""
+import sys
+import time
+import resource
+import multiprocessing
+
+import numpy as np
+
+from nengo_ocl.raggedarray import RaggedArray
+
+
+def old_buf(listofarrays):
+    # -- the construction used by RaggedArray before it was vectorized
+    buf = []
+    for l in listofarrays:
+        obj = np.asarray(l)
+        buf.extend(obj.ravel())
+    return np.asarray(buf)
+
+
+def new_buf(listofarrays, dtype=None):
+    return RaggedArray(listofarrays, dtype=dtype).buf
+
+
+def make_arrays(total_mb):
+    # -- a weight-matrix-heavy mix: some large matrices plus many small
+    #    state vectors and scalars, all float64 like nengo's signals
+    rng = np.random.RandomState(0)
+    arrays = []
+    nbytes = 0
+    while nbytes < total_mb * 2 ** 20:
+        n = rng.randint(100, 1000)
+        d = rng.randint(1, 64)
+        arrays.append(rng.randn(n, d))
+        arrays.append(rng.randn(n))
+        arrays.append(np.asarray(rng.randn()))
+        nbytes += 8 * (n * d + n + 1)
+    return arrays
+
+
+def maxrss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 2. ** 20   # -- bytes
+    return rss / 2. ** 10       # -- kilobytes
+
+
+def trial(args):
+    method, total_mb = args
+    arrays = make_arrays(total_mb)
+    rss0 = maxrss_mb()
+    t0 = time.time()
+    if method == 'old':
+        buf = old_buf(arrays)
+    elif method == 'new float64':
+        buf = new_buf(arrays)
+    elif method == 'new float32':
+        buf = new_buf(arrays, dtype=np.float32)
+    else:
+        raise ValueError(method)
+    t1 = time.time()
+    return t1 - t0, maxrss_mb() - rss0, buf.nbytes / 2. ** 20
+
+
+def main():
+    total_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 100.
+    print 'building ~%.0f MB of float64 signals' % total_mb
+    print '%-12s %10s %16s %12s' % (
+        'method', 'time (s)', 'peak extra (MB)', 'buf (MB)')
+    for method in ['old', 'new float64', 'new float32']:
+        # -- maxtasksperchild=1 so every trial gets a fresh process
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        secs, rss, size = pool.apply(trial, [(method, total_mb)])
+        pool.close()
+        pool.join()
+        print '%-12s %10.3f %16.1f %12.1f' % (method, secs, rss, size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""
+Simulate one small model for many seeds and sizes in a process pool.
+
+    python sweep_seeds.py [n_seeds]
+
+"""
+import sys
+import time
+import numpy as np
+
+import nengo
+from nengo_ocl.sweep import sweep
+
+
+def make_model(seed, n_neurons):
+    model = nengo.Model('sweep', seed=seed)
+    model.make_node('in', output=np.sin)
+    A = model.make_ensemble('A', nengo.LIF(n_neurons), 1)
+    model.connect('in', 'A')
+    model.probe(A, filter=0.01)
+    return model, {'A': A}
+
+
+if __name__ == '__main__':
+    n_seeds = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    grid = {'seed': range(n_seeds), 'n_neurons': [50, 200]}
+    t0 = time.time()
+    results = sweep(make_model, grid, run_time=1.0)
+    t1 = time.time()
+    print '%i simulations in %.2f s' % (len(results), t1 - t0)
+
+    t = np.arange(1000) * 0.001
+    for params, data in results:
+        rmse = np.sqrt(np.mean((data['A'][:, 0] - np.sin(t)) ** 2))
+        print '%(seed)4i %(n_neurons)6i' % params, 'rmse %.4f' % rmse
@@ -1,2 +1,2 @@
-from sim_ocl import Simulator
+from sim_ocl import Simulator, vectorized
 
@@ -155,6 +155,7 @@ def ocldtype(obj):
     obj = str(obj)
     if isinstance(obj, basestring):
         return {
+            'float16': 'half',
             'float32': 'float',
             'float64': 'double',
             'int64': 'long',
@@ -0,0 +1,273 @@
+"""
+Fused kernels: a SimLIF update together with the gemvs that read its spikes.
+
+Unfused, plan_lif writes each step's spikes to the signal buffer and a
+gemv kernel reads them back as X.  The fused kernel runs one work-group
+per LIF op: the work-group updates the op's neurons, keeps their spikes in
+local memory, and then computes, from local memory, every MultiProdUpdate
+op whose dense terms all multiply those spikes:
+
+    Y = gamma + beta * Y_in + sum_t dot(A_t, spikes)
+
+The spikes are still written to the buffer, for probes and other readers.
+
+find_lif_gemv_fusions decides which ops can be planned this way, and
+plan_lif_gemv makes the plan.
+"""
+import numpy as np
+from plan import Plan, build_program
+from mako.template import Template
+from clarray import to_device
+from clra_nonlinearities import lif_core_text
+from tricky_imports import OrderedDict
+
+
+def _group_rw(ops, extra_reads=None):
+    reads = set()
+    writes = set()
+    for op in ops:
+        reads.update(sig.base for sig in op.reads)
+        if extra_reads is not None:
+            reads.update(sig.base for sig in extra_reads(op))
+        writes.update(sig.base for sig in op.sets + op.incs + op.updates)
+    return reads, writes
+
+
+def lif_consumer(op, outputs, AX_views, YYB_views, ra, sidx):
+    """Return the SimLIF op (a value of `outputs`, which maps output bases
+    to SimLIF ops) whose spikes every dense term of MultiProdUpdate `op`
+    multiplies, or None if `op` is not of the form computed by
+    plan_lif_gemv.
+
+    `ra` is the RaggedArray holding all signals, `sidx` their indices in it.
+    """
+    AX = AX_views.get(op)
+    if not AX or op._float_beta is None:
+        return None
+    for sig in YYB_views[op][:2]:
+        if ra.shape1s[sidx[sig]] != 1 or ra.stride0s[sidx[sig]] != 1:
+            return None
+    M = ra.shape0s[sidx[YYB_views[op][0]]]
+    lif = None
+    for A, X in zip(AX[0::2], AX[1::2]):
+        if outputs.get(X.base) is None or lif not in (None, outputs[X.base]):
+            return None
+        lif = outputs[X.base]
+        S, X, A = sidx[lif.output], sidx[X], sidx[A]
+        if (ra.starts[X] != ra.starts[S]
+                or ra.shape0s[X] != ra.shape0s[S] or ra.shape1s[X] != 1
+                or ra.stride0s[X] != 1 or ra.stride0s[S] != 1
+                or ra.shape0s[A] != M or ra.shape1s[A] != ra.shape0s[S]
+                or ra.stride1s[A] != 1):
+            return None
+    return lif
+
+
+def find_lif_gemv_fusions(op_groups, AX_views, YYB_views, ra, sidx,
+                          exclude=(), max_size=None, extra_reads=None):
+    """Find the MultiProdUpdate ops to plan together with a SimLIF group.
+
+    Each such op reads the spikes of one SimLIF op (see lif_consumer), and
+    can be moved up to the SimLIF group: neither the SimLIF group nor any
+    group in between writes what it reads (other than those spikes), or
+    reads or writes what it writes.  Ops in `exclude`, and SimLIF groups
+    with an op of more than `max_size` neurons, are left alone.
+
+    Returns a dict mapping the index of a SimLIF group in `op_groups` to
+    an OrderedDict mapping the indices of later groups to their ops to fuse.
+    """
+    rw = [_group_rw(ops, extra_reads) for op_type, ops in op_groups]
+    rval = {}
+    for ii, (op_type, lif_ops) in enumerate(op_groups):
+        if op_type.__name__ != 'SimLIF':
+            continue
+        if max_size is not None and max(
+                op.output.size for op in lif_ops) > max_size:
+            continue
+        outputs = dict((op.output.base, op) for op in lif_ops)
+        lif_reads, lif_writes = rw[ii]
+        found = OrderedDict()
+        for kk in range(ii + 1, len(op_groups)):
+            if op_groups[kk][0].__name__ != 'MultiProdUpdate':
+                continue
+            movable = []
+            for op in op_groups[kk][1]:
+                if op in exclude:
+                    continue
+                lif = lif_consumer(op, outputs, AX_views, YYB_views, ra, sidx)
+                if lif is None:
+                    continue
+                reads, writes = _group_rw([op], extra_reads)
+                reads.discard(lif.output.base)
+                if (reads & lif_writes or writes & (lif_reads | lif_writes)
+                        or any(reads & w or writes & (r | w)
+                               for r, w in rw[ii + 1:kk])):
+                    continue
+                movable.append(op)
+            if movable:
+                found[kk] = movable
+        if found:
+            rval[ii] = found
+    return rval
+
+
+def plan_lif_gemv(queue, J, V, W, S, ref, tau, dt, consumer_ptr,
+                  Y, Y_in, beta, gamma, term_ptr, A, lsize=128, tag=None,
+                  upsample=1):
+    """Plan a LIF step of neurons J, V, W, S (CLRaggedArrays of one buffer,
+    item n for LIF op n), fused with gemvs that read S.
+
+    LIF op n has consumers c = consumer_ptr[n] .. consumer_ptr[n + 1] - 1,
+    each of which sets
+
+        Y[c] = gamma[c] + beta[c] * Y_in[c] + sum_t dot(A[t], S[n])
+
+    for t = term_ptr[c] .. term_ptr[c + 1] - 1.  `ref`, `tau`, `beta` and
+    `gamma` are sequences of floats, `lsize` (a power of 2) is the
+    work-group size.
+    """
+    data = J.cl_buf
+    N = len(J)
+    for ra in [V, W, S, Y, Y_in, A]:
+        assert ra.cl_buf.data.int_ptr == data.data.int_ptr
+    assert len(consumer_ptr) == N + 1 and len(term_ptr) == len(Y) + 1
+    assert all(s == 1 for s in A.stride1s)
+    assert all(s == 1 for s in Y.stride0s)
+    assert all(s == 1 for s in Y_in.stride0s)
+    assert lsize & (lsize - 1) == 0
+    itemsize = data.dtype.itemsize
+
+    text = """
+        ////////// MAIN FUNCTION //////////
+        __kernel void fn(
+            __global const int *sizes,
+            __global const ${O} *J_starts,
+            __global const ${O} *V_starts,
+            __global const ${O} *W_starts,
+            __global const ${O} *S_starts,
+            __global const ${T} *refs,
+            __global const ${T} *taus,
+            __global const int *consumer_ptr,
+            __global const ${O} *Y_starts,
+            __global const int *Y_shape0s,
+            __global const ${O} *Y_in_starts,
+            __global const ${T} *betas,
+            __global const ${T} *gammas,
+            __global const int *term_ptr,
+            __global const ${O} *A_starts,
+            __global const int *A_stride0s,
+            __global ${T} *data
+        )
+        {
+            __local ${T} spikes[${max_size}];
+            __local ${T} partial[${lsize}];
+            const int n = get_group_id(0);
+            const int li = get_local_id(0);
+            const int size = sizes[n];
+            const ${T} ref = refs[n];
+            const ${T} tau = taus[n];
+
+            // -- the LIF step, keeping the spikes in local memory
+            for (int i = li; i < size; i += ${lsize})
+            {
+                const ${T} j = data[J_starts[n] + i];
+                ${T} v = data[V_starts[n] + i];
+                ${T} w = data[W_starts[n] + i];
+                ${T} ov, ow, os;
+                char spiked;
+                ${T} dV, overshoot;
+${core_text}
+                data[V_starts[n] + i] = ov;
+                data[W_starts[n] + i] = ow;
+                data[S_starts[n] + i] = os;
+                spikes[i] = os;
+            }
+            barrier(CLK_LOCAL_MEM_FENCE);
+
+            // -- the gemvs reading those spikes
+            for (int c = consumer_ptr[n]; c < consumer_ptr[n + 1]; ++c)
+            {
+                const int M = Y_shape0s[c];
+                const ${T} beta = betas[c];
+                const ${T} gamma = gammas[c];
+                if (M >= ${lsize})
+                {
+                    // -- one row per work-item
+                    for (int m = li; m < M; m += ${lsize})
+                    {
+                        ${T} y_sum = 0;
+                        for (int t = term_ptr[c]; t < term_ptr[c + 1]; ++t)
+                        {
+                            __global const ${T} *a
+                                = data + A_starts[t] + m * A_stride0s[t];
+                            for (int i = 0; i < size; ++i)
+                                y_sum += a[i] * spikes[i];
+                        }
+                        data[Y_starts[c] + m] = gamma
+                            + beta * data[Y_in_starts[c] + m] + y_sum;
+                    }
+                }
+                else
+                {
+                    // -- one row at a time, reduced across the work-group
+                    for (int m = 0; m < M; ++m)
+                    {
+                        ${T} y_sum = 0;
+                        for (int t = term_ptr[c]; t < term_ptr[c + 1]; ++t)
+                        {
+                            __global const ${T} *a
+                                = data + A_starts[t] + m * A_stride0s[t];
+                            for (int i = li; i < size; i += ${lsize})
+                                y_sum += a[i] * spikes[i];
+                        }
+                        partial[li] = y_sum;
+                        barrier(CLK_LOCAL_MEM_FENCE);
+                        for (int s = ${lsize} / 2; s > 0; s >>= 1)
+                        {
+                            if (li < s)
+                                partial[li] += partial[li + s];
+                            barrier(CLK_LOCAL_MEM_FENCE);
+                        }
+                        if (li == 0)
+                            data[Y_starts[c] + m] = gamma
+                                + beta * data[Y_in_starts[c] + m]
+                                + partial[0];
+                        barrier(CLK_LOCAL_MEM_FENCE);
+                    }
+                }
+            }
+        }
+        """
+    textconf = dict(T=data.ocldtype, O=J.ocl_offset_t, lsize=lsize,
+                    max_size=int(max(J.shape0s)),
+                    core_text=lif_core_text(dt, upsample))
+    text = Template(text, output_encoding='ascii').render(**textconf)
+
+    def ints(seq):
+        return to_device(queue, np.asarray(seq, dtype='int32'))
+
+    def floats(seq):
+        return to_device(queue, np.asarray(seq, dtype=data.dtype))
+
+    full_args = (
+        J.cl_shape0s, J.cl_starts, V.cl_starts, W.cl_starts, S.cl_starts,
+        floats(ref), floats(tau),
+        ints(consumer_ptr), Y.cl_starts, Y.cl_shape0s, Y_in.cl_starts,
+        floats(beta), floats(gamma),
+        ints(term_ptr), A.cl_starts, A.cl_stride0s,
+        data,
+        )
+    _fn = build_program(queue.context, text).fn
+    _fn.set_args(*[arr.data for arr in full_args])
+
+    n_neurons = int(np.sum(J.shape0s))
+    n_weights = int(np.sum(A.shape0s * A.shape1s))
+    rval = Plan(queue, _fn, (N * lsize,), (lsize,),
+                name="clra_fusion.lif_gemv", tag=tag,
+                flops_per_call=2 * n_weights,
+                # -- read J, V, W, A, Y_in; write V, W, S, Y
+                bw_per_call=itemsize * (7 * n_neurons + n_weights
+                                        + 2 * int(np.sum(Y.shape0s))),
+                )
+    rval.full_args = full_args     # prevent garbage-collection
+    return rval
@@ -2,7 +2,7 @@ import math
 from collections import defaultdict
 import numpy as np
 import pyopencl as cl
-from plan import Plan
+from plan import Plan, build_program
 from mako.template import Template
 from clarray import to_device
 from clraggedarray import CLRaggedArray
@@ -47,14 +47,13 @@ def flops_from_geometry(geometry, items):
         flops += gi['y_len'] * 3
     return flops
 
-def bw_from_geometry(geometry, items):
+def bw_from_geometry(geometry, items, a_elemsize=4, elemsize=4):
     n_bytes = 0
-    elemsize = 4
     for ii in items:
         gi = geometry[ii]
         for dotinfo in gi['dots']:
             # -- load A
-            n_bytes += elemsize * dotinfo['a_shape1'] * gi['y_len']
+            n_bytes += a_elemsize * dotinfo['a_shape1'] * gi['y_len']
             # -- load X
             n_bytes += elemsize * dotinfo['a_shape1']
 
@@ -70,6 +69,14 @@ def bw_from_geometry(geometry, items):
         n_bytes += elemsize * gi['y_len']
     return n_bytes
 
+def a_load_macro(A):
+    """Source defining A_LOAD(ii), which reads element ii of A_data as a
+    float: half-precision A (see sim_ocl's weights_dtype) is stored as
+    half and read with vload_half."""
+    if A.cl_buf.ocldtype == 'half':
+        return "#define A_LOAD(ii) vload_half((ii), A_data)\n"
+    return "#define A_LOAD(ii) A_data[(ii)]\n"
+
 class DotSignature(object):
     def __init__(self, dct):
         self.y_len = dct['y_len']
@@ -139,13 +146,14 @@ class gemv_prog(object):
             print '  %6s\t%s' % (counts[dsi], dsi)
 
     def _geometry(self):
-        A_starts = self.A.starts
-        X_starts = self.X.starts
-        Y_starts = self.Y.starts
-        Y_in_starts = self.Y_in.starts
-        A_stride0s = self.A.stride0s
-        A_shape1s = self.A.shape1s
-        Y_shape0s = self.Y.shape0s
+        # -- Python ints, so that flop and bandwidth sums can't overflow
+        A_starts = self.A.starts.tolist()
+        X_starts = self.X.starts.tolist()
+        Y_starts = self.Y.starts.tolist()
+        Y_in_starts = self.Y_in.starts.tolist()
+        A_stride0s = self.A.stride0s.tolist()
+        A_shape1s = self.A.shape1s.tolist()
+        Y_shape0s = self.Y.shape0s.tolist()
 
         rval = []
         for bb in range(len(Y_shape0s)):
@@ -156,8 +164,8 @@ class gemv_prog(object):
                 'y_in_start': Y_in_starts[bb],
                     }
             if self.X_js:
-                x_js_i = self.X_js[bb]
-                A_js_i = self.A_js[bb]
+                x_js_i = self.X_js[bb].ravel().tolist()
+                A_js_i = self.A_js[bb].ravel().tolist()
                 assert len(x_js_i) == len(A_js_i)
                 for jj, (xj, aj) in enumerate(zip(x_js_i, A_js_i)):
                     dbb['dots'].append({
@@ -178,7 +186,11 @@ class gemv_prog(object):
         n_structure_vars = 4 * max_n_dots + 5
         structure_vars_stride = int(
             padding * math.ceil(float(n_structure_vars) / padding))
-        gstructure = np.zeros((len(items), structure_vars_stride), dtype='int32')
+        # -- the table holds buffer offsets, so it needs 64 bits if they do
+        wide = any(ra.offset_dtype == np.int64
+                   for ra in [p.A, p.X, p.Y, p.Y_in])
+        gstructure = np.zeros((len(items), structure_vars_stride),
+                              dtype='int64' if wide else 'int32')
         A_starts = p.A.starts
         X_starts = p.X.starts
         Y_starts = p.Y.starts
@@ -207,6 +219,7 @@ class gemv_prog(object):
         cl_gstructure = to_device(p.queue, gstructure)
 
         textconf = {
+            'structure_t': 'long' if wide else 'int',
             'n_structure_vars': n_structure_vars,
             'structure_vars_stride': structure_vars_stride,
             'x_starts': 'lstructure[0 * %s + ii]' % max_n_dots,
@@ -263,14 +276,14 @@ def ref_impl(p, items):
             __global ${cl_alpha.ocldtype} * alphas,
     % endif
     % if (A_js is not None):
-            __global int *A_starts,
+            __global ${A.ocl_offset_t} *A_starts,
             __global int *A_shape1s,
             __global int *A_stride0s,
             __global ${A.cl_buf.ocldtype} *A_data,
             __global int *A_js_starts,
             __global int *A_js_shape0s,
             __global int *A_js_data,
-            __global int *X_starts,
+            __global ${X.ocl_offset_t} *X_starts,
             __global int *X_stride0s,
             __global ${X.cl_buf.ocldtype} *X_data,
             __global int *X_js_starts,
@@ -280,15 +293,15 @@ def ref_impl(p, items):
             __global ${cl_beta.ocldtype} * betas,
     % endif
     % if clra_beta is not None:
-            __global int *beta_starts,
+            __global ${clra_beta.ocl_offset_t} *beta_starts,
             __global int *beta_data,
     % endif
     % if cl_gamma is not None:
             __global ${cl_gamma.ocldtype} * gammas,
     % endif
-            __global int *Y_in_starts,
+            __global ${Y_in.ocl_offset_t} *Y_in_starts,
             __global ${Y_in.cl_buf.ocldtype} *Y_in_data,
-            __global int *Y_starts,
+            __global ${Y.ocl_offset_t} *Y_starts,
             __global int *Y_shape0s,
             __global ${Y.cl_buf.ocldtype} *Y_data)
         {
@@ -297,15 +310,15 @@ def ref_impl(p, items):
             const int M = Y_shape0s[bb];
             if (mm < M)
             {
-                const int y_offset = Y_starts[bb];
-                const int y_in_offset = Y_in_starts[bb];
+                const ${Y.ocl_offset_t} y_offset = Y_starts[bb];
+                const ${Y_in.ocl_offset_t} y_in_offset = Y_in_starts[bb];
 
     % if float_beta is not None:
                 const ${Y.cl_buf.ocldtype} beta = ${float_beta};
     % elif cl_beta is not None:
                 const ${cl_beta.ocldtype} beta = betas[bb];
     % elif clra_beta is not None:
-                const int beta_offset = beta_starts[bb];
+                const ${clra_beta.ocl_offset_t} beta_offset = beta_starts[bb];
                 const ${clra_beta.cl_buf.ocldtype} beta
                     = beta_data[beta_offset + mm];
     % endif
@@ -330,15 +343,15 @@ def ref_impl(p, items):
                     const int x_ji = X_js_data[ii];
                     const int a_ji = A_js_data[ii];
                     const int N_i = A_shape1s[a_ji];
-                    const int x_offset = X_starts[x_ji];
-                    const int a_offset = A_starts[a_ji];
+                    const ${X.ocl_offset_t} x_offset = X_starts[x_ji];
+                    const ${A.ocl_offset_t} a_offset = A_starts[a_ji];
                     const int AsM = A_stride0s[a_ji];
                     const int XsM = X_stride0s[x_ji];
 
                     for (int nn = 0; nn < N_i; ++nn)
                     {
                         y_sum += X_data[x_offset + nn * XsM]
-                                 * A_data[a_offset + mm * AsM + nn];
+                                 * A_LOAD(a_offset + mm * AsM + nn);
                     }
                 }
         % if float_alpha is not None:
@@ -352,14 +365,15 @@ def ref_impl(p, items):
         }
     """
 
-    text = Template(text, output_encoding='ascii').render(**p.__dict__)
+    text = Template(a_load_macro(p.A) + text,
+                    output_encoding='ascii').render(**p.__dict__)
     #print text
 
     gsize = (
         max(p.geometry[ii]['y_len'] for ii in items),
         len(items))
     lsize = None
-    fn = cl.Program(p.queue.context, text).build().fn
+    fn = build_program(p.queue.context, text).fn
     full_args = [cl_items]
     if p.cl_alpha is not None:
         full_args += [p.cl_alpha]
@@ -399,7 +413,9 @@ def ref_impl(p, items):
     fn.set_args(*[arr.data for arr in full_args])
     rval = Plan(p.queue, fn, gsize, lsize, name="clra_gemv.ref_impl",
         tag=p.tag,
-        bw_per_call=bw_from_geometry(p.geometry, items),
+        bw_per_call=bw_from_geometry(p.geometry, items,
+                                     a_elemsize=p.A.dtype.itemsize,
+                                     elemsize=p.Y.dtype.itemsize),
         flops_per_call=flops_from_geometry(p.geometry, items))
     rval.full_args = full_args  # prevent GC the args
     return rval
@@ -476,7 +492,7 @@ def reduce_impl(p, items,
 
     text = """
         __kernel void fn(
-            const __global int *gstructure,
+            const __global ${structure_t} *gstructure,
             const __global ${A.cl_buf.ocldtype} *A_data,
             const __global ${X.cl_buf.ocldtype} *X_data,
             % if cl_beta is not None:
@@ -485,7 +501,7 @@ def reduce_impl(p, items,
             const __global ${Y_in.cl_buf.ocldtype} *Y_in_data,
             __global ${Y.cl_buf.ocldtype} *Y_data)
     {
-        __local int lstructure[${n_structure_vars}];
+        __local ${structure_t} lstructure[${n_structure_vars}];
     % if segment_size > 1:
         // we'll cache X in shared memory so we load it only once
         // for the whole segment
@@ -555,7 +571,7 @@ def reduce_impl(p, items,
             if ((nn < ${N_i}) && (get_global_id(1) < ${y_len}))
             {
             partialDotProduct[get_local_id(1)][get_local_id(0)] +=
-                A_data[${a_starts} + get_global_id(1) * ${a_s0} + nn]
+                A_LOAD(${a_starts} + get_global_id(1) * ${a_s0} + nn)
                 * X_data[${x_starts} + nn];
             }
     % else:
@@ -568,7 +584,7 @@ def reduce_impl(p, items,
             if ((nn < ${N_i}) && (get_global_id(1) < ${y_len}))
             {
             partialDotProduct[get_local_id(1)][get_local_id(0)] +=
-                A_data[${a_starts} + get_global_id(1) * ${a_s0} + nn]
+                A_LOAD(${a_starts} + get_global_id(1) * ${a_s0} + nn)
                 * lX[get_local_id(0)];
             }
     % endif
@@ -600,9 +616,10 @@ def reduce_impl(p, items,
     }
         """
 
-    text = Template(text, output_encoding='ascii').render(**textconf)
+    text = Template(a_load_macro(p.A) + text,
+                    output_encoding='ascii').render(**textconf)
 
-    fn = cl.Program(p.queue.context, text).build().fn
+    fn = build_program(p.queue.context, text).fn
 
     full_args = [
                  cl_gstructure,
@@ -620,7 +637,9 @@ def reduce_impl(p, items,
     rval = Plan(p.queue, fn, gsize, lsize,
         name='clra_gemv.reduce_impl',
         tag=p.tag,
-        bw_per_call=bw_from_geometry(p.geometry, items),
+        bw_per_call=bw_from_geometry(p.geometry, items,
+                                     a_elemsize=p.A.dtype.itemsize,
+                                     elemsize=p.Y.dtype.itemsize),
         flops_per_call=flops_from_geometry(p.geometry, items),
         )
     rval.full_args = full_args  # prevent GC the args
@@ -707,7 +726,7 @@ def many_dots_impl(p, items):
 
     text = """
         __kernel void fn(
-            const __global int *gstructure,
+            const __global ${structure_t} *gstructure,
             const __global ${A.cl_buf.ocldtype} *A_data,
             const __global ${X.cl_buf.ocldtype} *X_data,
             % if cl_beta is not None:
@@ -716,7 +735,7 @@ def many_dots_impl(p, items):
             const __global ${Y_in.cl_buf.ocldtype} *Y_in_data,
             __global ${Y.cl_buf.ocldtype} *Y_data)
     {
-        __local int lstructure[${n_structure_vars}];
+        __local ${structure_t} lstructure[${n_structure_vars}];
         __local ${Y.cl_buf.ocldtype} y_sum_pre[${segment_size}];
         __local ${Y.cl_buf.ocldtype} \
             y_sum_post[${dot_block_size}][${segment_size}];
@@ -765,7 +784,7 @@ def many_dots_impl(p, items):
                 for (int nn = 0; nn < ${N_i}; nn += 1)
                 {
                     y_sum_post[dot_block_idx][segment_idx]
-                    += A_data[${a_starts} + get_global_id(0) * ${a_s0} + nn]
+                    += A_LOAD(${a_starts} + get_global_id(0) * ${a_s0} + nn)
                        * X_data[${x_starts} + nn];
                 }
             }
@@ -786,9 +805,10 @@ def many_dots_impl(p, items):
     }
         """
 
-    text = Template(text, output_encoding='ascii').render(**textconf)
+    text = Template(a_load_macro(p.A) + text,
+                    output_encoding='ascii').render(**textconf)
 
-    fn = cl.Program(p.queue.context, text).build().fn
+    fn = build_program(p.queue.context, text).fn
 
     full_args = [
                  cl_gstructure,
@@ -806,7 +826,9 @@ def many_dots_impl(p, items):
     rval = Plan(p.queue, fn, gsize, lsize,
         name='clra_gemv.many_dots_impl',
         tag=p.tag,
-        bw_per_call=bw_from_geometry(p.geometry, items),
+        bw_per_call=bw_from_geometry(p.geometry, items,
+                                     a_elemsize=p.A.dtype.itemsize,
+                                     elemsize=p.Y.dtype.itemsize),
         flops_per_call=flops_from_geometry(p.geometry, items),
         )
     rval.full_args = full_args  # prevent GC the args
@@ -1,7 +1,7 @@
 
 import numpy as np
 import pyopencl as cl
-from plan import Plan
+from plan import Plan, LookaheadPlan, StimulusTablePlan, build_program
 from mako.template import Template
 from clarray import to_device
 from .clraggedarray import CLRaggedArray
@@ -45,10 +45,10 @@ def plan_probes(queue, periods, X, Y, tag=None):
             __global int *countdowns,
             __global int *bufpositions,
             __global const int *periods,
-            __global const int *Xstarts,
+            __global const ${Xoffset} *Xstarts,
             __global const int *Xshape0s,
             __global const ${Xtype} *Xdata,
-            __global const int *Ystarts,
+            __global const ${Yoffset} *Ystarts,
             __global ${Ytype} *Ydata
         )
         {
@@ -91,7 +91,9 @@ def plan_probes(queue, periods, X, Y, tag=None):
 
     textconf = dict(N=N,
             Xtype=X.cl_buf.ocldtype,
-            Ytype=Y.cl_buf.ocldtype)
+            Ytype=Y.cl_buf.ocldtype,
+            Xoffset=X.ocl_offset_t,
+            Yoffset=Y.ocl_offset_t)
     text = Template(text, output_encoding='ascii').render(**textconf)
 
     full_args = (
@@ -104,7 +106,7 @@ def plan_probes(queue, periods, X, Y, tag=None):
         Y.cl_starts,
         Y.cl_buf,
         )
-    _fn = cl.Program(queue.context, text).build().fn
+    _fn = build_program(queue.context, text).fn
     _fn.set_args(*[arr.data for arr in full_args])
 
     max_len = min(queue.device.max_work_group_size, max(X.shape0s))
@@ -112,10 +114,156 @@ def plan_probes(queue, periods, X, Y, tag=None):
     lsize = (max_len, 1)
     rval = Plan(queue, _fn, gsize, lsize=lsize, name="cl_probes", tag=tag)
     rval.full_args = full_args     # prevent garbage-collection
+    rval.cl_countdowns = cl_countdowns
     rval.cl_bufpositions = cl_bufpositions
+    rval.cl_periods = cl_periods
+    rval.X = X
     rval.Y = Y
     return rval
 
+def plan_lookahead(queue, Y, produce, chunk, first_step=0, tag=None):
+    """
+    Each step, copy the next row of values computed by `produce` into Y.
+
+    `produce(step0, n)` returns an (n, D) array, where D is the total size
+    of the Y vectors, Y[0] first.  It is called on a worker thread, ahead
+    of the device (see plan.LookaheadPlan).
+    """
+    N = len(Y)
+    for i in xrange(N):
+        assert Y.shape1s[i] == 1
+        assert Y.stride0s[i] == 1
+    offsets = np.concatenate([[0], np.cumsum(Y.shape0s)[:-1]])
+    D = int(np.sum(Y.shape0s))
+
+    cl_offsets = to_device(queue, offsets.astype('int32'))
+    cl_ring = to_device(queue, np.zeros(2 * chunk * D, dtype=Y.dtype))
+
+    text = """
+        ////////// MAIN FUNCTION //////////
+        __kernel void fn(
+            const int slot,
+            __global const int *offsets,
+            __global const ${Ytype} *ring,
+            __global const ${Yoffset} *Ystarts,
+            __global const int *Yshape0s,
+            __global ${Ytype} *Ydata
+        )
+        {
+            const int n = get_global_id(1);
+            const int n_dims = Yshape0s[n];
+            __global const ${Ytype} *r = ring + slot * ${D} + offsets[n];
+            __global ${Ytype} *y = Ydata + Ystarts[n];
+
+            for (int ii = get_global_id(0);
+                     ii < n_dims;
+                     ii += get_global_size(0))
+            {
+                y[ii] = r[ii];
+            }
+        }
+        """
+
+    textconf = dict(D=D, Ytype=Y.cl_buf.ocldtype, Yoffset=Y.ocl_offset_t)
+    text = Template(text, output_encoding='ascii').render(**textconf)
+
+    full_args = (
+        cl_offsets,
+        cl_ring,
+        Y.cl_starts,
+        Y.cl_shape0s,
+        Y.cl_buf,
+        )
+    _fn = build_program(queue.context, text).fn
+    _fn.set_args(np.int32(0), *[arr.data for arr in full_args])
+
+    max_len = min(queue.device.max_work_group_size, max(Y.shape0s))
+    gsize = (max_len, N,)
+    lsize = (max_len, 1)
+    rval = LookaheadPlan(queue, _fn, gsize, lsize, 0, cl_ring, produce,
+                         chunk, first_step=first_step,
+                         name="cl_lookahead", tag=tag)
+    rval.full_args = full_args     # prevent garbage-collection
+    return rval
+
+def plan_stimulus_table(queue, Y, n_rows, tag=None):
+    """
+    Each step, copy one row of a table of precomputed values into Y.
+
+    The table has `n_rows` rows of D values (the total size of the Y
+    vectors, Y[0] first); `fill_stimulus_table` uploads rows, and the plan
+    (a StimulusTablePlan) picks the row of each step on the host.
+    """
+    N = len(Y)
+    for i in xrange(N):
+        assert Y.shape1s[i] == 1
+        assert Y.stride0s[i] == 1
+    offsets = np.concatenate([[0], np.cumsum(Y.shape0s)[:-1]])
+    D = int(np.sum(Y.shape0s))
+
+    cl_offsets = to_device(queue, offsets.astype('int32'))
+    cl_table = to_device(queue, np.zeros(n_rows * D, dtype=Y.dtype))
+
+    text = """
+        ////////// MAIN FUNCTION //////////
+        __kernel void fn(
+            const int row,
+            __global const int *offsets,
+            __global const ${Ytype} *table,
+            __global const ${Yoffset} *Ystarts,
+            __global const int *Yshape0s,
+            __global ${Ytype} *Ydata
+        )
+        {
+            const int n = get_global_id(1);
+            const int n_dims = Yshape0s[n];
+            __global const ${Ytype} *r = table + row * ${D} + offsets[n];
+            __global ${Ytype} *y = Ydata + Ystarts[n];
+
+            for (int ii = get_global_id(0);
+                     ii < n_dims;
+                     ii += get_global_size(0))
+            {
+                y[ii] = r[ii];
+            }
+        }
+        """
+
+    textconf = dict(D=D, Ytype=Y.cl_buf.ocldtype, Yoffset=Y.ocl_offset_t)
+    text = Template(text, output_encoding='ascii').render(**textconf)
+
+    full_args = (
+        cl_offsets,
+        cl_table,
+        Y.cl_starts,
+        Y.cl_shape0s,
+        Y.cl_buf,
+        )
+    _fn = build_program(queue.context, text).fn
+    _fn.set_args(np.int32(0), *[arr.data for arr in full_args])
+
+    max_len = min(queue.device.max_work_group_size, max(Y.shape0s))
+    gsize = (max_len, N,)
+    lsize = (max_len, 1)
+    rval = StimulusTablePlan(queue, _fn, gsize, lsize, 0, cl_table, n_rows,
+                             name="cl_stimulus_table", tag=tag)
+    rval.full_args = full_args     # prevent garbage-collection
+    return rval
+
+def fill_stimulus_table(plan, start, values):
+    """Upload `values` (rows for steps start, start + 1, ...) into the table
+    of a plan_stimulus_table plan, which continues from step `start`.
+
+    The copy is enqueued behind every kernel already on the plan's queue,
+    so kernels reading the old rows are done first.
+    """
+    values = np.ascontiguousarray(values, dtype=plan.cl_table.dtype)
+    assert len(values) <= plan.n_rows
+    cl.enqueue_copy(plan.queue, plan.cl_table.data, values,
+                    is_blocking=True)
+    plan.table_range = (start, start + len(values))
+    plan.pos = start
+
 def plan_direct(queue, code, init, Xname, X, Y, tag=None):
     from . import ast_conversion
 
@@ -125,9 +273,9 @@ def plan_direct(queue, code, init, Xname, X, Y, tag=None):
     text = """
         ////////// MAIN FUNCTION //////////
         __kernel void fn(
-            __global const int *${IN}starts,
+            __global const ${INoffset} *${IN}starts,
             __global const ${INtype} *${IN}data,
-            __global const int *${OUT}starts,
+            __global const ${OUToffset} *${OUT}starts,
             __global ${OUTtype} *${OUT}data
         )
         {
@@ -150,11 +298,12 @@ ${code}
                     code=_indent(code, 12), N=N, arg=Xname,
                     IN=ast_conversion.INPUT_NAME, INtype=X.cl_buf.ocldtype,
                     OUT=ast_conversion.OUTPUT_NAME, OUTtype=Y.cl_buf.ocldtype,
+                    INoffset=X.ocl_offset_t, OUToffset=Y.ocl_offset_t,
                     )
     text = Template(text, output_encoding='ascii').render(**textconf)
 
     full_args = (X.cl_starts, X.cl_buf, Y.cl_starts, Y.cl_buf)
-    _fn = cl.Program(queue.context, text).build().fn
+    _fn = build_program(queue.context, text).fn
     _fn.set_args(*[arr.data for arr in full_args])
 
     gsize = (N,)
@@ -162,21 +311,16 @@ ${code}
     rval.full_args = full_args     # prevent garbage-collection
     return rval
 
-def plan_lif(queue, J, V, W, OV, OW, OS, ref, tau, dt,
-             tag=None, n_elements=0, upsample=1):
-    inputs = dict(j=J, v=V, w=W)
-    outputs = dict(ov=OV, ow=OW, os=OS)
-    parameters = dict(tau=tau, ref=ref)
+def lif_core_text(dt, upsample=1):
+    """Return the OpenCL statements of one LIF step (`upsample` substeps).
 
+    They read `j`, `v`, `w`, `tau` and `ref`, and set `ov`, `ow` and `os`;
+    `spiked`, `dV` and `overshoot` must be declared (see plan_lif).
+    """
     dt = float(dt)
     textconf = dict(upsample=upsample, dt=dt/upsample, dt_inv=upsample/dt,
                     V_threshold=1.)
 
-    declares = """
-            char spiked;
-            %(Vtype)s dV, overshoot;
-            """ % ({'Vtype': V.cl_buf.ocldtype})
-
     text = """
             spiked = 0;
 
@@ -202,21 +346,40 @@ def plan_lif(queue, J, V, W, OV, OW, OS, ref, tau, dt,
             ow = w;
             os = (spiked) ? 1.0f : 0.0f;
             """
-    text = Template(text, output_encoding='ascii').render(**textconf)
+    return Template(text, output_encoding='ascii').render(**textconf)
+
+def plan_lif(queue, J, V, W, OV, OW, OS, ref, tau, dt,
+             tag=None, n_elements=0, upsample=1):
+    inputs = dict(j=J, v=V, w=W)
+    outputs = dict(ov=OV, ow=OW, os=OS)
+    parameters = dict(tau=tau, ref=ref)
+
+    declares = """
+            char spiked;
+            %(Vtype)s dV, overshoot;
+            """ % ({'Vtype': V.cl_buf.ocldtype})
+
+    text = lif_core_text(dt, upsample)
 
     return _plan_template(
         queue, "cl_lif", text, declares=declares,
         tag=tag, n_elements=n_elements,
         inputs=inputs, outputs=outputs, parameters=parameters)
 
+def lif_rate_core_text(dt):
+    """Return the OpenCL statements of one LIFRate step: they read (and
+    change) `j`, read `tau` and `ref`, and set `r`.
+    """
+    return """
+            j = max(j - 1, 0.0f);
+            r = %(dt)e / (ref + tau * log1p(1.0/j));
+            """ % dict(dt=dt)
+
 def plan_lif_rate(queue, J, R, ref, tau, dt, tag=None, n_elements=0):
     inputs = dict(j=J)
     outputs = dict(r=R)
     parameters = dict(tau=tau, ref=ref)
-    text = """
-            j = max(j - 1, 0.0f);
-            r = %(dt)e / (ref + tau * log1p(1.0/j));
-            """ % dict(dt=dt)
+    text = lif_rate_core_text(dt)
 
     return _plan_template(
         queue, "cl_lif_rate", text, tag=tag, n_elements=n_elements,
@@ -263,7 +426,7 @@ def _plan_template(queue, name, core_text, declares="", tag=None, n_elements=0,
             params[k] = v
         else:
             try:
-                static_params[k] = ('float', float(v))
+                static_params[k] = (base.cl_buf.ocldtype, float(v))
             except TypeError:
                 raise
 
@@ -297,10 +460,13 @@ def _plan_template(queue, name, core_text, declares="", tag=None, n_elements=0,
     ovars = dict((k, avars[k]) for k in outputs.keys())
     pvars = dict((k, avars[k]) for k in params.keys())
 
+    offset_ts = dict((vname, v.ocl_offset_t) for vname, v
+                     in inputs.items() + outputs.items() + params.items())
+
     textconf = dict(N=N, n_elements=n_elements, tag=str(tag),
                     declares=declares, core_text=core_text,
                     ivars=ivars, ovars=ovars, pvars=pvars,
-                    static_params=static_params)
+                    offset_ts=offset_ts, static_params=static_params)
 
     if n_elements > 0:
         ### Allocate the exact number of required kernels in a vector
@@ -309,15 +475,15 @@ def _plan_template(queue, name, core_text, declares="", tag=None, n_elements=0,
         ////////// MAIN FUNCTION //////////
         __kernel void fn(
 % for name, [type, offset] in ivars.items():
-            __global const int *${name}_starts,
+            __global const ${offset_ts[name]} *${name}_starts,
             __global const ${type} *in_${name},
 % endfor
 % for name, [type, offset] in ovars.items():
-            __global const int *${name}_starts,
+            __global const ${offset_ts[name]} *${name}_starts,
             __global ${type} *in_${name},
 % endfor
 % for name, [type, offset] in pvars.items():
-            __global const int *${name}_starts,
+            __global const ${offset_ts[name]} *${name}_starts,
             __global const int *${name}_shape0s,
             __global const ${type} *in_${name},
 % endfor
@@ -406,15 +572,15 @@ def _plan_template(queue, name, core_text, declares="", tag=None, n_elements=0,
         ////////// MAIN FUNCTION //////////
         __kernel void fn(
 % for name, [type, offset] in ivars.items():
-            __global const int *${name}_starts,
+            __global const ${offset_ts[name]} *${name}_starts,
             __global const ${type} *in_${name},
 % endfor
 % for name, [type, offset] in ovars.items():
-            __global const int *${name}_starts,
+            __global const ${offset_ts[name]} *${name}_starts,
             __global ${type} *in_${name},
 % endfor
 % for name, [type, offset] in pvars.items():
-            __global const int *${name}_starts,
+            __global const ${offset_ts[name]} *${name}_starts,
             __global const int *${name}_shape0s,
             __global const ${type} *in_${name},
 % endfor
@@ -468,7 +634,7 @@ def _plan_template(queue, name, core_text, declares="", tag=None, n_elements=0,
     full_args.append(base.cl_shape0s)
     full_args = tuple(full_args)
 
-    _fn = cl.Program(queue.context, text).build().fn
+    _fn = build_program(queue.context, text).fn
     _fn.set_args(*[arr.data for arr in full_args])
 
     rval = Plan(queue, _fn, gsize, lsize=None, name=name, tag=tag)
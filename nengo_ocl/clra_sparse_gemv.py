@@ -0,0 +1,140 @@
+"""
+Sparse gather-gemv: Y += A X for sparse, read-only A.
+
+The rows of all the sparse matrices of a plan are stored together, with
+absolute indices into the signal buffer, so one work-item computes one
+element of Y:
+
+    data[y_idx[r]] += sum_k vals[k] * data[cols[k]]
+
+In CSR format the entries of row r are k = indptr[r] .. indptr[r + 1] - 1.
+In ELL format every row is padded (with zero values) to the same width W,
+and entry k of row r is at k * n_rows + r, so that neighbouring work-items
+read neighbouring entries.  ELL wastes no time on row lengths when they
+are regular, CSR wastes no space when they are not (see choose_format).
+"""
+import numpy as np
+from plan import Plan, build_program
+from mako.template import Template
+from clarray import to_device
+
+
+def choose_format(row_nnz, max_padding=1.5):
+    """Return 'ell' if padding all rows to the longest one stores at most
+    `max_padding` times the nonzeros, otherwise 'csr'.
+    """
+    row_nnz = np.asarray(row_nnz)
+    nnz = row_nnz.sum()
+    if nnz == 0 or row_nnz.max() * len(row_nnz) <= max_padding * nnz:
+        return 'ell'
+    return 'csr'
+
+
+def csr_from_rows(rows):
+    """Return indptr, cols, vals from a list of (cols, vals) rows"""
+    indptr = np.zeros(len(rows) + 1, dtype='int32')
+    indptr[1:] = np.cumsum([len(cols) for cols, vals in rows])
+    cols = np.concatenate([[]] + [c for c, v in rows]).astype('int64')
+    vals = np.concatenate([[]] + [v for c, v in rows])
+    return indptr, cols, vals
+
+
+def ell_from_rows(rows, pad_cols):
+    """Return width, cols, vals (column-major) from (cols, vals) rows.
+
+    Row r is padded with zero values at column pad_cols[r] (e.g. its own
+    output element), so that padding never reads an unrelated inf or nan.
+    """
+    width = max(len(c) for c, v in rows) if rows else 0
+    cols = np.empty((width, len(rows)), dtype='int64')
+    cols[...] = np.asarray(pad_cols, dtype='int64')
+    vals = np.zeros((width, len(rows)))
+    for rr, (c, v) in enumerate(rows):
+        cols[:len(c), rr] = c
+        vals[:len(v), rr] = v
+    return width, cols.ravel(), vals.ravel()
+
+
+def plan_sparse_gemv(queue, data, y_idx, rows, fmt, tag=None, tables=None):
+    """Plan data[y_idx[r]] += dot(vals, data[cols]) for each row r.
+
+    `data` is the device signal buffer (e.g. all_data.cl_buf), `rows` a
+    list of (cols, vals) with absolute buffer indices, and `fmt` either
+    'csr' or 'ell'.  `tables` can be the `tables` of an earlier plan of
+    the same rows (e.g. on a buffer of the same layout), to share its
+    device arrays rather than upload them again.
+    """
+    N = len(rows)
+    assert len(y_idx) == N > 0
+    nnz = sum(len(c) for c, v in rows)
+    # -- buffer positions need 64 bits in a buffer of 2**31 elements or more
+    idx_dtype = np.dtype('int64' if data.size > np.iinfo('int32').max
+                         else 'int32')
+    if fmt == 'csr':
+        indptr, cols, vals = csr_from_rows(rows)
+        loop = """
+            for (int k = indptr[r]; k < indptr[r + 1]; ++k)
+            {
+                y_sum += vals[k] * data[cols[k]];
+            }"""
+    elif fmt == 'ell':
+        width, cols, vals = ell_from_rows(rows, y_idx)
+        # -- unused, but keeps the kernel signature the same
+        indptr = np.zeros(1, dtype='int32')
+        loop = """
+            for (int k = r; k < ${width} * ${N}; k += ${N})
+            {
+                y_sum += vals[k] * data[cols[k]];
+            }"""
+    else:
+        raise ValueError('unknown sparse format', fmt)
+
+    text = """
+        ////////// MAIN FUNCTION //////////
+        __kernel void fn(
+            __global const ${I} *y_idx,
+            __global const int *indptr,
+            __global const ${I} *cols,
+            __global const ${T} *vals,
+            __global ${T} *data
+        )
+        {
+            const int r = get_global_id(0);
+            if (r >= ${N}) return;
+            ${T} y_sum = 0;
+""" + loop + """
+            data[y_idx[r]] += y_sum;
+        }
+        """
+    textconf = dict(N=N, T=data.ocldtype,
+                    I='long' if idx_dtype == np.int64 else 'int')
+    if fmt == 'ell':
+        textconf['width'] = width
+    text = Template(text, output_encoding='ascii').render(**textconf)
+
+    if tables is None:
+        tables = (
+            to_device(queue, np.asarray(y_idx, dtype=idx_dtype)),
+            to_device(queue, indptr),
+            # -- to_device can't upload empty arrays
+            to_device(queue, (cols if len(cols) else np.zeros(1))
+                      .astype(idx_dtype)),
+            to_device(queue, np.asarray(vals if len(vals) else [0],
+                                        dtype=data.dtype)),
+            )
+    full_args = tuple(tables) + (data,)
+    _fn = build_program(queue.context, text).fn
+    _fn.set_args(*[arr.data for arr in full_args])
+
+    itemsize = data.dtype.itemsize
+    rval = Plan(queue, _fn, (N,), None,
+                name="cl_sparse_gemv_" + fmt, tag=tag,
+                flops_per_call=2 * nnz,
+                # -- read vals, cols and X; read and write Y
+                bw_per_call=(nnz * (2 * itemsize + idx_dtype.itemsize)
+                             + N * (2 * itemsize + idx_dtype.itemsize)),
+                )
+    rval.full_args = full_args     # prevent garbage-collection
+    rval.tables = tables
+    rval.nnz = nnz
+    return rval
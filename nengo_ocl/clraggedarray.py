@@ -6,7 +6,9 @@ OpenCL-based implementation of RaggedArray data structure.
 import StringIO
 import numpy as np
 import pyopencl as cl
+from mako.template import Template
 from .clarray import to_device
+from .plan import build_program
 from .raggedarray import RaggedArray
 
 def to_host(queue, data, dtype, start, shape, elemstrides):
@@ -48,10 +50,43 @@ class CLRaggedArray(object):
 
     @property
     def dtype(self):
-        return self.buf.dtype
+        return self.cl_buf.dtype
 
-    def __init__(self, queue, np_raggedarray):
+    # -- buffer of each item (None: all items are in cl_buf), where buffer
+    #    0 is cl_buf and buffer k > 0 is shard_bufs[k - 1]
+    buf_ids = None
+    shard_bufs = ()
+
+    # -- dtype of `starts` (the other metadata is always int32)
+    offset_dtype = np.dtype('int32')
+
+    @property
+    def ocl_offset_t(self):
+        """The OpenCL type of `starts`, for kernel templates"""
+        return 'long' if self.offset_dtype == np.int64 else 'int'
+
+    def __init__(self, queue, np_raggedarray, dtype=np.float32,
+                 shards=(), buf_ids=None, offset_dtype=None):
+        """
+        Floating-point data is stored on the device as `dtype` (float32 by
+        default, float64 needs a device with cl_khr_fp64).  Integer data is
+        stored as int32.
+
+        The items can be spread over several device buffers, e.g. to stay
+        under the device's maximum allocation size: `shards` is a list of
+        extra host buffers, and `buf_ids` says which buffer each item is
+        in (0 for np_raggedarray.buf, k for shards[k - 1]).  Starts are
+        offsets into the item's own buffer.  Kernels see one buffer at a
+        time, through `shard`.
+
+        `offset_dtype` (default: that of np_raggedarray.starts) is int32
+        or int64; kernels declare `starts` as `ocl_offset_t`.
+        """
         self.queue = queue
+        self.float_dtype = np.dtype(dtype)
+        if offset_dtype is None:
+            offset_dtype = np_raggedarray.starts.dtype
+        self.offset_dtype = np.dtype(offset_dtype)
         self.starts = np_raggedarray.starts
         self.shape0s = np_raggedarray.shape0s
         self.shape1s = np_raggedarray.shape1s
@@ -59,6 +94,12 @@ class CLRaggedArray(object):
         self.stride1s = np_raggedarray.stride1s
         self.buf = np_raggedarray.buf
         self.names = np_raggedarray.names
+        if shards:
+            assert len(buf_ids) == len(self)
+            self.buf_ids = np.asarray(buf_ids, dtype='int32')
+            self.shard_bufs = [
+                to_device(self.queue, np.asarray(buf, dtype=self.dtype))
+                for buf in shards]
 
     def __str__(self):
         sio = StringIO.StringIO()
@@ -70,55 +111,34 @@ class CLRaggedArray(object):
             print >> sio, (fmt % nn), self[ii]
         return sio.getvalue()
 
-    @property
-    def starts(self):
-        return self._starts.tolist()
-
-    @starts.setter
-    def starts(self, starts):
-        self._starts = np.array(starts, dtype='int32')
-        self.cl_starts = to_device(self.queue, self._starts)
-        self.queue.finish()
-
-    @property
-    def shape0s(self):
-        return self._shape0s.tolist()
-
-    @shape0s.setter
-    def shape0s(self, shape0s):
-        self._shape0s = np.array(shape0s, dtype='int32')
-        self.cl_shape0s = to_device(self.queue, self._shape0s)
-        self.queue.finish()
-
-    @property
-    def shape1s(self):
-        return self._shape1s.tolist()
-
-    @shape1s.setter
-    def shape1s(self, shape1s):
-        self._shape1s = np.array(shape1s, dtype='int32')
-        self.cl_shape1s = to_device(self.queue, self._shape1s)
-        self.queue.finish()
-
-    @property
-    def stride0s(self):
-        return self._stride0s.tolist()
-
-    @stride0s.setter
-    def stride0s(self, stride0s):
-        self._stride0s = np.array(stride0s, dtype='int32')
-        self.cl_stride0s = to_device(self.queue, self._stride0s)
-        self.queue.finish()
-
-    @property
-    def stride1s(self):
-        return self._stride1s.tolist()
-
-    @stride1s.setter
-    def stride1s(self, stride1s):
-        self._stride1s = np.array(stride1s, dtype='int32')
-        self.cl_stride1s = to_device(self.queue, self._stride1s)
-        self.queue.finish()
+    # -- View metadata is kept as int32 arrays (starts: offset_dtype) on
+    #    the host.  Assigning one only replaces the host array; the device
+    #    copy (e.g. cl_starts) is uploaded the first time a plan asks for it.
+    def _meta_property(name):
+        def get(self):
+            return getattr(self, '_' + name)
+
+        def setter(self, val):
+            dtype = self.offset_dtype if name == 'starts' else 'int32'
+            setattr(self, '_' + name, np.asarray(val, dtype=dtype))
+            self.__dict__.pop('_cl_' + name, None)
+            self.__dict__.pop('_gathers', None)
+
+        def get_cl(self):
+            try:
+                return self.__dict__['_cl_' + name]
+            except KeyError:
+                rval = to_device(self.queue, getattr(self, '_' + name))
+                self.__dict__['_cl_' + name] = rval
+                return rval
+        return property(get, setter), property(get_cl)
+
+    starts, cl_starts = _meta_property('starts')
+    shape0s, cl_shape0s = _meta_property('shape0s')
+    shape1s, cl_shape1s = _meta_property('shape1s')
+    stride0s, cl_stride0s = _meta_property('stride0s')
+    stride1s, cl_stride1s = _meta_property('stride1s')
+    del _meta_property
 
     @property
     def buf(self):
@@ -131,21 +151,37 @@ class CLRaggedArray(object):
         buf = np.asarray(buf)
         if 'int' in str(buf.dtype):
             buf = buf.astype('int32')
-        if buf.dtype == np.dtype('float64'):
-            buf = buf.astype('float32')
+        elif buf.dtype.kind == 'f' and buf.dtype != self.float_dtype:
+            buf = buf.astype(self.float_dtype)
         self.cl_buf = to_device(self.queue, buf)
         self.queue.finish()
 
-    # def shallow_copy(self):
-    #     rval = self.__class__.__new__(self.__class__)
-    #     rval.cl_starts = self.cl_starts
-    #     rval.cl_lens = self.cl_lens
-    #     rval.cl_buf = self.cl_buf
-    #     rval.queue = self.queue
-    #     return rval
+    def shallow_copy(self):
+        """Return a CLRaggedArray sharing all device arrays with this one"""
+        rval = self.__class__.__new__(self.__class__)
+        rval.__dict__.update(self.__dict__)
+        return rval
 
     def __len__(self):
-        return self.cl_starts.shape[0]
+        return len(self._starts)
+
+    def item_buf(self, item):
+        """The device buffer holding `item`"""
+        if self.buf_ids is None or self.buf_ids[item] == 0:
+            return self.cl_buf
+        return self.shard_bufs[self.buf_ids[item] - 1]
+
+    def shard(self, buf_id):
+        """Return a copy whose cl_buf is buffer `buf_id`, for kernels.
+
+        Only the items in that buffer are valid in the copy.
+        """
+        rval = self.shallow_copy()
+        rval.cl_buf = self.cl_buf if buf_id == 0 else \
+            self.shard_bufs[buf_id - 1]
+        rval.buf_ids = None
+        rval.shard_bufs = ()
+        return rval
 
     def __getitem__(self, item):
         """
@@ -153,7 +189,6 @@ class CLRaggedArray(object):
         Getting multiple items returns a view into the device.
         """
 
-        # -- these are each OCL fetch operations (could be sped up)
         starts = self.starts
         shape0s = self.shape0s
         shape1s = self.shape1s
@@ -166,19 +201,26 @@ class CLRaggedArray(object):
 
             rval = self.__class__.__new__(self.__class__)
             rval.queue = self.queue
-            rval.starts = [starts[i] for i in items]
-            rval.shape0s = [shape0s[i] for i in items]
-            rval.shape1s = [shape1s[i] for i in items]
-            rval.stride0s = [stride0s[i] for i in items]
-            rval.stride1s = [stride1s[i] for i in items]
+            rval.float_dtype = self.float_dtype
+            rval.offset_dtype = self.offset_dtype
+            items = np.asarray(items, dtype='int64')
+            rval.starts = starts[items]
+            rval.shape0s = shape0s[items]
+            rval.shape1s = shape1s[items]
+            rval.stride0s = stride0s[items]
+            rval.stride1s = stride1s[items]
             rval.cl_buf = self.cl_buf
             rval.names = [self.names[i] for i in items]
+            if self.buf_ids is not None:
+                rval.buf_ids = self.buf_ids[items]
+                rval.shard_bufs = self.shard_bufs
             return rval
         else:
             buf = to_host(
-                self.queue, self.cl_buf.data, self.dtype, self.starts[item],
-                (self.shape0s[item], self.shape1s[item]),
-                (self.stride0s[item], self.stride1s[item]),
+                self.queue, self.item_buf(item).data, self.dtype,
+                int(starts[item]),
+                (int(shape0s[item]), int(shape1s[item])),
+                (int(stride0s[item]), int(stride1s[item])),
                 )
             buf.setflags(write=False)
             return buf
@@ -192,8 +234,8 @@ class CLRaggedArray(object):
         if isinstance(item, (list, tuple)):
             raise NotImplementedError('TODO')
         else:
-            m, n = shape0s[item], shape1s[item]
-            sM, sN = stride0s[item], stride1s[item]
+            m, n = int(shape0s[item]), int(shape1s[item])
+            sM, sN = int(stride0s[item]), int(stride1s[item])
 
             if sM < 0 or sN < 0:
                 raise NotImplementedError()
@@ -201,15 +243,13 @@ class CLRaggedArray(object):
                 raise NotImplementedError('discontiguous setitem')
 
             itemsize = self.dtype.itemsize
-            bytestart = itemsize * starts[item]
+            bytestart = itemsize * int(starts[item])
             # -- N.B. match to getitem
             byteend = bytestart + itemsize * ((m-1) * sM + (n-1) * sN + 1)
 
-            temp_buf = np.zeros((byteend - bytestart), dtype=np.int8)
-            # -- TODO: if copying into a contiguous region, this
-            #          first copy from the device is unnecessary
-            cl.enqueue_copy(self.queue, temp_buf, self.cl_buf.data,
-                            device_offset=bytestart, is_blocking=True)
+            # -- the region is contiguous (see above) and every element of
+            #    it is written, so it doesn't need to be read back first
+            temp_buf = np.empty((byteend - bytestart), dtype=np.int8)
 
             bytestrides = (itemsize * sM, itemsize * sN)
             view = np.ndarray(
@@ -220,9 +260,107 @@ class CLRaggedArray(object):
                 strides=bytestrides)
             view[...] = new_value
             # print temp_buf.view('float32')
-            cl.enqueue_copy(self.queue, self.cl_buf.data, temp_buf,
+            cl.enqueue_copy(self.queue, self.item_buf(item).data, temp_buf,
                             device_offset=bytestart, is_blocking=True)
 
+    _gather_text = """
+        __kernel void fn(
+            __global const ${I} *idx,
+            __global const int *pos,
+            __global ${T} *data,
+            __global ${T} *scratch
+        )
+        {
+            const int i = get_global_id(0);
+        % if scatter:
+            data[idx[i]] = scratch[pos[i]];
+        % else:
+            scratch[pos[i]] = data[idx[i]];
+        % endif
+        }
+        """
+
+    def _gather(self, items, scatter=False):
+        """Return kernels moving the elements of `items` between their
+        buffers and a device scratch array, and where each item is in it.
+
+        The scratch array holds the items one after the other, each in C
+        order.  There is one kernel per buffer holding some of the items;
+        with scatter=False they gather into the scratch array, otherwise
+        they scatter from it.  Returns (kernels, scratch, [(offset in
+        scratch, (m, n))]), cached by `items`.
+        """
+        key = (tuple(items), scatter, self.cl_buf.data.int_ptr)
+        cache = self.__dict__.setdefault('_gathers', {})
+        if key in cache:
+            return cache[key]
+
+        idxs = {}
+        layout = []
+        size = 0
+        for item in items:
+            m, n = int(self.shape0s[item]), int(self.shape1s[item])
+            sM, sN = int(self.stride0s[item]), int(self.stride1s[item])
+            idx = (int(self.starts[item]) + sM * np.arange(m)[:, None]
+                   + sN * np.arange(n)[None, :]).ravel()
+            buf_id = 0 if self.buf_ids is None else int(self.buf_ids[item])
+            pos = np.arange(size, size + m * n)
+            idxs.setdefault(buf_id, []).append((idx, pos))
+            layout.append((size, (m, n)))
+            size += m * n
+
+        scratch = to_device(self.queue, np.zeros(max(size, 1),
+                                                 dtype=self.dtype))
+        text = Template(self._gather_text, output_encoding='ascii').render(
+            I=self.ocl_offset_t, T=self.cl_buf.ocldtype, scatter=scatter)
+        kernels = []
+        for buf_id in sorted(idxs):
+            idx = np.concatenate([ii for ii, pp in idxs[buf_id]])
+            pos = np.concatenate([pp for ii, pp in idxs[buf_id]])
+            if not len(idx):
+                continue
+            data = (self.cl_buf if buf_id == 0
+                    else self.shard_bufs[buf_id - 1])
+            args = (to_device(self.queue, idx.astype(self.offset_dtype)),
+                    to_device(self.queue, pos.astype('int32')),
+                    data, scratch)
+            kern = build_program(self.queue.context, text).fn
+            kern.set_args(*[arr.data for arr in args])
+            # -- keep the index arrays alive with the kernel
+            kernels.append((kern, len(idx), args))
+        cache[key] = (kernels, scratch, layout)
+        return cache[key]
+
+    def get_items(self, items):
+        """Return host copies of several items.
+
+        The items are gathered on the device into one scratch array (one
+        kernel per buffer), which is read with a single transfer.
+        """
+        kernels, scratch, layout = self._gather(items)
+        temp = np.empty(scratch.shape, dtype=self.dtype)
+        if kernels:
+            for kern, n, args in kernels:
+                cl.enqueue_nd_range_kernel(self.queue, kern, (n,), None)
+            cl.enqueue_copy(self.queue, temp, scratch.data, is_blocking=True)
+        return [temp[offset:offset + m * n].reshape(m, n)
+                for offset, (m, n) in layout]
+
+    def set_items(self, items, new_values):
+        """Write several items, like get_items: one transfer into a scratch
+        array, which is scattered on the device."""
+        kernels, scratch, layout = self._gather(items, scatter=True)
+        if not kernels:
+            return
+        temp = np.empty(scratch.shape, dtype=self.dtype)
+        for (offset, (m, n)), value in zip(layout, new_values):
+            temp[offset:offset + m * n].reshape(m, n)[...] = value
+        cl.enqueue_copy(self.queue, scratch.data, temp, is_blocking=False)
+        for kern, n, args in kernels:
+            ev = cl.enqueue_nd_range_kernel(self.queue, kern, (n,), None)
+        # -- (which also keeps `temp` alive until it is uploaded)
+        ev.wait()
+
     def to_host(self):
         """Copy the whole object to a host RaggedArray"""
         rval = RaggedArray.__new__(RaggedArray)
@@ -0,0 +1,386 @@
+"""
+Megakernel: a whole simulator step (or several) in one kernel launch.
+
+For small models a step is mostly kernel launch overhead: a gemv plan per
+group of MultiProdUpdates (many of them over scalars like step and time),
+the neurons, the probes.  A megakernel runs op groups of these kinds as
+stages of one kernel, on a single work-group, with a barrier between
+stages.  (OpenCL has no barrier across work-groups, so a single work-group
+is the only way to order the stages inside one launch; this only pays off
+for models small enough to keep one compute unit busy.)
+
+Ops that never touch a signal written by each other's islands (see
+find_islands), e.g. separate recurrent ensembles, need no ordering at all,
+so each island can get its own work-group, with its own stages, and run
+any number of steps without waiting for the others.
+
+Outside of megakernel mode, small_groups collects the tiny op groups of
+each dependency layer (e.g. the step and time updates), which would
+otherwise cost a launch each, into a single-stage megakernel.
+
+Each stage is a set of op groups that don't depend on each other (see
+stage_levels), and is described by flat per-element tables:
+
+    gemv:      data[y] = gamma + beta * data[y_in]
+                         + sum_t sum_k data[a_t + k * a_step_t]
+                                   * data[x_t + k * x_step_t]
+               for each output element of a MultiProdUpdate
+    lif:       one LIF step per neuron (see clra_nonlinearities)
+    lif_rate:  one LIFRate step per neuron
+
+plan_megakernel makes the plan; its kernel loops over `n_steps` steps
+(kernel argument 0, see MegakernelPlan.set_n_steps), and can also do the
+work of the probe plan at the end of each step.
+"""
+import numpy as np
+from plan import Plan, build_program
+from mako.template import Template
+from clarray import to_device
+from clra_nonlinearities import lif_core_text, lif_rate_core_text
+
+
+def stage_levels(group_idxs, group_deps):
+    """Return the stage of each op group in `group_idxs` (increasing
+    indices into op_groups): one more than the latest stage of a group it
+    depends on (see sim_npy.op_group_dependencies), or 0."""
+    level = {}
+    for ii in group_idxs:
+        level[ii] = max([level[jj] + 1 for jj in group_deps[ii]
+                         if jj in level] + [0])
+    return [level[ii] for ii in group_idxs]
+
+
+def small_groups(sizes, group_deps, max_size):
+    """Collect the small op groups of each dependency layer, for one kernel.
+
+    `sizes[ii]` is the work of op group ii (e.g. its output elements plus
+    multiply-adds), or None if it can't go in a megakernel.  Groups of at
+    most `max_size` are collected by stage_levels layer.  A layer's kernel
+    runs in place of its first group, so a later group only joins if all
+    the groups it depends on come before that one (so moving it up is
+    safe, see sim_npy.op_group_dependencies).
+
+    Returns a dict mapping the first index of each collection of two or
+    more groups to the collection's indices.
+    """
+    levels = stage_levels(range(len(sizes)), group_deps)
+    first = {}
+    rval = {}
+    for ii, (size, level) in enumerate(zip(sizes, levels)):
+        if size is None or size > max_size:
+            continue
+        start = first.setdefault(level, ii)
+        if start == ii or max(group_deps[ii] + [-1]) < start:
+            rval.setdefault(start, []).append(ii)
+    return dict((ii, idxs) for ii, idxs in rval.items() if len(idxs) > 1)
+
+
+def find_islands(ops, written):
+    """Partition `ops` into islands, such that no base in `written` is
+    touched by the ops of two islands.
+
+    Returns the islands (lists of ops, in op order) and a dict mapping
+    each base of `written` touched by `ops` to the index of its island.
+    """
+    parent = dict((op, op) for op in ops)
+
+    def find(op):
+        while parent[op] is not op:
+            parent[op] = parent[parent[op]]
+            op = parent[op]
+        return op
+
+    first_op = {}
+    for op in ops:
+        for sig in op.all_signals:
+            if sig.base in written:
+                other = first_op.setdefault(sig.base, op)
+                parent[find(op)] = find(other)
+    index = {}
+    islands = []
+    for op in ops:
+        root = find(op)
+        if root not in index:
+            index[root] = len(islands)
+            islands.append([])
+        islands[index[root]].append(op)
+    return islands, dict((base, index[find(op)])
+                         for base, op in first_op.items())
+
+
+def _positions(ra, idx, rows, cols):
+    return (ra.starts[idx].astype('int64') + rows * ra.stride0s[idx]
+            + cols * ra.stride1s[idx])
+
+
+def gemv_elements(ops, AX_views, YYB_views, ra, sidx):
+    """Return the gemv tables (a dict of arrays) of MultiProdUpdate `ops`,
+    whose signals are items `sidx[view]` of RaggedArray `ra`"""
+    cols = dict((name, []) for name in [
+        'y', 'y_in', 'beta_at', 'beta', 'gamma', 'n_terms',
+        'a', 'a_step', 'x', 'x_step', 'len'])
+    for op in ops:
+        Y = sidx[YYB_views[op][0]]
+        M, N = ra.shape0s[Y], ra.shape1s[Y]
+        rows, cc = [ii.ravel() for ii in np.mgrid[:M, :N]]
+        cols['y'].append(_positions(ra, Y, rows, cc))
+        cols['y_in'].append(_positions(ra, sidx[YYB_views[op][1]], rows, cc))
+        if op._float_beta is None:
+            cols['beta_at'].append(
+                _positions(ra, sidx[YYB_views[op][2]], rows, cc))
+            cols['beta'].append(np.zeros(M * N))
+        else:
+            cols['beta_at'].append(-np.ones(M * N, dtype='int64'))
+            cols['beta'].append(op._float_beta * np.ones(M * N))
+        cols['gamma'].append(op.gamma * np.ones(M * N))
+        AX = AX_views[op]
+        cols['n_terms'].append(len(AX) // 2 * np.ones(M * N, dtype='int32'))
+        # -- the terms of each element are contiguous
+        terms = [[] for name in ['a', 'a_step', 'x', 'x_step', 'len']]
+        for A, X in zip(AX[0::2], AX[1::2]):
+            A, X = sidx[A], sidx[X]
+            terms[0].append(_positions(ra, A, rows, 0))
+            terms[1].append(ra.stride1s[A] * np.ones(M * N, dtype='int32'))
+            terms[2].append(_positions(ra, X, 0, cc))
+            terms[3].append(ra.stride0s[X] * np.ones(M * N, dtype='int32'))
+            terms[4].append(ra.shape1s[A] * np.ones(M * N, dtype='int32'))
+        for name, term in zip(['a', 'a_step', 'x', 'x_step', 'len'], terms):
+            if term:
+                cols[name].append(np.asarray(term).T.ravel())
+    return _concatenate(cols)
+
+
+def neuron_elements(ops, roles, ra, sidx):
+    """Return the neuron tables of SimLIF or SimLIFRate `ops`: for each
+    (name, attribute) in `roles`, the buffer positions of the attribute's
+    elements, plus their 'ref' and 'tau'"""
+    cols = dict((name, []) for name, attr in roles)
+    cols['ref'] = []
+    cols['tau'] = []
+    for op in ops:
+        size = op.J.size
+        for name, attr in roles:
+            idx = sidx[getattr(op, attr)]
+            cols[name].append(_positions(ra, idx, np.arange(size), 0))
+        cols['ref'].append(op.nl.tau_ref * np.ones(size))
+        cols['tau'].append(op.nl.tau_rc * np.ones(size))
+    return _concatenate(cols)
+
+
+LIF_ROLES = (('j', 'J'), ('v', 'voltage'), ('w', 'refractory_time'),
+             ('s', 'output'))
+LIF_RATE_ROLES = (('j', 'J'), ('r', 'output'))
+
+
+def _concatenate(cols):
+    return dict((name, np.concatenate(arrs) if arrs else np.zeros(0))
+                for name, arrs in cols.items())
+
+
+class MegakernelPlan(Plan):
+    """A Plan whose kernel runs several steps per launch"""
+
+    n_steps = 1
+
+    def set_n_steps(self, n_steps):
+        self.kern.set_arg(0, np.int32(n_steps))
+        self.n_steps = n_steps
+
+
+def plan_megakernel(queue, data, islands, dt, lsize=256, probes=None,
+                    probe_islands=None, tag=None):
+    """Plan one kernel with a work-group per island.
+
+    `data` is the device signal buffer, and `islands` a list with, for
+    each island, its stages: dicts with (optional) keys 'gemv' (see
+    gemv_elements), 'lif' and 'lif_rate' (see neuron_elements).  If given,
+    `probes` is the plan of plan_probes, whose work is then done at the end
+    of each step, for probe n by the work-group of island probe_islands[n].
+    """
+    T = data.dtype
+    O = np.dtype('int64' if data.size > np.iinfo('int32').max else 'int32')
+    n_stages = max(len(stages) for stages in islands)
+    # -- island g's stage s is stages[g * n_stages + s]
+    stages = [island[ss] if ss < len(island) else {}
+              for island in islands for ss in range(n_stages)]
+    empty = {'gemv': gemv_elements([], {}, {}, None, {}),
+             'lif': neuron_elements([], LIF_ROLES, None, {}),
+             'lif_rate': neuron_elements([], LIF_RATE_ROLES, None, {})}
+
+    def concat(kind, name):
+        return np.concatenate(
+            [stage.get(kind, empty[kind])[name] for stage in stages])
+
+    def ptr(kind, name):
+        return np.cumsum([0] + [len(stage.get(kind, empty[kind])[name])
+                                for stage in stages])
+
+    def upload(arr, dtype):
+        # -- to_device can't upload empty arrays
+        arr = np.asarray(arr, dtype=dtype)
+        return to_device(queue, arr if len(arr) else np.zeros(1, dtype))
+
+    n_terms = concat('gemv', 'n_terms')
+    args = [
+        ('stage_gemv', upload(ptr('gemv', 'y'), 'int32')),
+        ('stage_lif', upload(ptr('lif', 'j'), 'int32')),
+        ('stage_lif_rate', upload(ptr('lif_rate', 'j'), 'int32')),
+        ('g_y', upload(concat('gemv', 'y'), O)),
+        ('g_y_in', upload(concat('gemv', 'y_in'), O)),
+        ('g_beta_at', upload(concat('gemv', 'beta_at'), O)),
+        ('g_beta', upload(concat('gemv', 'beta'), T)),
+        ('g_gamma', upload(concat('gemv', 'gamma'), T)),
+        ('g_terms', upload(np.cumsum([0] + list(n_terms)), 'int32')),
+        ('t_a', upload(concat('gemv', 'a'), O)),
+        ('t_a_step', upload(concat('gemv', 'a_step'), 'int32')),
+        ('t_x', upload(concat('gemv', 'x'), O)),
+        ('t_x_step', upload(concat('gemv', 'x_step'), 'int32')),
+        ('t_len', upload(concat('gemv', 'len'), 'int32')),
+        ]
+    for kind, roles in [('lif', LIF_ROLES), ('lif_rate', LIF_RATE_ROLES)]:
+        for name, attr in roles:
+            args.append(('%s_%s' % (kind, name),
+                         upload(concat(kind, name), O)))
+        args.append(('%s_ref' % kind, upload(concat(kind, 'ref'), T)))
+        args.append(('%s_tau' % kind, upload(concat(kind, 'tau'), T)))
+    n_probes = 0
+    if probes is not None:
+        X, Y = probes.X, probes.Y
+        n_probes = len(X)
+        if probe_islands is None:
+            probe_islands = [0] * n_probes
+        args += [
+            ('probe_ptr', upload(np.cumsum([0] + [
+                probe_islands.count(gg) for gg in range(len(islands))]),
+                'int32')),
+            ('p_order', upload(np.argsort(probe_islands, kind='mergesort'),
+                               'int32')),
+            ('countdowns', probes.cl_countdowns),
+            ('bufpositions', probes.cl_bufpositions),
+            ('periods', probes.cl_periods),
+            ('p_x', upload(X.starts, O)),
+            ('p_len', X.cl_shape0s),
+            ('p_y', Y.cl_starts),
+            ('p_data', Y.cl_buf),
+            ]
+    args.append(('data', data))
+
+    text = """
+        ////////// MAIN FUNCTION //////////
+        __kernel void fn(
+            const int n_steps,
+            ${arg_decls}
+        )
+        {
+            const int li = get_local_id(0);
+            const int g = get_group_id(0);
+            for (int step = 0; step < n_steps; ++step)
+            {
+                for (int s = g * ${n_stages}; s < (g + 1) * ${n_stages}; ++s)
+                {
+                    for (int e = stage_gemv[s] + li; e < stage_gemv[s + 1];
+                         e += ${lsize})
+                    {
+                        ${T} y_sum = 0;
+                        for (int t = g_terms[e]; t < g_terms[e + 1]; ++t)
+                        {
+                            const ${O} a = t_a[t];
+                            const ${O} x = t_x[t];
+                            const int a_step = t_a_step[t];
+                            const int x_step = t_x_step[t];
+                            for (int k = 0; k < t_len[t]; ++k)
+                                y_sum += data[a + k * a_step]
+                                         * data[x + k * x_step];
+                        }
+                        const ${T} beta = (g_beta_at[e] < 0)
+                            ? g_beta[e] : data[g_beta_at[e]];
+                        data[g_y[e]] = g_gamma[e] + beta * data[g_y_in[e]]
+                                       + y_sum;
+                    }
+
+                    for (int e = stage_lif[s] + li; e < stage_lif[s + 1];
+                         e += ${lsize})
+                    {
+                        const ${T} j = data[lif_j[e]];
+                        ${T} v = data[lif_v[e]];
+                        ${T} w = data[lif_w[e]];
+                        const ${T} ref = lif_ref[e];
+                        const ${T} tau = lif_tau[e];
+                        ${T} ov, ow, os;
+                        char spiked;
+                        ${T} dV, overshoot;
+${lif_text}
+                        data[lif_v[e]] = ov;
+                        data[lif_w[e]] = ow;
+                        data[lif_s[e]] = os;
+                    }
+
+                    for (int e = stage_lif_rate[s] + li;
+                         e < stage_lif_rate[s + 1]; e += ${lsize})
+                    {
+                        ${T} j = data[lif_rate_j[e]];
+                        const ${T} ref = lif_rate_ref[e];
+                        const ${T} tau = lif_rate_tau[e];
+                        ${T} r;
+${lif_rate_text}
+                        data[lif_rate_r[e]] = r;
+                    }
+                    barrier(CLK_GLOBAL_MEM_FENCE);
+                }
+
+% if n_probes:
+                // -- the probe plan (see clra_nonlinearities.plan_probes)
+                for (int q = probe_ptr[g]; q < probe_ptr[g + 1]; ++q)
+                {
+                    const int n = p_order[q];
+                    const int countdown = countdowns[n];
+                    const int bufpos = bufpositions[n];
+                    const int n_dims = p_len[n];
+                    if (countdown == 0)
+                    {
+                        for (int ii = li; ii < n_dims; ii += ${lsize})
+                            p_data[p_y[n] + bufpos * n_dims + ii]
+                                = data[p_x[n] + ii];
+                    }
+                    barrier(CLK_GLOBAL_MEM_FENCE);
+                    if (li == 0)
+                    {
+                        countdowns[n] = (countdown == 0)
+                            ? periods[n] - 1 : countdown - 1;
+                        if (countdown == 0)
+                            bufpositions[n] = bufpos + 1;
+                    }
+                }
+                barrier(CLK_GLOBAL_MEM_FENCE);
+% endif
+            }
+        }
+        """
+    # -- the arguments are const unless the kernel writes them
+    writable = ('countdowns', 'bufpositions', 'p_data', 'data')
+    arg_decls = ',\n            '.join(
+        '__global %s%s *%s' % ('' if name in writable else 'const ',
+                               arr.ocldtype, name)
+        for name, arr in args)
+    textconf = dict(arg_decls=arg_decls,
+                    T=data.ocldtype, O='long' if O == np.int64 else 'int',
+                    lsize=lsize, n_stages=n_stages, n_probes=n_probes,
+                    lif_text=lif_core_text(dt),
+                    lif_rate_text=lif_rate_core_text(dt))
+    text = Template(text, output_encoding='ascii').render(**textconf)
+
+    full_args = tuple(arr for name, arr in args)
+    _fn = build_program(queue.context, text).fn
+    _fn.set_args(np.int32(1), *[arr.data for arr in full_args])
+
+    itemsize = T.itemsize
+    n_macs = int(np.sum(concat('gemv', 'len')))
+    n_neurons = len(concat('lif', 'j')) + len(concat('lif_rate', 'j'))
+    rval = MegakernelPlan(queue, _fn, (len(islands) * lsize,), (lsize,),
+                          name="megakernel", tag=tag,
+                          flops_per_call=2 * n_macs,
+                          bw_per_call=itemsize * (2 * n_macs + 4 * n_neurons
+                                                  + 3 * len(n_terms)),
+                          )
+    rval.full_args = full_args     # prevent garbage-collection
+    return rval
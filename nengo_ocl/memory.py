@@ -0,0 +1,188 @@
+"""
+Device memory: what a sim_ocl.Simulator allocates, and what it will need.
+
+Bytes are broken down into these categories:
+
+    weights          read-only A matrices of gemv ops (and their copies)
+    neuron_state     signals of the neuron ops (J, voltage, ...)
+    filter_state     other signals written every step (filters, decoded
+                     values, time)
+    signals          other read-only signals (and all_data padding)
+    snapshot         the copy of all_data kept for reset()
+    probe_buffers    probe output buffers and their counters
+    gemv_tables      gemv index tables (gstructure, A_js, X_js, sparse
+                     indices)
+    ragged_metadata  starts, shapes and strides of the ragged arrays
+    other            anything else plans upload (LIF constants, stimulus
+                     tables, ...)
+
+`estimate_memory` works from the operator list alone, before anything is
+uploaded, and `check_fits` compares such an estimate with a device's
+CL_DEVICE_GLOBAL_MEM_SIZE and CL_DEVICE_MAX_MEM_ALLOC_SIZE.
+`device_memory` measures a built simulator (see Simulator.memory_report).
+"""
+import numpy as np
+
+from . import passes
+from . import sim_npy
+
+CATEGORIES = ('weights', 'neuron_state', 'filter_state', 'signals',
+              'snapshot', 'probe_buffers', 'gemv_tables', 'ragged_metadata',
+              'other')
+
+# -- int32 starts, shape0s, shape1s, stride0s, stride1s
+_META_NAMES = ('starts', 'shape0s', 'shape1s', 'stride0s', 'stride1s')
+_META_BYTES = 4 * len(_META_NAMES)
+
+
+def base_categories(operators):
+    """Return a dict mapping each signal base of `operators` to one of
+    'weights', 'neuron_state', 'filter_state' or 'signals'"""
+    written = passes.written_bases(operators)
+    neuron_roles = sim_npy.Simulator.contiguous_roles
+    rval = {}
+    for op in operators:
+        for role in neuron_roles.get(type(op).__name__, ()):
+            rval.setdefault(getattr(op, role).base, 'neuron_state')
+    for op in operators:
+        for A in getattr(op, 'As', ()):
+            if A.base not in written:
+                rval.setdefault(A.base, 'weights')
+    for op in operators:
+        for sig in op.all_signals:
+            rval.setdefault(
+                sig.base, 'filter_state' if sig.base in written else 'signals')
+    return rval
+
+
+def estimate_memory(operators, probes, dtype=np.float32, weights_dtype=None,
+                    n_prealloc_probes=1000):
+    """Estimate the device bytes of a sim_ocl.Simulator, by category.
+
+    `operators` is the converted operator list (sim.operators, i.e. after
+    MultiProdUpdate.convert_to and compress), `probes` the model's probes.
+    Signals, weights, the snapshot and the probe buffers are exact (up to
+    layout padding), except that with `weights_dtype` all the weights are
+    assumed to move out of all_data; gemv tables and ragged metadata are
+    rough.
+
+    Also returns 'total' and 'largest_buffer', the size of the largest
+    single allocation.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    rval = dict((cat, 0) for cat in CATEGORIES)
+    categories = base_categories(operators)
+    for base, cat in categories.items():
+        rval[cat] += base.size * itemsize
+    weight_copy_bytes = 0
+    if weights_dtype is not None:
+        # -- assuming all_data keeps none of the weights (see
+        #    sim_ocl.Simulator._weights_only_bases)
+        n_weights = sum(base.size for base, cat in categories.items()
+                        if cat == 'weights')
+        weight_copy_bytes = n_weights * np.dtype(weights_dtype).itemsize
+        rval['weights'] = weight_copy_bytes
+    all_data_bytes = sum(rval.values()) - weight_copy_bytes
+    rval['snapshot'] = all_data_bytes
+
+    probe_bytes = n_prealloc_probes * itemsize * sum(
+        p.sig.shape[0] for p in probes)
+    rval['probe_buffers'] = probe_bytes + 2 * 4 * len(probes)
+
+    # -- one gstructure row (4 ints per term, 5 per output) per gemv op,
+    #    plus its A_js and X_js entries
+    gemv_ops = [op for op in operators if hasattr(op, 'As')]
+    if gemv_ops:
+        max_terms = max(len(op.As) for op in gemv_ops)
+        n_terms = sum(len(op.As) for op in gemv_ops)
+        rval['gemv_tables'] = 4 * (len(gemv_ops) * (4 * max_terms + 5)
+                                   + 2 * n_terms)
+
+    # -- all_data's own views, then (about) two columns per signal for the
+    #    ragged arrays each plan makes out of all_data
+    n_signals = sum(len(op.all_signals) for op in operators)
+    rval['ragged_metadata'] = (_META_BYTES * (len(categories) + n_signals)
+                               + 2 * 4 * n_signals)
+
+    rval['total'] = sum(rval[cat] for cat in CATEGORIES)
+    rval['largest_buffer'] = max(all_data_bytes, weight_copy_bytes,
+                                 probe_bytes)
+    return rval
+
+
+def check_fits(estimate, device, largest_buffer=True):
+    """Raise MemoryError if `estimate` (see estimate_memory) does not fit
+    on cl.Device `device`.
+
+    The total must fit in the device's global memory, and (unless
+    `largest_buffer` is False, e.g. before all_data is sharded) the
+    largest buffer within its maximum allocation size.
+    """
+    problems = []
+    if estimate['total'] > device.global_mem_size:
+        problems.append('%.1f MB needed, but the device has %.1f MB' % (
+            estimate['total'] / 1e6, device.global_mem_size / 1e6))
+    if (largest_buffer
+            and estimate['largest_buffer'] > device.max_mem_alloc_size):
+        problems.append(
+            'a %.1f MB buffer is needed, but the device allocates at most'
+            ' %.1f MB' % (estimate['largest_buffer'] / 1e6,
+                          device.max_mem_alloc_size / 1e6))
+    if problems:
+        raise MemoryError('model does not fit on %s: %s (%s)' % (
+            device.name.strip(), '; '.join(problems),
+            ', '.join('%s %.1f MB' % (cat, estimate[cat] / 1e6)
+                      for cat in CATEGORIES if estimate[cat])))
+
+
+def device_memory(sim):
+    """Return the device bytes allocated by sim_ocl.Simulator `sim`, by
+    category, and their 'total'.
+
+    Every buffer is counted once, however many plans share it.
+    """
+    rval = dict((cat, 0) for cat in CATEGORIES)
+    seen = set()
+
+    def add(cat, arr):
+        if arr is None or arr.data.int_ptr in seen:
+            return
+        seen.add(arr.data.int_ptr)
+        rval[cat] += arr.data.size
+
+    # -- all_data (and its shards), split by what its bases hold
+    itemsize = sim.all_data.dtype.itemsize
+    categories = base_categories(sim.operators)
+    for base in sim.all_bases:
+        if (base not in sim.base_aliases
+                and base not in sim.weights_only_bases):
+            rval[categories.get(base, 'signals')] += base.size * itemsize
+    all_data_bufs = [sim.all_data.cl_buf] + list(sim.all_data.shard_bufs)
+    seen.update(buf.data.int_ptr for buf in all_data_bufs)
+    rval['signals'] += (sum(buf.data.size for buf in all_data_bufs)
+                        - sum(rval.values()))
+    add('snapshot', sim._initial_buf)
+    if sim.weight_data is not None:
+        add('weights', sim.weight_data.cl_buf)
+    for ra in [sim.all_data, sim.weight_data]:
+        for name in _META_NAMES:
+            if ra is not None:
+                add('ragged_metadata', ra.__dict__.get('_cl_' + name))
+
+    probe_plan = getattr(sim, '_cl_probe_plan', None)
+    if probe_plan is not None:
+        for arr in [probe_plan.Y.cl_buf, probe_plan.cl_countdowns,
+                    probe_plan.cl_bufpositions]:
+            add('probe_buffers', arr)
+
+    for plan in sim._plandict:
+        is_gemv = 'gemv' in getattr(plan, 'name', '')
+        for arr in getattr(plan, 'full_args', ()):
+            if is_gemv:
+                cat = 'gemv_tables' if arr.dtype.kind == 'i' else 'weights'
+            else:
+                cat = 'ragged_metadata' if arr.dtype.kind == 'i' else 'other'
+            add(cat, arr)
+
+    rval['total'] = sum(rval[cat] for cat in CATEGORIES)
+    return rval
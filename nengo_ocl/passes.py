@@ -0,0 +1,213 @@
+"""
+Build-time rewrites of the (MultiProdUpdate-converted) operator list.
+
+Each pass takes the list of operators and returns a new one, plus a report
+of what it did.  The Simulator runs them after MultiProdUpdate.compress,
+before any signal is allocated.
+"""
+import hashlib
+
+import numpy as np
+
+from nengo import builder as nb
+
+
+def signal_value(sig):
+    """Return the initial value of signal (or view) `sig` as an ndarray"""
+    base = np.asarray(sig.base.value)
+    if sig is sig.base:
+        return base
+    flat = np.ascontiguousarray(base).ravel()
+    return np.lib.stride_tricks.as_strided(
+        flat[sig.offset:],
+        shape=sig.shape,
+        strides=[flat.itemsize * st for st in sig.elemstrides])
+
+
+def written_bases(operators):
+    return set(sig.base for op in operators
+               for sig in op.sets + op.incs + op.updates)
+
+
+def low_rank_factor(A, tol):
+    """Return (U, V) with dot(U, V) == A up to `tol` * max|A|, or None if
+    A is not low-rank enough for the factors to be smaller than A.
+
+    The rank is the number of singular values above tol * the largest.
+    """
+    m, n = A.shape
+    if not np.any(A):
+        return None
+    U, s, V = np.linalg.svd(A, full_matrices=False)
+    rank = int(np.sum(s > tol * s[0]))
+    if rank * (m + n) >= m * n:
+        return None
+    U = U[:, :rank] * s[:rank]
+    V = V[:rank]
+    if np.max(np.abs(np.dot(U, V) - A)) > tol * np.max(np.abs(A)):
+        return None
+    return U, V
+
+
+def factor_low_rank(operators, tol=1e-6, min_size=1024):
+    """Rewrite read-only, low-rank A terms of MultiProdUpdates as two gemvs.
+
+    Each such `dot(A, X)` term (A at least `min_size` elements, X a vector)
+    becomes `dot(U, Z)`, where a new MultiProdUpdate sets the intermediate
+    signal Z to `dot(V, X)` and `dot(U, V) ~= A` (see low_rank_factor).
+    Per step this moves rank * (m + n) weights instead of m * n.
+
+    Returns the new operator list and a list of dicts (one per rewritten
+    term) with the term's shape and rank, and the number of weight
+    elements before and after.
+    """
+    from .sim_npy import MultiProdUpdate
+    written = written_bases(operators)
+    rval = []
+    report = []
+    for op in operators:
+        if not isinstance(op, MultiProdUpdate):
+            rval.append(op)
+            continue
+        for ii, (A, X) in enumerate(zip(op.As, op.Xs)):
+            if (A.ndim != 2 or A.size < min_size
+                    or X.ndim != 1 and not (X.ndim == 2 and X.shape[1] == 1)
+                    or A.base in written):
+                continue
+            factors = low_rank_factor(signal_value(A), tol)
+            if factors is None:
+                continue
+            U, V = factors
+            rank = U.shape[1]
+            name = '%s.lowrank%i' % (getattr(op, 'tag', ''), ii)
+            # -- Z is shaped like X, e.g. (rank, 1) for a column signal
+            Z = nb.Signal(np.zeros((rank,) + X.shape[1:]), name=name + '.Z')
+            z_op = MultiProdUpdate(Z, Z, beta=0, gamma=0,
+                                   tag=name, as_update=False)
+            z_op.add_AX(nb.Signal(V, name=name + '.V'), X)
+            rval.append(z_op)
+            op.As[ii] = nb.Signal(U, name=name + '.U')
+            op.Xs[ii] = Z
+            report.append({
+                'op': str(getattr(op, 'tag', '')),
+                'shape': A.shape,
+                'rank': rank,
+                'elements_before': A.size,
+                'elements_after': U.size + V.size,
+                })
+        rval.append(op)
+    return rval, report
+
+
+def dedupe_bases(bases, values, written):
+    """Merge read-only bases with identical contents.
+
+    `values` maps each base to its initial ndarray, and bases in `written`
+    are never merged.  Returns the bases to store (in order), a dict
+    mapping each merged base to the stored base with the same contents,
+    and a report dict with the number of merged bases and bytes saved.
+    """
+    first_by_key = {}
+    stored = []
+    aliases = {}
+    bytes_saved = 0
+    for bb in bases:
+        if bb not in written:
+            value = np.ascontiguousarray(values[bb])
+            key = (value.dtype.str, value.shape,
+                   hashlib.sha1(value.tostring()).digest())
+            first = first_by_key.setdefault(key, bb)
+            # -- compare, rather than trust the hash
+            if first is not bb and np.array_equal(values[first], value):
+                aliases[bb] = first
+                bytes_saved += value.nbytes
+                continue
+        stored.append(bb)
+    return stored, aliases, {'n_merged': len(aliases),
+                             'bytes_saved': bytes_saved}
+
+
+def layout_bases(bases, op_groups, written, roles=None):
+    """Order `bases` by how the op groups access them.
+
+    The bases are split into clusters that one kernel reads or writes
+    together: first, for each op group listed in `roles` (op type name ->
+    attribute names), one cluster per role, as in Simulator.order_bases;
+    then, for each MultiProdUpdate group, the Ys, the Xs and the As of its
+    ops; and for any other group, all the signals of its ops.  A base
+    belongs to the first cluster it appears in, and keeps its op order.
+
+    Read-only clusters come first, then clusters of bases in `written`.
+    Returns the ordered bases and the set of bases that start a cluster
+    (to be aligned in all_data).
+    """
+    roles = roles or {}
+    clusters = []
+    claimed = set()
+
+    def claim(sigs):
+        cluster = []
+        for sig in sigs:
+            if sig.base not in claimed:
+                claimed.add(sig.base)
+                cluster.append(sig.base)
+        clusters.append(cluster)
+
+    for op_type, ops in op_groups:
+        for role in roles.get(op_type.__name__, ()):
+            # -- views are left to the second pass, like order_bases does
+            claim(sig for sig in (getattr(op, role) for op in ops)
+                  if sig is sig.base)
+    for op_type, ops in op_groups:
+        if op_type.__name__ == 'MultiProdUpdate':
+            claim(op.Y for op in ops)
+            claim(X for op in ops for X in op.Xs)
+            claim(A for op in ops for A in op.As)
+        claim(sig for op in ops for sig in op.all_signals)
+    claim(bases)
+
+    read_only = [[bb for bb in cc if bb not in written] for cc in clusters]
+    read_write = [[bb for bb in cc if bb in written] for cc in clusters]
+    ordered = [cc for cc in read_only + read_write if cc]
+    return ([bb for cc in ordered for bb in cc],
+            set(cc[0] for cc in ordered))
+
+
+def _extent(sig, base_starts):
+    """Return (start, size) of `sig` in the buffer, or None if its
+    elements are not one unit-stride range"""
+    start = base_starts[sig.base]
+    if sig is sig.base:
+        return start, sig.size
+    shape = [n for n in sig.shape if n != 1]
+    strides = [st for n, st in zip(sig.shape, sig.elemstrides) if n != 1]
+    expected = [int(np.prod(shape[ii + 1:])) for ii in range(len(shape))]
+    if strides != expected:
+        return None
+    return start + sig.offset, sig.size
+
+
+def contiguous_gemv_items(op_groups, base_starts):
+    """Count the MultiProdUpdate ops whose operands are unit-stride ranges
+    of the buffer and whose Y directly follows the Y of the previous op
+    of its group (so that neighbouring work-items write neighbouring
+    elements).  `base_starts` maps each base to its offset.
+
+    Returns (number of ops, number of such ops).
+    """
+    n_items = 0
+    n_contiguous = 0
+    for op_type, ops in op_groups:
+        if op_type.__name__ != 'MultiProdUpdate':
+            continue
+        prev_end = None
+        for op in ops:
+            y = _extent(op.Y, base_starts)
+            ok = (y is not None
+                  and (prev_end is None or y[0] == prev_end)
+                  and all(_extent(sig, base_starts) is not None
+                          for sig in op.As + op.Xs))
+            prev_end = y[0] + y[1] if y is not None else None
+            n_items += 1
+            n_contiguous += ok
+    return n_items, n_contiguous
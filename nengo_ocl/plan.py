@@ -1,9 +1,73 @@
+import re
+import sys
 import time
+import threading
+import Queue
+import numpy as np
 import pyopencl as cl
 from collections import defaultdict
+from contextlib import contextmanager
 import networkx as nx
 PROFILING_ENABLE = cl.command_queue_properties.PROFILING_ENABLE
 
+# -- When this is a dict (source -> built cl.Program, all in one context),
+#    build_program reuses and adds to it (see cached_programs).
+program_cache = None
+
+# -- When this is a list, build_program appends one record per call
+#    (see sim_npy.BuildReport).
+compile_log = None
+
+# -- Directory for pyopencl's on-disk cache of compiled kernel binaries
+#    (None: pyopencl's default). Processes that share a cache_dir only
+#    compile each kernel once between them (see sweep.py).
+build_cache_dir = None
+
+
+def build_program(context, text):
+    """Return a built cl.Program for source `text` in `context`.
+
+    Inside a `cached_programs` block, programs are cached by source, so
+    planning the same kernel a second time (e.g. for a forked Simulator)
+    reuses the compiled program. Each attribute
+    access like `build_program(ctx, text).fn` still creates a new cl.Kernel,
+    so plans never share kernel arguments.
+    """
+    if re.search(r'\bdouble\b', text) and 'cl_khr_fp64' not in text:
+        text = '#pragma OPENCL EXTENSION cl_khr_fp64 : enable\n' + text
+    programs = {} if program_cache is None else program_cache
+    cached = text in programs
+    t0 = time.time()
+    if not cached:
+        programs[text] = cl.Program(context, text).build(
+            cache_dir=build_cache_dir)
+    if compile_log is not None:
+        names = re.findall(r'__kernel\s+void\s+(\w+)', text)
+        compile_log.append({
+            'name': ','.join(names),
+            'source_size': len(text),
+            'time': time.time() - t0,
+            'cached': cached,
+            })
+    return programs[text]
+
+
+@contextmanager
+def cached_programs(cache):
+    """Make build_program use `cache` (a dict, for programs of one context)
+    inside this block.
+
+    The cache lives as long as its owner (e.g. a Simulator and its forks),
+    rather than for the whole process.
+    """
+    global program_cache
+    old_cache = program_cache
+    program_cache = cache
+    try:
+        yield
+    finally:
+        program_cache = old_cache
+
 
 class BasePlan(object):
     def __init__(self, name="", tag="",
@@ -93,11 +157,123 @@ class Plan(BasePlan):
             self.name)
 
 
+class LookaheadPlan(Plan):
+    """Plan copying one row of a device ring buffer per call.
+
+    A worker thread calls `produce(step0, n)`, which must return an (n, D)
+    array of the values for steps step0 .. step0 + n - 1, one chunk of
+    `chunk` steps at a time and up to two chunks ahead of the device.
+    `ring` holds two chunks (2 * chunk rows of D).  When a call starts a
+    new chunk, its values are uploaded (asynchronously, on the in-order
+    queue) into the half of the ring that was consumed two chunks ago, and
+    the kernel argument `slot_arg` tells the kernel which row to copy.
+    The host only waits if the worker falls behind; the device never does.
+    """
+    def __init__(self, queue, kern, gsize, lsize, slot_arg, ring, produce,
+                 chunk, first_step=0, **kwargs):
+        super(LookaheadPlan, self).__init__(queue, kern, gsize, lsize,
+                                            **kwargs)
+        self.slot_arg = slot_arg
+        self.ring = ring
+        self.produce = produce
+        self.chunk = chunk
+        self._uploads = [None, None]
+        self._stop = None
+        self.restart(first_step)
+
+    def restart(self, first_step):
+        """Discard staged values and continue from step `first_step`."""
+        if self._stop is not None:
+            self._stop.set()
+        self.pos = 0
+        self._stop = threading.Event()
+        self._chunks = Queue.Queue(maxsize=2)
+        self._thread = threading.Thread(
+            target=self._produce_loop,
+            args=(first_step, self._chunks, self._stop))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _produce_loop(self, step0, chunks, stop):
+        while not stop.is_set():
+            try:
+                item = (np.ascontiguousarray(
+                    self.produce(step0, self.chunk), dtype=self.ring.dtype),
+                    None)
+            except Exception:
+                item = (None, sys.exc_info())
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+            if item[1] is not None:
+                return
+            step0 += self.chunk
+
+    def close(self):
+        """Stop the worker thread (restart starts a new one)."""
+        if self._stop is not None:
+            self._stop.set()
+            self._thread.join()
+
+    def enqueue(self, wait_for=None):
+        if self._stop.is_set():
+            raise RuntimeError('LookaheadPlan is closed')
+        half, row = divmod(self.pos, self.chunk)
+        half %= 2
+        if row == 0:
+            values, exc_info = self._chunks.get()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if self._uploads[half] is not None:
+                self._uploads[half][0].wait()
+            offset = half * values.nbytes
+            ev = cl.enqueue_copy(self.queue, self.ring.data, values,
+                                 device_offset=offset, is_blocking=False)
+            # -- keep `values` alive until the copy is done
+            self._uploads[half] = (ev, values)
+        self.kern.set_arg(self.slot_arg,
+                          np.int32(half * self.chunk + row))
+        self.pos += 1
+        return super(LookaheadPlan, self).enqueue(wait_for=wait_for)
+
+
+class StimulusTablePlan(Plan):
+    """Plan copying one row of a device table per call.
+
+    The table holds the values of steps `table_range` = (first, stop);
+    the host counts the steps (`pos`) and tells the kernel which row to
+    copy through kernel argument `row_arg`, so the row never depends on
+    the order of the plans within a step.
+    """
+    def __init__(self, queue, kern, gsize, lsize, row_arg, table, n_rows,
+                 **kwargs):
+        super(StimulusTablePlan, self).__init__(queue, kern, gsize, lsize,
+                                                **kwargs)
+        self.row_arg = row_arg
+        self.cl_table = table
+        self.n_rows = n_rows
+        self.table_range = None
+        self.pos = 0
+
+    def enqueue(self, wait_for=None):
+        if self.table_range is None or not (
+                self.table_range[0] <= self.pos < self.table_range[1]):
+            raise IndexError('stimulus table has no row for step', self.pos,
+                             self.table_range)
+        self.kern.set_arg(self.row_arg,
+                          np.int32(self.pos - self.table_range[0]))
+        self.pos += 1
+        return super(StimulusTablePlan, self).enqueue(wait_for=wait_for)
+
+
 class Marker(Plan):
     def __init__(self, queue):
-        dummy = cl.Program(queue.context, """
+        dummy = build_program(queue.context, """
         __kernel void dummy() {}
-        """).build().dummy
+        """).dummy
         Plan.__init__(self, queue, dummy, (1,), None)
 
 
@@ -118,7 +294,15 @@ class DAG(object):
             for other in waits_on:
                 self.clients[other].append(plan)
                 self.dg.add_edge(other, plan)
-        self.order = nx.topological_sort(self.dg)
+        # -- keep the plandict's own order if it is already topological
+        seen = set()
+        for plan, waits_on in plandict.items():
+            if not seen.issuperset(waits_on):
+                self.order = nx.topological_sort(self.dg)
+                break
+            seen.add(plan)
+        else:
+            self.order = list(plandict)
         #for plan in self.order:
             #print 'order', plan
 
@@ -133,9 +317,29 @@ class DAG(object):
                 for p in self.order:
                     p.update_from_enqueued_events(self.profiling)
         else:
-            for ii in range(n):
-                for p in self.order:
-                    p(self.profiling)
+            self._call_n_times_hybrid(n)
+
+    def _call_n_times_hybrid(self, n):
+        """Enqueue OCL plans asynchronously, and call host plans in order.
+
+        Host plans (e.g. PythonPlans) must do their transfers on the OCL
+        plans' in-order queue.  Each host plan's first blocking transfer
+        then waits for every kernel enqueued before it, not only for the
+        ones it depends on, so host plans fully synchronize the queue.
+        Between host plans, the host doesn't wait for the device.
+        """
+        last_ev = None
+        for ii in range(n):
+            for plan in self.order:
+                if hasattr(plan, 'enqueue'):
+                    last_ev = plan.enqueue()
+                else:
+                    plan(self.profiling)
+        if last_ev is not None:
+            last_ev.wait()
+        for p in self.order:
+            if hasattr(p, 'update_from_enqueued_events'):
+                p.update_from_enqueued_events(self.profiling)
 
     def enqueue_n_times(self, n):
         if self.overlap:
@@ -186,3 +390,115 @@ class DAG(object):
 
 
 
+
+
+class ThreadedDAG(object):
+    """Run host-side plans on a pool of threads, respecting dependencies.
+
+    `plandict` maps each plan (any callable taking `profiling`) to the plans
+    it must follow, like the `plandict` of DAG.  Every step runs every plan
+    exactly once; a plan starts as soon as all the plans it waits on are
+    done, so the results are the same as a sequential run in any
+    topological order.  numpy releases the GIL in e.g. np.dot, so
+    independent plans can overlap on multicore CPUs.
+
+    `busy_times[i]` accumulates the seconds thread `i` spent running plans,
+    and `wall_time` the seconds spent in `__call__` (see `utilization`).
+    """
+    def __init__(self, plandict, n_threads, profiling=False):
+        self.profiling = profiling
+        self.plans = list(plandict)
+        index = dict((p, ii) for ii, p in enumerate(self.plans))
+        self.n_waits = [len(set(plandict[p])) for p in self.plans]
+        self.clients = [[] for p in self.plans]
+        for p in self.plans:
+            for other in set(plandict[p]):
+                self.clients[index[other]].append(index[p])
+        self.roots = [ii for ii, n in enumerate(self.n_waits) if n == 0]
+
+        self.busy_times = [0.0] * n_threads
+        self.wall_time = 0.0
+        self._error = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._tasks = Queue.Queue()
+        self._threads = []
+        for ii in range(n_threads):
+            thread = threading.Thread(target=self._work, args=(ii,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self, thread_idx):
+        while True:
+            ii = self._tasks.get()
+            if ii is None:
+                return
+            error = None
+            # -- after a failure, the tasks already queued are dropped
+            if self._error is None:
+                t0 = time.time()
+                try:
+                    self.plans[ii](self.profiling)
+                except:
+                    error = sys.exc_info()
+                self.busy_times[thread_idx] += time.time() - t0
+            ready = []
+            with self._lock:
+                self._n_pending -= 1
+                if error is not None and self._error is None:
+                    self._error = error
+                if self._error is None:
+                    self._n_finished += 1
+                    for client in self.clients[ii]:
+                        self._n_waiting[client] -= 1
+                        if self._n_waiting[client] == 0:
+                            ready.append(client)
+                    self._n_pending += len(ready)
+                    if self._n_finished == len(self.plans):
+                        self._done.set()
+                elif self._n_pending == 0:
+                    # -- no clients are started after a failure, and the
+                    #    error is raised once nothing is queued or running
+                    self._done.set()
+            for client in ready:
+                self._tasks.put(client)
+
+    def __call__(self):
+        return self.call_n_times(1)
+
+    def call_n_times(self, n):
+        if self._error is not None:
+            raise RuntimeError('a plan failed in an earlier call')
+        t0 = time.time()
+        try:
+            for step in xrange(n):
+                self._n_finished = 0
+                self._n_waiting = list(self.n_waits)
+                self._done.clear()
+                if not self.plans:
+                    continue
+                # -- tasks queued or running
+                self._n_pending = len(self.roots)
+                for ii in self.roots:
+                    self._tasks.put(ii)
+                # -- a timeout keeps the main thread interruptible
+                while not self._done.wait(0.1):
+                    pass
+                if self._error is not None:
+                    raise self._error[0], self._error[1], self._error[2]
+        finally:
+            self.wall_time += time.time() - t0
+
+    def utilization(self):
+        """Fraction of the wall time in __call__ that each thread was busy"""
+        if self.wall_time == 0:
+            return [0.0] * len(self.busy_times)
+        return [busy / self.wall_time for busy in self.busy_times]
+
+    def close(self):
+        for thread in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
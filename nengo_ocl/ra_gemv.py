@@ -132,3 +132,86 @@ def ragged_gather_gemv(alpha, A, A_js, X, X_js,
                     print 'Gemv writing', tag, y_i
             Y[i] = y_i
 
+
+
+def sparse_ragged_gather_gemv(alpha, A, A_js, X, X_js,
+                              beta, Y, Y_in=None,
+                              gamma=None
+                             ):
+    """
+    Return a function computing the same thing as ragged_gather_gemv:
+
+        Y <- gamma + Y_in * beta + \sum_j dot(A[A_js[j]], X[X_js[j]])
+
+    A, X, Y, and Y_in must be views of one buffer (e.g. Simulator.all_data).
+    Every term A[m, k] * X[k, n] of the whole group is precomputed as a
+    pair of buffer indices plus an output position, so each call is a few
+    vectorized gathers, one bincount, and one scatter, with no Python loop
+    over the items.  This trades memory (three indices per term) for speed.
+
+    beta and gamma must be constants (scalars or one per item of Y).
+    """
+    buf = Y.buf
+    assert A.buf is buf and X.buf is buf
+    if Y_in is None:
+        Y_in = Y
+    assert Y_in.buf is buf
+
+    n_items = len(Y)
+    def per_item(val, default):
+        if val is None:
+            val = default
+        return np.asarray(val, dtype='float64') * np.ones(n_items)
+    alpha = per_item(alpha, 1.0)
+    beta = per_item(beta, 1.0)
+    gamma = per_item(gamma, 0.0)
+
+    # -- output positions: Y[i] is rows [y_offsets[i], y_offsets[i] + M*N)
+    y_sizes = Y.shape0s.astype('int64') * Y.shape1s
+    y_offsets = np.cumsum(y_sizes) - y_sizes
+    y_idx = Y.buf_indices()
+    y_in_idx = Y_in.buf_indices()
+    assert len(y_in_idx) == len(y_idx)
+    y_alpha = np.repeat(alpha, y_sizes)
+    y_beta = np.repeat(beta, y_sizes)
+    y_gamma = np.repeat(gamma, y_sizes)
+
+    # -- one entry per (item, dot product) pair
+    a_js = A_js.buf[A_js.buf_indices()].astype('int64')
+    x_js = X_js.buf[X_js.buf_indices()].astype('int64')
+    assert len(a_js) == len(x_js)
+    pair_owner = np.repeat(np.arange(n_items),
+                           A_js.shape0s.astype('int64') * A_js.shape1s)
+    Ms = A.shape0s[a_js].astype('int64')
+    Ks = A.shape1s[a_js].astype('int64')
+    Ns = X.shape1s[x_js].astype('int64')
+    assert np.all(X.shape0s[x_js] == Ks)
+    assert np.all(Y.shape0s[pair_owner] == Ms)
+    assert np.all(Y.shape1s[pair_owner] == Ns)
+
+    # -- one entry per term A[m, k] * X[k, n]
+    sizes = Ms * Ks * Ns
+    owner = np.repeat(np.arange(len(a_js)), sizes)
+    pos = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    N = Ns[owner]
+    K = Ks[owner]
+    mm = pos // (K * N)
+    kk = (pos // N) % K
+    nn = pos % N
+    a_j = a_js[owner]
+    x_j = x_js[owner]
+    a_idx = A.starts[a_j] + mm * A.stride0s[a_j] + kk * A.stride1s[a_j]
+    x_idx = X.starts[x_j] + kk * X.stride0s[x_j] + nn * X.stride1s[x_j]
+    out_pos = y_offsets[pair_owner][owner] + mm * N + nn
+    n_out = len(y_idx)
+    del owner, pos, N, K, mm, kk, nn, a_j, x_j
+
+    def gemv():
+        buf = Y.buf
+        y = y_gamma + y_beta * buf[y_in_idx]
+        if len(out_pos):
+            y += y_alpha * np.bincount(out_pos,
+                                       weights=buf[a_idx] * buf[x_idx],
+                                       minlength=n_out)
+        buf[y_idx] = y
+    return gemv
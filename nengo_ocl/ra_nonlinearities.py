@@ -7,9 +7,21 @@ def lif_step(dt, J, voltage, refractory_time, spiked, tau_ref, tau_rc,
     Replicates nengo.nonlinear.LIF's step_math0 function, except for
     a) not requiring a LIF instance and
     b) not adding the bias
+
+    tau_ref and tau_rc may be scalars or arrays that broadcast against J
+    (e.g. one value per neuron), so many populations can be stepped at once.
+
+    With upsample > 1, the step is `upsample` substeps of dt / upsample,
+    and a neuron has spiked if it spiked in any of them (like plan_lif).
     """
     if upsample != 1:
-        raise NotImplementedError()
+        any_spike = np.zeros(np.shape(spiked), dtype=bool)
+        for ii in range(upsample):
+            lif_step(dt / upsample, J, voltage, refractory_time, spiked,
+                     tau_ref, tau_rc, upsample=1)
+            any_spike |= spiked > 0.5
+        spiked[...] = any_spike
+        return
 
     # Euler's method
     dV = dt / tau_rc * (J - voltage)
@@ -25,26 +37,29 @@ def lif_step(dt, J, voltage, refractory_time, spiked, tau_ref, tau_rc,
 
     # determine which neurons spike
     # if v > 1 set spiked = 1, else 0
-    spiked[...] = (v > 1) * 1.0
-
-    old = np.seterr(all='ignore')
-    try:
+    spiking = v > 1
+    spiked[...] = spiking
 
-        # linearly approximate time since neuron crossed spike threshold
-        overshoot = (v - 1) / dV
-        spiketime = dt * (1.0 - overshoot)
+    # linearly approximate time since neuron crossed spike threshold
+    # (only used where spiking, where dV > 0, so other elements divide by 1)
+    overshoot = (v - 1) / np.where(spiking, dV, 1.0)
+    spiketime = dt * (1.0 - overshoot)
 
-        # adjust refractory time (neurons that spike get a new
-        # refractory time set, all others get it reduced by dt)
-        new_refractory_time = spiked * (spiketime + tau_ref) \
-                              + (1 - spiked) * (refractory_time - dt)
-    finally:
-        np.seterr(**old)
+    # adjust refractory time (neurons that spike get a new
+    # refractory time set, all others get it reduced by dt)
+    refractory_time[...] = np.where(
+        spiking, spiketime + tau_ref, refractory_time - dt)
 
-    # return an ordered dictionary of internal variables to update
-    # (including setting a neuron that spikes to a voltage of 0)
-
-    voltage[:] = v * (1 - spiked)
-    refractory_time[:] = new_refractory_time
+    # set a neuron that spikes to a voltage of 0
+    voltage[...] = np.where(spiking, 0, v)
 
 
+def lif_rate(dt, J, tau_ref, tau_rc):
+    """
+    Replicates nengo.nonlinear.LIFRate's math function, except for
+    not requiring a LIF instance (tau_ref and tau_rc may be arrays)
+    """
+    j = np.maximum(J - 1, 0.)
+    active = j > 0
+    r = dt / (tau_ref + tau_rc * np.log1p(1. / np.where(active, j, 1.)))
+    return np.where(active, r, 0.)
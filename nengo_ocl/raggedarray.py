@@ -38,44 +38,71 @@ class RaggedArray(object):
     def dtype(self):
         return self.buf.dtype
 
-    def __init__(self, listofarrays, names=None):
-        starts = []
-        shape0s = []
-        shape1s = []
-        stride0s = []
-        stride1s = []
-        buf = []
-
-        for l in listofarrays:
-            obj = np.asarray(l)
-            starts.append(len(buf))
-            shape0s.append(shape0(obj))
-            shape1s.append(shape1(obj))
+    def __init__(self, listofarrays, names=None, dtype=None, align=None,
+                 offset_dtype='int32'):
+        """
+        If `align` is given, it is a sequence with one alignment (in
+        elements) per array: the start of each array is rounded up to a
+        multiple of it, and the gaps in `buf` are filled with zeros.
+
+        `starts` are stored as `offset_dtype`: int32, or int64 for buffers
+        of 2**31 elements or more.
+        """
+        arrays = [np.asarray(l) for l in listofarrays]
+        n = len(arrays)
+        shape0s = np.ones(n, dtype='int32')
+        shape1s = np.ones(n, dtype='int32')
+        stride0s = np.ones(n, dtype='int32')
+        stride1s = np.ones(n, dtype='int32')
+        for ii, obj in enumerate(arrays):
             if obj.ndim == 0:
-                stride0s.append(1)
-                stride1s.append(1)
+                pass
             elif obj.ndim == 1:
-                stride0s.append(1)
-                stride1s.append(1)
+                shape0s[ii] = obj.shape[0]
             elif obj.ndim == 2:
-                stride0s.append(obj.shape[1])
-                stride1s.append(1)
+                shape0s[ii], shape1s[ii] = obj.shape
+                stride0s[ii] = obj.shape[1]
             else:
                 raise NotImplementedError()
-            buf.extend(obj.ravel())
+
+        # -- compute all offsets up front, then fill one preallocated
+        #    buffer with slice copies (no intermediate Python list)
+        sizes = np.asarray([obj.size for obj in arrays], dtype=np.int64)
+        if align is None:
+            ends = np.cumsum(sizes)
+        else:
+            assert len(align) == n
+            ends = np.empty(n, dtype=np.int64)
+            pos = 0
+            for ii, (size, al) in enumerate(zip(sizes, align)):
+                pos = -(-pos // al) * al + size
+                ends[ii] = pos
+        if n and ends[-1] > np.iinfo(offset_dtype).max:
+            raise NotImplementedError(
+                'buffer too large for %s offsets' % offset_dtype)
+        starts = (ends - sizes).astype(offset_dtype)
+        if dtype is None:
+            # -- empty arrays (e.g. an empty list of A_js) default to
+            #    float64 and should not affect the promotion.
+            dtypes = set(obj.dtype for obj in arrays if obj.size)
+            dtype = reduce(np.promote_types, dtypes) if dtypes else np.float64
+        empty = np.empty if align is None else np.zeros
+        buf = empty(int(ends[-1]) if n else 0, dtype=dtype)
+        for obj, start, end in zip(arrays, starts, ends):
+            buf[start:end] = obj.ravel()
 
         self.starts = starts
         self.shape0s = shape0s
         self.shape1s = shape1s
         self.stride0s = stride0s
         self.stride1s = stride1s
-        self.buf = np.asarray(buf)
+        self.buf = buf
         if names is None:
             self.names = [''] * len(self)
         else:
             assert len(names) == len(stride0s)
             self.names = names
-        assert 0 not in shape1s
+        assert np.all(shape1s)
 
     def __str__(self):
         sio = StringIO.StringIO()
@@ -102,13 +129,15 @@ class RaggedArray(object):
         #assert start + length <= len(self.buf)
         # -- creates copies, same semantics
         #    as OCL version
-        assert 0 not in shape0s
-        assert 0 not in shape1s
-        self.starts = self.starts + starts
-        self.shape0s = self.shape0s + shape0s
-        self.shape1s = self.shape1s + shape1s
-        self.stride0s = self.stride0s + stride0s
-        self.stride1s = self.stride1s + stride1s
+        assert np.all(shape0s)
+        assert np.all(shape1s)
+        def cat(a, b):
+            return np.concatenate([a, np.asarray(b, dtype=a.dtype)])
+        self.starts = cat(self.starts, starts)
+        self.shape0s = cat(self.shape0s, shape0s)
+        self.shape1s = cat(self.shape1s, shape1s)
+        self.stride0s = cat(self.stride0s, stride0s)
+        self.stride1s = cat(self.stride1s, stride1s)
         if names:
             self.names = self.names + names
         else:
@@ -117,24 +146,46 @@ class RaggedArray(object):
     def __len__(self):
         return len(self.starts)
 
+    def buf_indices(self, items=None):
+        """Return the `buf` index of every element of `items`.
+
+        Elements are listed item by item, each in C (row-major) order, so
+        `self.buf[self.buf_indices(items)]` is the concatenation of
+        `self[ii].ravel()` for `ii` in `items` (default: all items).
+        """
+        if items is None:
+            items = np.arange(len(self))
+        else:
+            items = np.asarray(items, dtype='int64')
+        shape1s = self.shape1s[items].astype('int64')
+        sizes = self.shape0s[items] * shape1s
+        owner = np.repeat(np.arange(len(items)), sizes)
+        offsets = np.cumsum(sizes) - sizes
+        pos = np.arange(sizes.sum()) - np.repeat(offsets, sizes)
+        n1 = shape1s[owner]
+        return (self.starts[items][owner]
+                + (pos // n1) * self.stride0s[items][owner]
+                + (pos % n1) * self.stride1s[items][owner])
+
     def __getitem__(self, item):
         if isinstance(item, (list, tuple)):
             rval = self.__class__.__new__(self.__class__)
-            rval.starts = [self.starts[i] for i in item]
-            rval.shape0s = [self.shape0s[i] for i in item]
-            rval.shape1s = [self.shape1s[i] for i in item]
-            rval.stride0s = [self.stride0s[i] for i in item]
-            rval.stride1s = [self.stride1s[i] for i in item]
+            items = np.asarray(item, dtype='int64')
+            rval.starts = self.starts[items]
+            rval.shape0s = self.shape0s[items]
+            rval.shape1s = self.shape1s[items]
+            rval.stride0s = self.stride0s[items]
+            rval.stride1s = self.stride1s[items]
             rval.buf = self.buf
             rval.names = [self.names[i] for i in item]
             return rval
         else:
             itemsize = self.dtype.itemsize
-            byteoffset = itemsize * self.starts[item]
+            byteoffset = itemsize * int(self.starts[item])
             bytestrides = (
-                itemsize * self.stride0s[item],
-                itemsize * self.stride1s[item])
-            shape = self.shape0s[item], self.shape1s[item]
+                itemsize * int(self.stride0s[item]),
+                itemsize * int(self.stride1s[item]))
+            shape = int(self.shape0s[item]), int(self.shape1s[item])
             if shape[0] == 0:
                 # -- The list of A_js for example can be
                 #    an empty list.
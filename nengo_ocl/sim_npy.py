@@ -2,8 +2,12 @@
 numpy Simulator in the style of the OpenCL one, to get design right.
 """
 
+import copy
 import time
+import resource
+import sys
 from collections import defaultdict
+from contextlib import contextmanager
 import itertools
 import logging
 import networkx as nx
@@ -22,10 +26,13 @@ import nengo
 from nengo import builder as nb
 from nengo.nonlinearities import LIF, LIFRate, Direct
 
-from .ra_gemv import ragged_gather_gemv
+from .ra_gemv import ragged_gather_gemv, sparse_ragged_gather_gemv
+from . import passes
+from .ra_nonlinearities import lif_step, lif_rate
 from .raggedarray import RaggedArray as _RaggedArray
 
-from .plan import PythonPlan
+from . import plan as plan_module
+from .plan import PythonPlan, ThreadedDAG
 
 
 class MultiProdUpdate(nb.Operator):
@@ -212,6 +219,79 @@ class Timer(object):
                         _TimerCalls[self.msg])
 
 
+def maxrss_mb():
+    """Peak resident set size of this process so far, in MB"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 2. ** 20   # -- bytes
+    return rss / 2. ** 10       # -- kilobytes
+
+
+class BuildReport(object):
+    """Wall time and peak memory of each phase of a Simulator build.
+
+    A disabled report records nothing, so the Simulator can wrap its
+    phases unconditionally.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = OrderedDict()
+        self.op_types = OrderedDict()
+        self.kernels = []
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        rss0 = maxrss_mb()
+        t0 = time.time()
+        yield
+        t1 = time.time()
+        rss1 = maxrss_mb()
+        self.phases[name] = {
+            'time': t1 - t0,
+            'maxrss_mb': rss1,
+            'maxrss_increase_mb': rss1 - rss0,
+            }
+
+    @contextmanager
+    def op_type(self, name, n_ops):
+        if not self.enabled:
+            yield
+            return
+        t0 = time.time()
+        yield
+        entry = self.op_types.setdefault(name, {'time': 0.0, 'n_ops': 0})
+        entry['time'] += time.time() - t0
+        entry['n_ops'] += n_ops
+
+    @contextmanager
+    def kernels_compiled(self):
+        """Record plan.build_program calls made inside this block"""
+        if not self.enabled:
+            yield
+            return
+        old_log = plan_module.compile_log
+        plan_module.compile_log = self.kernels
+        try:
+            yield
+        finally:
+            plan_module.compile_log = old_log
+
+    def as_dict(self):
+        compiled = [k for k in self.kernels if not k['cached']]
+        return {
+            'phases': self.phases,
+            'total_time': sum(p['time'] for p in self.phases.values()),
+            'maxrss_mb': maxrss_mb(),
+            'op_types': self.op_types,
+            'kernels': self.kernels,
+            'n_kernels_compiled': len(compiled),
+            'compile_time': sum(k['time'] for k in compiled),
+            }
+
+
 def exact_dependency_graph(operators, share_memory):
     dg = nx.DiGraph()
 
@@ -300,14 +380,15 @@ def exact_dependency_graph(operators, share_memory):
     return dg
 
 
-def greedy_planner(operators, share_memory, cliques):
+def greedy_planner(operators, share_memory, cliques, dg=None):
     """
     I feel like there might e a dynamic programming solution here, but I can't
     work it out, and I'm not sure. Even if a DP solution existed, we would
     need a function to estimate the goodness (e.g. neg wall time) of kernel
     calls, and  that function would need to be pretty fast.
     """
-    dg = exact_dependency_graph(operators, share_memory)
+    if dg is None:
+        dg = exact_dependency_graph(operators, share_memory)
     #depth = {}
     #ops_by_depth = defaultdict(list)
 
@@ -371,14 +452,55 @@ def greedy_planner(operators, share_memory, cliques):
     return rval
 
 
-def sequential_planner(operators, share_memory):
+def op_group_dependencies(op_groups, extra_reads=None):
+    """
+    Return, for each op group, the sorted indices of earlier groups that
+    must run before it.
+
+    This is conservative: group `j` precedes group `i` (j < i) whenever
+    they touch a common base and at least one of them writes it, so running
+    the groups in any order consistent with these dependencies gives the
+    same results, bit for bit, as running them in list order.
+    `extra_reads(op)` can list signals that an op's plan reads in addition
+    to `op.reads`.
+    """
+    deps = []
+    last_writer = {}
+    # -- groups reading a base since its last write
+    readers = defaultdict(list)
+    for ii, (op_type, ops) in enumerate(op_groups):
+        reads = set()
+        writes = set()
+        for op in ops:
+            reads.update(sig.base for sig in op.reads)
+            if extra_reads is not None:
+                reads.update(sig.base for sig in extra_reads(op))
+            writes.update(sig.base for sig in op.sets + op.incs + op.updates)
+        deps_ii = set()
+        for base in reads | writes:
+            if base in last_writer:
+                deps_ii.add(last_writer[base])
+        for base in writes:
+            deps_ii.update(readers[base])
+        for base in reads:
+            readers[base].append(ii)
+        for base in writes:
+            last_writer[base] = ii
+            readers[base] = []
+        deps_ii.discard(ii)
+        deps.append(sorted(deps_ii))
+    return deps
+
+
+def sequential_planner(operators, share_memory, cliques=None, dg=None):
     """
     I feel like there might e a dynamic programming solution here, but I can't
     work it out, and I'm not sure. Even if a DP solution existed, we would
     need a function to estimate the goodness (e.g. neg wall time) of kernel
     calls, and  that function would need to be pretty fast.
     """
-    dg = exact_dependency_graph(operators, share_memory)
+    if dg is None:
+        dg = exact_dependency_graph(operators, share_memory)
 
     # list of pairs: (type, [ops_of_type], set_of_ancestors, set_of_descendants)
     topo_order = [op
@@ -423,6 +545,23 @@ class SignalDict(dict):
             raise KeyError(obj)
 
 
+def per_element(values, sizes):
+    """One value per element for groups of `sizes` elements (or a scalar)"""
+    if len(set(values)) == 1:
+        return values[0]
+    return np.repeat(values, sizes)
+
+
+def lif_upsample(ops):
+    """The `upsample` of the LIF nonlinearities of SimLIF `ops`, which
+    must all have the same one"""
+    upsamples = set(op.nl.upsample for op in ops)
+    if len(upsamples) != 1:
+        raise NotImplementedError('SimLIF ops with different upsample',
+                                  sorted(upsamples))
+    return upsamples.pop()
+
+
 def isview(obj):
     return obj.base is not None and obj.base is not obj
 
@@ -457,20 +596,25 @@ def stable_unique(seq):
 
 
 class ViewBuilder(object):
-    def __init__(self, bases, rarray):
+    """Accumulate views of `bases` for appending to `rarray`.
+
+    View metadata is written into a growable int64 table (doubling its
+    capacity when full) and committed to `rarray` with one `add_views`.
+    `aliases` maps extra bases to one of `bases` whose storage they share.
+    """
+    def __init__(self, bases, rarray, aliases=None):
         self.bases = bases
         self.sidx = dict((bb, ii) for ii, bb in enumerate(bases))
         assert len(self.bases) == len(self.sidx)
+        for alias, bb in (aliases or {}).items():
+            self.sidx[alias] = self.sidx[bb]
+        self.base_set = set(self.sidx)
         self.rarray = rarray
 
-        self.starts = []
-        self.shape0s = []
-        self.shape1s = []
-        self.stride0s = []
-        self.stride1s = []
+        # -- columns: start, shape0, shape1, stride0, stride1
+        self.meta = np.zeros((max(len(bases), 16), 5), dtype='int64')
+        self.n_views = 0
         self.names = []
-        #self.orig_len = len(self.all_signals)
-        #self.base_starts = self.all_data_A.starts
 
     def append_view(self, obj):
         assert obj.size
@@ -481,7 +625,7 @@ class ViewBuilder(object):
             return
             #raise KeyError('sidx already contains object', obj)
 
-        if obj in self.bases:
+        if obj in self.base_set:
             # -- it is not a view, but OK
             return
 
@@ -489,35 +633,36 @@ class ViewBuilder(object):
             # -- it is not a view, and not OK
             raise ValueError('can only append views of known signals', obj)
 
-        idx = self.sidx[obj.base]
-        self.starts.append(self.rarray.starts[idx] + obj.offset)
-        self.shape0s.append(shape0(obj))
-        self.shape1s.append(shape1(obj))
         if obj.ndim == 0:
-            self.stride0s.append(1)
-            self.stride1s.append(1)
+            stride0, stride1 = 1, 1
         elif obj.ndim == 1:
-            self.stride0s.append(obj.elemstrides[0])
-            self.stride1s.append(1)
+            stride0, stride1 = obj.elemstrides[0], 1
         elif obj.ndim == 2:
-            self.stride0s.append(obj.elemstrides[0])
-            self.stride1s.append(obj.elemstrides[1])
+            stride0, stride1 = obj.elemstrides
         else:
             raise NotImplementedError()
+
+        if self.n_views == len(self.meta):
+            self.meta = np.concatenate([self.meta, np.zeros_like(self.meta)])
+        idx = self.sidx[obj.base]
+        self.meta[self.n_views] = (
+            self.rarray.starts[idx] + obj.offset,
+            shape0(obj), shape1(obj), stride0, stride1)
+        self.n_views += 1
         self.names.append(getattr(obj, 'name', ''))
-        self.sidx[obj] = len(self.sidx)
+        self.sidx[obj] = len(self.bases) + self.n_views - 1
 
     def add_views_to(self, rarray):
+        meta = self.meta[:self.n_views]
         rarray.add_views(
-            starts=self.starts,
-            shape0s=self.shape0s,
-            shape1s=self.shape1s,
-            stride0s=self.stride0s,
-            stride1s=self.stride1s,
+            starts=meta[:, 0],
+            shape0s=meta[:, 1],
+            shape1s=meta[:, 2],
+            stride0s=meta[:, 3],
+            stride1s=meta[:, 4],
             names=self.names)
 
 
-
 def signals_from_operators(operators):
     def all_with_dups():
         for op in operators:
@@ -530,9 +675,72 @@ class Simulator(object):
 
     profiling = False
 
+    # -- dtype of the host signal buffer (None: promote the signal dtypes)
+    all_data_dtype = None
+
+    # -- op type name -> signals (by attribute) that order_bases lays out
+    #    contiguously, role by role, across all the ops of a group
+    contiguous_roles = {
+        'SimLIF': ('J', 'voltage', 'refractory_time', 'output'),
+        'SimLIFRate': ('J', 'output'),
+    }
+
+    # -- ThreadedDAG running the plans, if n_threads was given
+    _executor = None
+    closed = False
+
+    # -- if not None, read-only MultiProdUpdate A matrices with at least
+    #    sparse_min_size elements and at most this fraction of nonzeros are
+    #    taken out of _AX_views into _sparse_AX (see plan_sparse_AX)
+    sparse_density = None
+    sparse_min_size = 256
+
+    # -- with optimize_layout, each cluster of bases starts at a multiple
+    #    of this many elements of all_data
+    layout_align = 16
+
     def __init__(self, model, dt=0.001, seed=None, builder=None,
-            planner=greedy_planner,
+            planner=greedy_planner, build_report=False, gemv_engine='loop',
+            n_threads=None, low_rank_tol=None, dedupe_bases=False,
+            optimize_layout=False, offset_bits=None,
             ):
+        """
+        If `build_report` is True, the wall time and peak memory of each
+        build phase are stored in `self.build_report` (a dict; see
+        BuildReport.as_dict), otherwise `self.build_report` is None.
+
+        `gemv_engine` selects how MultiProdUpdate groups run in numpy:
+        'loop' calls ragged_gather_gemv (a Python loop over outputs), and
+        'sparse' precompiles each group with sparse_ragged_gather_gemv.
+
+        If `n_threads` is a number, each step runs the plans on that many
+        threads (see ThreadedDAG), with independent op groups in parallel.
+
+        If `low_rank_tol` is a number, read-only low-rank weight matrices
+        are run as two smaller gemvs (see passes.factor_low_rank), and
+        `self.low_rank_report` lists the rewritten terms.
+
+        If `dedupe_bases` is True, read-only bases with identical contents
+        share one slot of all_data (see passes.dedupe_bases), and
+        `self.dedupe_report` says how many were merged.  N.B. writing one
+        of them through `self.signals` then changes all of them.
+
+        If `optimize_layout` is True, all_data is laid out by
+        passes.layout_bases instead of order_bases: the bases that one
+        kernel reads or writes together are contiguous and aligned, and
+        read-only bases are kept apart from written ones.
+        `self.layout_report` then counts the gemv items with contiguous
+        operands before and after (see passes.contiguous_gemv_items).
+
+        `offset_bits` (32 or 64) is the width of the buffer offsets in
+        the ragged arrays' `starts` (and in the kernels that read them).
+        By default it is 64 only if all_data has 2**31 elements or more.
+        """
+        if gemv_engine not in ('loop', 'sparse'):
+            raise ValueError('unknown gemv_engine', gemv_engine)
+        self.gemv_engine = gemv_engine
+        self.n_threads = n_threads
+        self._report = report = BuildReport(enabled=build_report)
 
         if builder is None:
             builder = nb.Builder(copy=True)
@@ -546,8 +754,9 @@ class Simulator(object):
         self._dt = nb.Signal(np.asarray(dt, dtype=np.float64), name='DT')
 
         # -- possibly make a copy of the model
-        self.model = builder(model, dt)
-        
+        with report.phase('builder'):
+            self.model = builder(model, dt)
+
         # -- add some time-keeping to the copied model
         #    this will be used by e.g. plan_SimPyFunc
         self.model.operators.append(
@@ -560,8 +769,14 @@ class Simulator(object):
             nb.DotInc(self._dt, self._one, self._time))
 
         # -- convert DotInc, Reset, Copy, and ProdUpdate to MultiProdUpdate
-        operators = map(MultiProdUpdate.convert_to, self.model.operators)
-        operators = MultiProdUpdate.compress(operators)
+        with report.phase('convert'):
+            operators = map(MultiProdUpdate.convert_to, self.model.operators)
+            operators = MultiProdUpdate.compress(operators)
+        self.low_rank_report = None
+        if low_rank_tol is not None:
+            with report.phase('low_rank'):
+                operators, self.low_rank_report = passes.factor_low_rank(
+                    operators, tol=low_rank_tol)
         self.operators = operators
         all_signals = signals_from_operators(operators)
         all_bases = stable_unique([sig.base for sig in all_signals])
@@ -597,44 +812,221 @@ class Simulator(object):
             _shares_memory_with[key1] = rval
             return rval
 
-        op_groups = planner(operators, share_memory, indep_cliques)
+        with report.phase('dependency_graph'):
+            dg = exact_dependency_graph(operators, share_memory)
+        with report.phase('planner'):
+            op_groups = planner(operators, share_memory, indep_cliques, dg=dg)
         self.op_groups = op_groups # debug
         #print '-' * 80
         #self.print_op_groups()
 
-        for op in operators:
-            op.init_sigdict(sigdict, self.model.dt)
-
-
         self.n_steps = 0
         self.probe_outputs = dict((probe, []) for probe in self.model.probes)
 
-        self.all_data = _RaggedArray(
-                [sigdict[sb] for sb in all_bases],
-                [getattr(sb, 'name', '') for ss in all_bases]
-                )
+        with report.phase('allocate'):
+            default_order = self.order_bases(all_bases, op_groups)
+            aligned = set()
+            if optimize_layout:
+                all_bases, aligned = passes.layout_bases(
+                    all_bases, op_groups, passes.written_bases(operators),
+                    roles=self.contiguous_roles)
+            else:
+                all_bases = default_order
+            for op in operators:
+                op.init_sigdict(sigdict, self.model.dt)
+            stored_bases = all_bases
+            self.base_aliases = {}
+            self.dedupe_report = None
+            if dedupe_bases:
+                stored_bases, self.base_aliases, self.dedupe_report = \
+                    passes.dedupe_bases(all_bases, sigdict,
+                                        passes.written_bases(operators))
+            if offset_bits is None:
+                n_elements = sum(sigdict[sb].size for sb in stored_bases)
+                if optimize_layout:
+                    n_elements += self.layout_align * len(aligned)
+                offset_bits = 64 if n_elements > np.iinfo('int32').max else 32
+            if offset_bits not in (32, 64):
+                raise ValueError('offset_bits must be 32 or 64', offset_bits)
+            self.offset_bits = offset_bits
+            self.all_data = _RaggedArray(
+                    [sigdict[sb] for sb in stored_bases],
+                    [getattr(sb, 'name', '') for ss in stored_bases],
+                    dtype=self.all_data_dtype,
+                    align=([self.layout_align if sb in aligned else 1
+                            for sb in stored_bases]
+                           if optimize_layout else None),
+                    offset_dtype='int%i' % offset_bits,
+                    )
         #for k in all_bases:
             #print k, k.shape#, sigdict[k]
 
-        builder = ViewBuilder(all_bases, self.all_data)
-        #self._DotInc_views = {}
-        self._AX_views = {}
-        for op_type, op_list in op_groups:
-            self.setup_views(builder, op_type, op_list)
-        builder.add_views_to(self.all_data)
-        self.sidx = builder.sidx
+        with report.phase('views'):
+            builder = ViewBuilder(stored_bases, self.all_data,
+                                  aliases=self.base_aliases)
+            #self._DotInc_views = {}
+            self._AX_views = {}
+            self._sparse_AX = {}
+            for op_type, op_list in op_groups:
+                self.setup_views(builder, op_type, op_list)
+            builder.add_views_to(self.all_data)
+            self.sidx = builder.sidx
+
+        # -- bases that optimize_layout aligned (see layout_align)
+        self.aligned_bases = aligned
+        self.layout_report = None
+        if optimize_layout:
+            sizes = [sigdict[bb].size for bb in default_order]
+            before = dict(zip(default_order, np.cumsum(sizes) - sizes))
+            after = dict((bb, self.all_data.starts[self.sidx[bb]])
+                         for bb in all_bases)
+            n_items, n_before = passes.contiguous_gemv_items(op_groups, before)
+            n_items, n_after = passes.contiguous_gemv_items(op_groups, after)
+            self.layout_report = {
+                'gemv_items': n_items,
+                'contiguous_before': n_before,
+                'contiguous_after': n_after,
+                'n_clusters': len(aligned),
+                'padding': len(self.all_data.buf) - sum(
+                    sigdict[bb].size for bb in stored_bases),
+                }
+
+        with report.phase('prep_all_data'):
+            self._prep_all_data()
+        self.all_bases = all_bases
 
-        self._prep_all_data()
+        # -- source -> built program, shared with forks (see fork)
+        self._programs = {}
+        with report.phase('plan'):
+            with report.kernels_compiled():
+                with plan_module.cached_programs(self._programs):
+                    self._build_plans()
+        with report.phase('snapshot'):
+            self._save_initial_data()
 
-        self._plan = []
-        for op_type, op_list in op_groups:
-            self._plan.extend(self.plan_op_group(op_type, op_list))
-        self._plan.extend(self.plan_probes())
-        self.all_bases = all_bases
+        self.build_report = report.as_dict() if build_report else None
+        # -- later re-planning (e.g. fork) is not part of the build
+        self._report = BuildReport(enabled=False)
 
     def _prep_all_data(self):
         pass
 
+    def _build_plans(self):
+        self._plan = []
+        plan_groups = []
+        for op_type, op_list in self.op_groups:
+            plan_groups.append(self.plan_op_group(op_type, op_list))
+            self._plan.extend(plan_groups[-1])
+        with self._report.op_type('probes', len(self.model.probes)):
+            probe_plans = self.plan_probes()
+        self._plan.extend(probe_plans)
+
+        self._executor = None
+        if self.n_threads:
+            # -- probes read all kinds of signals, so they go last
+            plandict = OrderedDict()
+            deps = op_group_dependencies(self.op_groups, self.extra_reads)
+            for plans, deps_ii in zip(plan_groups, deps):
+                waits_on = [p for jj in deps_ii for p in plan_groups[jj]]
+                for p in plans:
+                    plandict[p] = waits_on
+            for p in probe_plans:
+                plandict[p] = [pp for plans in plan_groups for pp in plans]
+            self._executor = ThreadedDAG(plandict, self.n_threads,
+                                         profiling=self.profiling)
+
+    def extra_reads(self, op):
+        """Signals read by the plan for `op` that are not in `op.reads`.
+
+        None by default: node plans take their time from the host step
+        count, not from the time signal.
+        """
+        return []
+
+    def close(self):
+        """Stop the worker threads of this simulator (see ThreadedDAG).
+
+        The simulator can't be run afterwards (but can still be forked).
+        Simulators are also context managers, which close on exit.
+        """
+        if self._executor is not None:
+            self._executor.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def thread_utilization(self):
+        """Fraction of step time each thread spent running plans (or None)"""
+        if self._executor is None:
+            return None
+        return self._executor.utilization()
+
+    def _save_initial_data(self):
+        self._initial_buf = self.all_data.buf.copy()
+
+    def _copy_all_data(self):
+        rval = self.all_data.shallow_copy()
+        rval.buf = self.all_data.buf.copy()
+        return rval
+
+    def reset(self):
+        """Restore all signals to their values at the end of the build.
+
+        Probe outputs are cleared and the step counter is set back to 0.
+        Nothing is rebuilt, so this is much cheaper than making a new
+        Simulator for every trial.
+        """
+        self.all_data.buf[...] = self._initial_buf
+        self.n_steps = 0
+        self.probe_outputs = dict((probe, []) for probe in self.model.probes)
+
+    def fork(self):
+        """Return a second simulator that continues from the current state.
+
+        The fork shares the built model, operator schedule and signal views
+        with this simulator, but owns a copy of the signal data and its own
+        probe outputs, so the two can be run independently.
+        """
+        rval = copy.copy(self)
+        rval.closed = False
+        rval.all_data = self._copy_all_data()
+        rval.probe_outputs = dict(
+            (probe, list(outputs))
+            for probe, outputs in self.probe_outputs.items())
+        with plan_module.cached_programs(self._programs):
+            rval._build_plans()
+        return rval
+
+    def order_bases(self, all_bases, op_groups):
+        """Return `all_bases` reordered for the layout of `all_data`.
+
+        For each op group listed in `contiguous_roles`, the bases of each
+        role are moved (in op order) to the end of the buffer, so that e.g.
+        the voltages of all LIF ops form one contiguous range.
+        """
+        moved = []
+        for op_type, ops in op_groups:
+            for role in self.contiguous_roles.get(op_type.__name__, ()):
+                moved.extend(getattr(op, role) for op in ops)
+        moved = stable_unique(sig for sig in moved if not isview(sig))
+        moved_set = set(moved)
+        return [bb for bb in all_bases if bb not in moved_set] + moved
+
+    def buf_index(self, sigs):
+        """Index of the elements of `sigs` in `all_data.buf`.
+
+        Returns a slice if the elements are contiguous and in order, so
+        that indexing the buffer with it makes a view rather than a copy.
+        """
+        idx = self.all_data.buf_indices([self.sidx[sig] for sig in sigs])
+        if len(idx) and np.all(np.diff(idx) == 1):
+            return slice(idx[0], idx[-1] + 1)
+        return idx
+
     def print_op_groups(self):
         for op_type, op_list in self.op_groups:
             print 'op_type', op_type.__name__
@@ -642,7 +1034,8 @@ class Simulator(object):
                 print '  ', op
 
     def plan_op_group(self, op_type, ops):
-        return getattr(self, 'plan_' + op_type.__name__)(ops)
+        with self._report.op_type(op_type.__name__, len(ops)):
+            return getattr(self, 'plan_' + op_type.__name__)(ops)
 
     def setup_views(self, view_builder, op_type, ops):
         if hasattr(self, 'setup_views_' + op_type.__name__):
@@ -694,12 +1087,87 @@ class Simulator(object):
 
                 AX_views.extend([A_view, X_view])
 
+            if self.sparse_density is not None:
+                AX_views = self._take_sparse_AX(op, AX_views, view_builder)
+
             map(view_builder.append_view,
                 op.all_signals + AX_views + YYB_views)
             self._AX_views[op] = AX_views
             self._YYB_views[op] = YYB_views
 
+    def _take_sparse_AX(self, op, AX_views, view_builder):
+        """Move the sparse A terms of `op` to self._sparse_AX[op].
+
+        Each sparse term is stored in CSR form, as (indptr, cols, vals,
+        X_view) with int32 row pointers and column indices, and the
+        nonzeros of A read from the (host) all_data.  Returns the remaining
+        (dense) AX_views.  An op that doesn't just increment Y keeps at
+        least one dense term, for the gemv that computes beta * Y_in.
+        """
+        if not hasattr(self, '_written_bases'):
+            self._written_bases = set(
+                sig.base for oo in self.operators
+                for sig in oo.sets + oo.incs + oo.updates)
+        dense = []
+        sparse = []
+        for A_view, X_view in zip(AX_views[0::2], AX_views[1::2]):
+            if (A_view.size < self.sparse_min_size
+                    or X_view.shape[1] != 1
+                    or A_view.base in self._written_bases
+                    # -- the sparse terms run after the gemv writes Y
+                    or X_view.base is op.Y.base):
+                dense.extend([A_view, X_view])
+                continue
+            if isview(A_view):
+                buf = self.all_data.buf
+                itemsize = buf.dtype.itemsize
+                A = np.ndarray(
+                    shape=A_view.shape, dtype=buf.dtype, buffer=buf,
+                    offset=itemsize * (
+                        self.all_data.starts[view_builder.sidx[A_view.base]]
+                        + A_view.offset),
+                    strides=[itemsize * st for st in A_view.elemstrides])
+            else:
+                A = self.all_data[view_builder.sidx[A_view]]
+            rows, cols = np.nonzero(A)
+            if len(rows) > self.sparse_density * A.size:
+                dense.extend([A_view, X_view])
+                continue
+            indptr = np.zeros(A.shape[0] + 1, dtype='int32')
+            np.cumsum(np.bincount(rows, minlength=A.shape[0]),
+                      out=indptr[1:])
+            sparse.append((A_view, X_view, indptr, cols.astype('int32'),
+                           A[rows, cols].copy()))
+        if sparse and not dense and not op._incs_Y:
+            dense.extend(sparse.pop(0)[:2])
+        if sparse:
+            self._sparse_AX[op] = [(indptr, cols, vals, X_view)
+                                   for A_view, X_view, indptr, cols, vals
+                                   in sparse]
+            map(view_builder.append_view, [term[1] for term in sparse])
+        return dense
+
     def plan_MultiProdUpdate(self, ops):
+        # -- ops left without dense terms only increment Y by sparse ones
+        #    (ops that never had any terms, like Resets, still need a gemv)
+        dense_ops = [op for op in ops
+                     if self._AX_views[op] or op not in self._sparse_AX]
+        gemvs = self.plan_dense_AX(dense_ops)
+        sparse_ops = [op for op in ops if op in self._sparse_AX]
+        if not sparse_ops:
+            return gemvs
+        plans = gemvs + self.plan_sparse_AX(sparse_ops)
+        # -- one plan, so that the sparse terms are added after the gemvs
+        #    that set Y (also with n_threads)
+        def gemvs_then_sparse(profiling=False):
+            for fn in plans:
+                fn(profiling)
+        return [gemvs_then_sparse]
+
+    def plan_dense_AX(self, ops):
+        """Plan the gemvs of MultiProdUpdate `ops`, for their dense terms"""
+        if not ops:
+            return []
         constant_bs = [op
             for op in ops
             if op._float_beta is not None]
@@ -742,6 +1210,26 @@ class Simulator(object):
             )
         return constant_b_gemvs + vector_b_gemvs
 
+    def plan_sparse_AX(self, ops):
+        """Plan Y += A X for the sparse terms of MultiProdUpdate `ops`
+        (see _take_sparse_AX), with one bincount over the rows per term"""
+        terms = []
+        for op in ops:
+            y_idx = self.all_data.buf_indices(
+                [self.sidx[self._YYB_views[op][0]]])
+            for indptr, cols, vals, X_view in self._sparse_AX[op]:
+                x_idx = self.all_data.buf_indices([self.sidx[X_view]])
+                rows = np.repeat(np.arange(len(indptr) - 1, dtype='int32'),
+                                 np.diff(indptr))
+                terms.append((y_idx, x_idx, rows, cols, vals))
+        def sparse_AX(profiling=False):
+            buf = self.all_data.buf
+            for y_idx, x_idx, rows, cols, vals in terms:
+                x = buf[x_idx]
+                buf[y_idx] += np.bincount(rows, weights=vals * x[cols],
+                                          minlength=len(y_idx))
+        return [sparse_AX]
+
     def plan_SimDirect(self, ops):
         sidx = self.sidx
         def direct(profiling=False):
@@ -758,18 +1246,17 @@ class Simulator(object):
     def plan_SimPyFunc(self, ops):
         dt = self.model.dt
         sidx = self.sidx
-        t = self.all_data[sidx[self._time]]
         def pyfunc(profiling=False):
+            # -- the time signal minus dt (see nengo ticket #234), from the
+            #    host step count, like sim_ocl's node plans
+            t = self.n_steps * dt
             for op in ops:
                 output = self.all_data[sidx[op.output]]
-                # -- YEP, subtracting off DT is crazy
-                #    but it makes nengo's tests pass.
-                #    See nengo ticket #234 for potential resolution.
                 if op.n_args == 2:
                     J = self.all_data[sidx[op.J]]
-                    out = op.fn(t[0, 0] - dt, J)
+                    out = op.fn(t, J)
                 else:
-                    out = op.fn(t[0, 0] - dt)
+                    out = op.fn(t)
                 out = np.asarray(out)
                 if out.ndim == 1:
                     output[...] = out[:, None]
@@ -781,24 +1268,36 @@ class Simulator(object):
 
     def plan_SimLIF(self, ops):
         dt = self.model.dt
-        sidx = self.sidx
+        J = self.buf_index([op.J for op in ops])
+        V = self.buf_index([op.voltage for op in ops])
+        W = self.buf_index([op.refractory_time for op in ops])
+        S = self.buf_index([op.output for op in ops])
+        sizes = [op.J.size for op in ops]
+        tau_ref = per_element([op.nl.tau_ref for op in ops], sizes)
+        tau_rc = per_element([op.nl.tau_rc for op in ops], sizes)
+        upsample = lif_upsample(ops)
         def lif(profiling=False):
-            for op in ops:
-                J = self.all_data[sidx[op.J]]
-                voltage = self.all_data[sidx[op.voltage]]
-                reftime = self.all_data[sidx[op.refractory_time]]
-                output = self.all_data[sidx[op.output]]
-                op.nl.step_math0(dt, J, voltage, reftime, output,)
+            buf = self.all_data.buf
+            voltage, reftime, output = buf[V], buf[W], buf[S]
+            lif_step(dt, buf[J], voltage, reftime, output, tau_ref, tau_rc,
+                     upsample=upsample)
+            # -- slices were updated in place, index arrays were copies
+            for idx, val in [(V, voltage), (W, reftime), (S, output)]:
+                if not isinstance(idx, slice):
+                    buf[idx] = val
         return [lif]
 
     def plan_SimLIFRate(self, ops):
         dt = self.model.dt
-        def lif_rate(profiling=False):
-            for op in ops:
-                J = self.all_data[self.sidx[op.J]]
-                output = self.all_data[self.sidx[op.output]]
-                output[:] = op.nl.math(dt, J)
-        return [lif_rate]
+        J = self.buf_index([op.J for op in ops])
+        R = self.buf_index([op.output for op in ops])
+        sizes = [op.J.size for op in ops]
+        tau_ref = per_element([op.nl.tau_ref for op in ops], sizes)
+        tau_rc = per_element([op.nl.tau_rc for op in ops], sizes)
+        def lifrate(profiling=False):
+            buf = self.all_data.buf
+            buf[R] = lif_rate(dt, buf[J], tau_ref, tau_rc)
+        return [lifrate]
 
     def RaggedArray(self, *args, **kwargs):
         return _RaggedArray(*args, **kwargs)
@@ -892,6 +1391,11 @@ class Simulator(object):
     def plan_ragged_gather_gemv(self, alpha, A, A_js, X, X_js,
                                 beta, Y, Y_in=None, tag=None, seq=None,
                                 gamma=None):
+        # -- signal-valued beta (a RaggedArray) still uses the loop
+        if self.gemv_engine == 'sparse' and not isinstance(beta, _RaggedArray):
+            fn = sparse_ragged_gather_gemv(alpha, A, A_js, X, X_js, beta, Y,
+                                           Y_in=Y_in, gamma=gamma)
+            return PythonPlan(fn, name="npy_sparse_gather_gemv", tag=tag)
         fn = lambda: ragged_gather_gemv(alpha, A, A_js, X, X_js, beta, Y,
                                         Y_in=Y_in, gamma=gamma,
                                         tag=tag,
@@ -1011,9 +1515,14 @@ class Simulator(object):
             return []
 
     def step(self):
-        profiling = self.profiling
-        for fn in self._plan:
-            fn(profiling)
+        if self.closed:
+            raise RuntimeError('simulator is closed')
+        if self._executor is not None:
+            self._executor()
+        else:
+            profiling = self.profiling
+            for fn in self._plan:
+                fn(profiling)
         self.n_steps += 1
 
     def run(self, time_in_seconds):
@@ -1,14 +1,23 @@
 import os
+import dis
+import copy
 import collections
 import numpy as np
 import pyopencl as cl
 
+from . import memory
+from . import passes
 from . import sim_npy
 from .raggedarray import RaggedArray
 from .clraggedarray import CLRaggedArray
 from .clra_gemv import plan_ragged_gather_gemv
+from .clra_sparse_gemv import plan_sparse_gemv, choose_format
+from .clra_fusion import find_lif_gemv_fusions, plan_lif_gemv
+from .megakernel import plan_megakernel, stage_levels, find_islands, \
+    small_groups, gemv_elements, neuron_elements, LIF_ROLES, LIF_RATE_ROLES
 from .clra_nonlinearities import \
-    plan_lif, plan_lif_rate, plan_direct, plan_probes
+    plan_lif, plan_lif_rate, plan_direct, plan_probes, plan_lookahead, \
+    plan_stimulus_table, fill_stimulus_table
 from .plan import BasePlan, PythonPlan, DAG, Marker
 from .ast_conversion import OCL_Function
 from .tricky_imports import OrderedDict
@@ -18,18 +27,169 @@ logger = logging.getLogger(__name__)
 
 PROFILING_ENABLE = cl.command_queue_properties.PROFILING_ENABLE
 
+# -- a function whose code only does these builds its output from
+#    constants, e.g. `lambda t: [0.5, -0.5]`
+_CONSTANT_OPS = set(dis.opmap[name] for name in [
+    'LOAD_CONST', 'BUILD_LIST', 'BUILD_TUPLE', 'RETURN_VALUE',
+    'UNARY_POSITIVE', 'UNARY_NEGATIVE', 'BINARY_ADD', 'BINARY_SUBTRACT',
+    'BINARY_MULTIPLY', 'BINARY_DIVIDE', 'BINARY_TRUE_DIVIDE',
+    'BINARY_FLOOR_DIVIDE', 'BINARY_POWER'])
+
+
+def constant_output(fn):
+    """Return the output of node function `fn(t)` if it is constant.
+
+    `fn` counts as constant if it is a plain Python function of one
+    argument whose code reads nothing but literal constants (e.g.
+    `lambda t: [0.5]`).  Reads of globals, closure variables, attributes
+    or items (e.g. `lambda t: state['x']`) can change between steps, so
+    such functions are not constant.  Otherwise return None.
+    """
+    code = getattr(fn, 'func_code', None)
+    if code is None or code.co_argcount != 1 or code.co_flags & 0x2c:
+        # -- 0x2c: *args, **kwargs, generator
+        return None
+    bytecode = code.co_code
+    ii = 0
+    while ii < len(bytecode):
+        op = ord(bytecode[ii])
+        if op not in _CONSTANT_OPS:
+            return None
+        ii += 3 if op >= dis.HAVE_ARGUMENT else 1
+    return np.array(fn(0.0), dtype=np.float64)
+
+
+def is_constant(op):
+    """True if SimPyFunc `op` is a node with a constant output, which
+    plan_SimPyFunc folds into the initial signal values"""
+    return (op.n_args == 1 and not getattr(op.fn, 'vectorized', False)
+            and constant_output(op.fn) is not None)
+
+
+def vectorized(fn):
+    """Mark node function `fn` as vectorized, for sim_ocl.Simulator.
+
+    All the nodes sharing a vectorized function are run with one call per
+    step: `fn(t)` must return an (n_nodes, size_out) array, and `fn(t, X)`
+    gets the inputs of all the nodes stacked in an (n_nodes, size_in)
+    array.  Rows follow the order of the nodes' operators in the model.
+    Vectorized functions are always called from the step loop (they are
+    not folded, tabulated or evaluated ahead).
+    """
+    fn.vectorized = True
+    return fn
+
+
+def probe_error_report(sim, ref):
+    """Compare the probe outputs of two simulators of the same model.
+
+    E.g. `sim` with weights_dtype=np.float16 against a float32 `ref`.
+    Returns one dict per probe (in model.probes order) with the max and
+    RMS absolute error and the RMS of the reference output.
+    """
+    rval = []
+    for probe, ref_probe in zip(sim.model.probes, ref.model.probes):
+        data = sim.probe_data(probe)
+        ref_data = ref.probe_data(ref_probe)
+        err = data - ref_data
+        rval.append({
+            'probe': str(probe.sig),
+            'max_abs_err': float(np.max(np.abs(err))) if err.size else 0.0,
+            'rms_err': float(np.sqrt(np.mean(err ** 2))) if err.size else 0.0,
+            'rms_ref': (float(np.sqrt(np.mean(ref_data ** 2)))
+                        if err.size else 0.0),
+            })
+    return rval
+
 
 class Simulator(sim_npy.Simulator):
 
+    # -- build the host buffer directly in the device dtype
+    all_data_dtype = np.float32
+
     def RaggedArray(self, *args, **kwargs):
         val = RaggedArray(*args, **kwargs)
         if len(val.buf) == 0:
             return None
         else:
-            return CLRaggedArray(self.queue, val)
+            return CLRaggedArray(self.queue, val, dtype=self.all_data_dtype)
 
     def __init__(self, model, dt=0.001, seed=None, builder=None, context=None,
-                 n_prealloc_probes=1000, profiling=None, ocl_only=False):
+                 n_prealloc_probes=1000, profiling=None, ocl_only=False,
+                 build_report=False, lookahead=0, stimulus_steps=0,
+                 dtype=np.float32, weights_dtype=None, sparse_density=None,
+                 low_rank_tol=None, dedupe_bases=False,
+                 optimize_layout=False, max_buffer_bytes=None,
+                 shared_weights=False, offset_bits=None,
+                 fuse_lif_gemv=False, megakernel=False,
+                 steps_per_launch=1, small_ops_size=None,
+                 planner=sim_npy.greedy_planner):
+        """
+        dtype : np.float32 or np.float64
+            The precision of all signals (and of the time signal) on the
+            device.  float64 needs devices supporting cl_khr_fp64.
+            Python nodes always get their time in float64, from a host
+            step count (see _node_clock).
+        weights_dtype : None or np.float16
+            If np.float16, the read-only A matrices of the gemv ops (decoders,
+            encoders, transforms) are read from a separate half-precision
+            copy (`weight_data`), halving their bandwidth.  Accumulation
+            stays in `dtype`.  See probe_error_report.
+        sparse_density : None or float
+            If set, read-only A matrices (of at least sparse_min_size
+            elements) with at most this fraction of nonzeros are multiplied
+            by clra_sparse_gemv kernels instead of dense gemv.
+        lookahead : int
+            If > 0, nodes whose output depends only on time are evaluated
+            on a worker thread, `lookahead` steps at a time and ahead of
+            the device, instead of synchronously in every step.
+        stimulus_steps : int
+            If > 0 (and lookahead is 0), nodes whose output depends only on
+            time are evaluated before each run, for up to `stimulus_steps`
+            steps, into a device table indexed by the step counter.
+            Longer runs refill the table every `stimulus_steps` steps.
+        max_buffer_bytes : None or int
+            If all_data would be larger than this (default: the smallest
+            max_mem_alloc_size of the context's devices), the read-only
+            gemv A matrices are moved to extra buffers of at most this
+            size (see _shard_all_data and CLRaggedArray.shard).
+        shared_weights : bool
+            If True, those A matrices are moved to the extra buffers even
+            if all_data fits in one, so that fork() shares them rather
+            than copying them.  The gemv ops reading them are then not
+            fused or put into megakernels (see _plain_gemv).
+        offset_bits : None, 32 or 64
+            The width of buffer offsets in ragged metadata and kernels.
+            By default it is 64 only if a buffer of all_data (after any
+            sharding) has 2**31 elements or more.  See
+            examples/benchmark_offsets.py for the cost of 64.
+        fuse_lif_gemv : bool
+            If True, MultiProdUpdate ops that only multiply the spikes of a
+            LIF op (e.g. decoders) are computed in the kernel of its SimLIF
+            group, from the spikes in local memory (see clra_fusion).
+            They read their A matrices from all_data, i.e. not from a
+            weights_dtype copy.  `self.fusion_report` counts them.
+        megakernel : bool
+            If True, each run of consecutive MultiProdUpdate (dense), SimLIF
+            and SimLIFRate groups is planned as a single kernel on a single
+            work-group (see megakernel.py), cutting launch overhead for
+            small models.  If that is the whole step, independent parts
+            of the model (islands) get a work-group each.  Other groups
+            (e.g. Python nodes) get their usual plans in between.
+            Overrides fuse_lif_gemv.
+            `self.megakernel_report` says how it went.
+        steps_per_launch : int
+            With megakernel, and if the whole step (probes included) is one
+            megakernel, run up to this many steps per kernel launch.
+        small_ops_size : None or int
+            If set (and megakernel is not), the op groups that a megakernel
+            can compute and that have at most this many output elements
+            plus multiply-adds (e.g. the step and time updates) are
+            collected by dependency layer, and each layer's collection is
+            planned as one single-stage megakernel
+            (see megakernel.small_groups).  `self.small_ops_report` counts
+            the groups and kernels.
+        """
         if context is None:
             print 'No context argument was provided to sim_ocl.Simulator'
             print "Calling pyopencl.create_some_context() for you now:"
@@ -38,6 +198,32 @@ class Simulator(sim_npy.Simulator):
             profiling = int(os.getenv("NENGO_OCL_PROFILING", 0))
         self.context = context
         self.profiling = profiling
+        dtype = np.dtype(dtype)
+        if dtype not in (np.float32, np.float64):
+            raise ValueError('dtype must be float32 or float64', dtype)
+        if dtype == np.float64:
+            for device in context.devices:
+                if 'cl_khr_fp64' not in device.extensions:
+                    raise ValueError(
+                        'device does not support float64', device.name)
+        self.all_data_dtype = dtype
+        if weights_dtype is not None and np.dtype(weights_dtype) != np.float16:
+            raise ValueError('weights_dtype must be None or float16',
+                             weights_dtype)
+        self.weights_dtype = weights_dtype
+        self.sparse_density = sparse_density
+        self.max_buffer_bytes = max_buffer_bytes
+        self.shared_weights = shared_weights
+        # -- (fmt, ops) -> device arrays of the sparse plans, which forks
+        #    share (see plan_sparse_AX)
+        self._sparse_tables = {}
+        self._auto_offset_bits = offset_bits is None
+        self.fuse_lif_gemv = fuse_lif_gemv
+        self.megakernel = megakernel
+        self.small_ops_size = small_ops_size
+        if steps_per_launch != 1 and not megakernel:
+            raise ValueError('steps_per_launch needs megakernel=True')
+        self.steps_per_launch = steps_per_launch
         if self.profiling:
             self.queue = cl.CommandQueue(context,
                                          properties=PROFILING_ENABLE)
@@ -46,42 +232,699 @@ class Simulator(sim_npy.Simulator):
 
         self.n_prealloc_probes = n_prealloc_probes
         self.ocl_only = ocl_only
+        self.lookahead = lookahead
+        self.stimulus_steps = stimulus_steps
 
         # -- allocate data
         sim_npy.Simulator.__init__(
-            self, model=model, dt=dt, seed=seed, builder=builder)
+            self, model=model, dt=dt, seed=seed, builder=builder,
+            build_report=build_report, low_rank_tol=low_rank_tol,
+            dedupe_bases=dedupe_bases, optimize_layout=optimize_layout,
+            offset_bits=offset_bits, planner=planner)
 
+    def _build_plans(self):
         # -- set up the DAG for executing OCL kernels
         self._plandict = OrderedDict()
+        self._lookahead_plans = []
+        self._stimulus_tables = []
+        self._node_clocks = []
         self.step_marker = Marker(self.queue)
-        # -- marker is used to do the op_groups in order
-        deps = []
-        for op_type, op_list in self.op_groups:
-            deps = self.plandict_op_group(op_type, op_list, deps)
-        probe_plans = self.plan_probes()
-        for p in probe_plans:
-            self._plandict[p] = deps
-        self._dag = DAG(context, self.step_marker,
+        # -- each op group waits only on the groups it really depends on,
+        #    so the DAG needs to sync the host only where a PythonPlan does
+        group_deps = sim_npy.op_group_dependencies(
+            self.op_groups, self.extra_reads)
+        fusions = self._lif_gemv_fusions()
+        fused = set(op for found in fusions.values()
+                    for ops in found.values() for op in ops)
+        self.fusion_report = {
+            'n_lif_groups': len(fusions), 'n_gemv_ops': len(fused)}
+        segments = (self._megakernel_segments()
+                    or self._small_op_groups(group_deps, fusions))
+        # -- the probes go into the megakernel if it is the whole step
+        fold_probes = (self.megakernel and len(segments) == 1
+                       and len(segments.values()[0]) == len(self.op_groups))
+        if fold_probes:
+            with self._report.op_type('probes', len(self.model.probes)):
+                probe_plans = self.plan_probes()
+        self._loop_plan = None
+        # -- group index -> fused plans that compute some of its ops
+        fused_plans = {}
+        group_plans = []
+        for ii, ((op_type, op_list), deps_ii) in enumerate(
+                zip(self.op_groups, group_deps)):
+            deps = [p for jj in deps_ii for p in group_plans[jj]]
+            if any(ii in seg[1:] for seg in segments.values()):
+                group_plans.append(fused_plans[ii])
+                continue
+            if ii in segments:
+                seg = segments[ii]
+                deps = sim_npy.stable_unique(
+                    p for kk in seg for jj in group_deps[kk] if jj < ii
+                    for p in group_plans[jj])
+                with self._report.op_type(
+                        'megakernel' if self.megakernel else 'small-ops',
+                        sum(len(self.op_groups[kk][1]) for kk in seg)):
+                    plans = [self.plan_megakernel(
+                        seg, group_deps,
+                        probes=probe_plans[0]
+                        if fold_probes and probe_plans else None)]
+                self._plandict[plans[0]] = deps
+                for kk in seg[1:]:
+                    fused_plans[kk] = plans
+                if fold_probes:
+                    self._loop_plan = plans[0]
+            elif ii in fusions:
+                # -- the moved ops also wait on what they depend on (all of
+                #    which comes before this group, see find_lif_gemv_fusions)
+                deps = sim_npy.stable_unique(deps + [
+                    p for kk in fusions[ii] for jj in group_deps[kk]
+                    if jj < ii for p in group_plans[jj]])
+                gemv_ops = [op for ops in fusions[ii].values() for op in ops]
+                with self._report.op_type('SimLIF+MultiProdUpdate',
+                                          len(op_list) + len(gemv_ops)):
+                    plans = self.plan_lif_gemv(op_list, gemv_ops)
+                for p in plans:
+                    self._plandict[p] = deps
+                for kk in fusions[ii]:
+                    fused_plans.setdefault(kk, []).extend(plans)
+            else:
+                op_list = [op for op in op_list if op not in fused]
+                plans = (self.plandict_op_group(op_type, op_list, deps)
+                         if op_list else [])
+            group_plans.append(plans + fused_plans.get(ii, []))
+        if not fold_probes:
+            with self._report.op_type('probes', len(self.model.probes)):
+                probe_plans = self.plan_probes()
+            deps = sim_npy.stable_unique(
+                p for plans in group_plans for p in plans)
+            for p in probe_plans:
+                self._plandict[p] = deps
+        self.megakernel_report = None
+        if self.megakernel:
+            self.megakernel_report = {
+                'n_megakernels': len(segments),
+                'n_stages': sum(p.n_stages for p in self._plandict
+                                if p.name == 'megakernel'),
+                'n_islands': sum(p.n_islands for p in self._plandict
+                                 if p.name == 'megakernel'),
+                'n_other_plans': len(self._plandict) - len(segments),
+                'whole_step': fold_probes,
+                }
+        self.small_ops_report = None
+        if self.small_ops_size is not None and not self.megakernel:
+            self.small_ops_report = {
+                'n_groups': sum(len(seg) for seg in segments.values()),
+                'n_kernels': len(segments),
+                }
+        if self.steps_per_launch != 1 and self._loop_plan is None:
+            raise ValueError('steps_per_launch needs a model whose whole '
+                             'step runs in one megakernel',
+                             self.megakernel_report)
+        self._dag = DAG(self.context, self.step_marker,
                            self._plandict,
                            self.profiling)
 
-    def plan_op_group(self, *args):
-        # -- HACK: SLOWLY removing sim_npy from the project...
-        return []
+    def _megakernel_segments(self):
+        """Return a dict mapping the first index of each run of consecutive
+        op groups that a megakernel can compute to the run's indices"""
+        if not self.megakernel:
+            return {}
+        rval = {}
+        start = None
+        for ii, (op_type, ops) in enumerate(self.op_groups):
+            name = op_type.__name__
+            # -- megakernel.neuron_elements has no upsampled LIF
+            if name == 'SimLIFRate' or (
+                    name == 'SimLIF' and sim_npy.lif_upsample(ops) == 1) or (
+                    name == 'MultiProdUpdate'
+                    and all(map(self._plain_gemv, ops))) or (
+                    name == 'SimPyFunc' and all(map(is_constant, ops))):
+                if start is None:
+                    start = ii
+                rval.setdefault(start, []).append(ii)
+            else:
+                start = None
+        return rval
+
+    def _small_op_groups(self, group_deps, fusions):
+        """Return the collections of small op groups to plan as one kernel
+        each (see megakernel.small_groups), if small_ops_size is set.
+
+        Groups taking part in `fusions` (see _lif_gemv_fusions) are left
+        alone.
+        """
+        if self.small_ops_size is None or self.megakernel:
+            return {}
+        fused_idxs = set(fusions)
+        for found in fusions.values():
+            fused_idxs.update(found)
+        sizes = []
+        for ii, (op_type, ops) in enumerate(self.op_groups):
+            name = op_type.__name__
+            if ii in fused_idxs:
+                sizes.append(None)
+            elif name == 'SimLIFRate' or (
+                    name == 'SimLIF' and sim_npy.lif_upsample(ops) == 1):
+                sizes.append(sum(op.J.size for op in ops))
+            elif name == 'MultiProdUpdate' and all(
+                    map(self._plain_gemv, ops)):
+                sizes.append(sum(
+                    self._YYB_views[op][0].size
+                    + sum(A.size for A in self._AX_views[op][0::2])
+                    for op in ops))
+            else:
+                sizes.append(None)
+        return small_groups(sizes, group_deps, self.small_ops_size)
+
+    def plan_megakernel(self, group_idxs, group_deps, probes=None):
+        """Plan op groups `group_idxs` as one kernel (see megakernel.py).
+
+        If `probes` is given, the groups are the whole step, and each
+        island (see megakernel.find_islands) gets its own work-group.
+        """
+        kinds = {'MultiProdUpdate': 'gemv', 'SimLIF': 'lif',
+                 'SimLIFRate': 'lif_rate'}
+        groups = []
+        for ii in group_idxs:
+            op_type, ops = self.op_groups[ii]
+            if op_type.__name__ == 'SimPyFunc':
+                # -- constant nodes, which need no plan
+                assert self.plan_SimPyFunc(ops) == []
+                continue
+            groups.append((ii, kinds[op_type.__name__], ops))
+
+        all_ops = [op for ii, kind, ops in groups for op in ops]
+        if probes is None:
+            islands, base_islands = [all_ops], {}
+        else:
+            islands, base_islands = find_islands(
+                all_ops, passes.written_bases(self.operators))
+        island_of = dict((op, gg) for gg, island in enumerate(islands)
+                         for op in island)
+
+        island_stages = []
+        for gg in range(len(islands)):
+            island_groups = [
+                (ii, kind, [op for op in ops if island_of[op] == gg])
+                for ii, kind, ops in groups]
+            island_groups = [group for group in island_groups if group[2]]
+            levels = stage_levels([ii for ii, kind, ops in island_groups],
+                                  group_deps)
+            stage_ops = [{} for ll in range(max(levels) + 1)]
+            for (ii, kind, ops), level in zip(island_groups, levels):
+                stage_ops[level].setdefault(kind, []).extend(ops)
+            stages = []
+            for ops_by_kind in stage_ops:
+                stage = {}
+                for kind, ops in ops_by_kind.items():
+                    if kind == 'gemv':
+                        stage[kind] = gemv_elements(
+                            ops, self._AX_views, self._YYB_views,
+                            self.all_data, self.sidx)
+                    else:
+                        stage[kind] = neuron_elements(
+                            ops,
+                            LIF_ROLES if kind == 'lif' else LIF_RATE_ROLES,
+                            self.all_data, self.sidx)
+                stages.append(stage)
+            island_stages.append(stages)
+
+        lsize = min([256] + [d.max_work_group_size
+                             for d in self.context.devices])
+        # -- probes of signals no island writes can go anywhere
+        probe_islands = [base_islands.get(p.sig.base, 0)
+                         for p in self.model.probes]
+        rval = plan_megakernel(self.queue, self.all_data.cl_buf,
+                               island_stages, self.model.dt, lsize=lsize,
+                               probes=probes, probe_islands=probe_islands,
+                               tag='%s-%i' % (
+                                   'megakernel' if self.megakernel
+                                   else 'small-ops', len(group_idxs)))
+        rval.n_stages = max(len(stages) for stages in island_stages)
+        rval.n_islands = len(islands)
+        return rval
+
+    def _lif_gemv_fusions(self):
+        """Find the MultiProdUpdate ops to plan with a SimLIF group (see
+        clra_fusion.find_lif_gemv_fusions), if fuse_lif_gemv is set"""
+        if not self.fuse_lif_gemv or self.megakernel:
+            return {}
+        devices = self.context.devices
+        lsize = self._fused_lsize()
+        local_elems = (min(d.local_mem_size for d in devices)
+                       // self.all_data.dtype.itemsize)
+        exclude = set(op for op in self._AX_views
+                      if not self._plain_gemv(op))
+        return find_lif_gemv_fusions(
+            self.op_groups, self._AX_views, self._YYB_views,
+            self.all_data, self.sidx, exclude=exclude,
+            max_size=local_elems - lsize, extra_reads=self.extra_reads)
+
+    def _fused_lsize(self):
+        max_size = min([128] + [d.max_work_group_size
+                                for d in self.context.devices])
+        return 2 ** int(np.log2(max_size))
+
+    def plan_lif_gemv(self, lif_ops, gemv_ops):
+        """Plan SimLIF `lif_ops` together with the MultiProdUpdate `gemv_ops`
+        that read their spikes (see clra_fusion.plan_lif_gemv)"""
+        outputs = dict((op.output.base, op) for op in lif_ops)
+        consumers = dict((op, []) for op in lif_ops)
+        for op in gemv_ops:
+            X = self._AX_views[op][1]
+            consumers[outputs[X.base]].append(op)
+        gemv_ops = [op for lif in lif_ops for op in consumers[lif]]
+        consumer_ptr = np.cumsum([0] + [len(consumers[op]) for op in lif_ops])
+        term_ptr = np.cumsum(
+            [0] + [len(self._AX_views[op]) // 2 for op in gemv_ops])
+
+        items = lambda sigs: self.all_data[[self.sidx[sig] for sig in sigs]]
+        return [plan_lif_gemv(
+            self.queue,
+            J=items([op.J for op in lif_ops]),
+            V=items([op.voltage for op in lif_ops]),
+            W=items([op.refractory_time for op in lif_ops]),
+            S=items([op.output for op in lif_ops]),
+            ref=[op.nl.tau_ref for op in lif_ops],
+            tau=[op.nl.tau_rc for op in lif_ops],
+            dt=self.model.dt,
+            consumer_ptr=consumer_ptr,
+            Y=items([self._YYB_views[op][0] for op in gemv_ops]),
+            Y_in=items([self._YYB_views[op][1] for op in gemv_ops]),
+            beta=[op._float_beta for op in gemv_ops],
+            gamma=[op.gamma for op in gemv_ops],
+            term_ptr=term_ptr,
+            A=items([A for op in gemv_ops for A in self._AX_views[op][0::2]]),
+            lsize=self._fused_lsize(),
+            tag='lif-gemv-%i' % len(gemv_ops),
+            upsample=sim_npy.lif_upsample(lif_ops),
+            )]
 
     def plandict_op_group(self, op_type, op_list, deps):
-        plans = getattr(self, 'plan_' + op_type.__name__)(op_list)
+        plans = self.plan_op_group(op_type, op_list)
         for p in plans:
             self._plandict[p] = deps
         return plans
 
     def _prep_all_data(self):
+        # -- fail here, with a breakdown, rather than in some to_device;
+        #    the largest buffer is only known after any sharding (below)
+        self.memory_estimate = memory.estimate_memory(
+            self.operators, self.model.probes, dtype=self.all_data_dtype,
+            weights_dtype=self.weights_dtype,
+            n_prealloc_probes=self.n_prealloc_probes)
+        for device in self.memory_devices():
+            memory.check_fits(self.memory_estimate, device,
+                              largest_buffer=False)
+
+        self.weights_only_bases = set()
+        if self.weights_dtype is not None:
+            self.weight_data, self._weight_items = self._weight_data()
+            self.weights_only_bases = self._weights_only_bases()
+            if self.weights_only_bases:
+                self.all_data = self._drop_bases(self.weights_only_bases)
+        else:
+            self.weight_data, self._weight_items = None, set()
+
+        max_bytes = self.max_buffer_bytes
+        if max_bytes is None:
+            max_bytes = min(dev.max_mem_alloc_size
+                            for dev in self.memory_devices())
+        itemsize = np.dtype(self.all_data_dtype).itemsize
+        shards, buf_ids = (), None
+        if (self.shared_weights
+                or len(self.all_data.buf) * itemsize > max_bytes):
+            self.all_data, shards, buf_ids = self._shard_all_data(
+                max_bytes // itemsize)
+            self.memory_estimate['largest_buffer'] = itemsize * max(
+                [len(self.all_data.buf)] + map(len, shards)
+                + [len(self.weight_data.buf) if self.weight_data else 0])
+            self.memory_estimate['largest_buffer'] = max(
+                self.memory_estimate['largest_buffer'],
+                self.memory_estimate['probe_buffers'])
+        for device in self.memory_devices():
+            memory.check_fits(self.memory_estimate, device)
+
+        if self._auto_offset_bits:
+            # -- offsets only need to address the largest single buffer
+            largest = max([len(self.all_data.buf)] + map(len, shards))
+            self.offset_bits = (64 if largest > np.iinfo('int32').max
+                                else 32)
+
         # -- replace the numpy-allocated RaggedArray with OpenCL one
-        self.all_data = CLRaggedArray(self.queue, self.all_data)
+        self.all_data = CLRaggedArray(self.queue, self.all_data,
+                                      dtype=self.all_data_dtype,
+                                      shards=shards, buf_ids=buf_ids,
+                                      offset_dtype='int%i' % self.offset_bits)
+
+    def memory_devices(self):
+        """The devices whose global memory and maximum allocation size
+        the model must fit (see memory.check_fits)"""
+        return self.context.devices
+
+    def _shard_all_data(self, max_size):
+        """Move read-only gemv A matrices out of all_data into shards.
+
+        Each shard holds at most `max_size` elements, and all the A
+        matrices of one op (or of ops sharing an A) go into the same
+        shard, so that each gemv plan reads one shard.  Bases that
+        anything else reads stay in buffer 0.
+
+        Returns the new host all_data (buffer 0), the shards' host
+        buffers, and the buffer id of every item.
+        """
+        written = passes.written_bases(self.operators)
+        stored_base = lambda sig: self.base_aliases.get(sig.base, sig.base)
+        other = set(stored_base(p.sig) for p in self.model.probes)
+        for op in self.operators:
+            if op in self._AX_views:
+                sigs = self._AX_views[op][1::2] + self._YYB_views[op]
+                sigs += [X for rows, cols, vals, X in
+                         self._sparse_AX.get(op, [])]
+            else:
+                sigs = op.all_signals
+            other.update(stored_base(sig) for sig in sigs)
+
+        # -- union-find over the A bases of each op: a unit of bases moves
+        #    together, and only if none of them has to stay
+        parent = {}
+        def find(bb):
+            while parent[bb] is not bb:
+                bb = parent[bb]
+            return bb
+        a_bases = []
+        for op_type, ops in self.op_groups:
+            for op in ops:
+                bases = [stored_base(A)
+                         for A in self._AX_views.get(op, [])[0::2]]
+                for bb in bases:
+                    if bb not in parent:
+                        parent[bb] = bb
+                        a_bases.append(bb)
+                for bb in bases[1:]:
+                    parent[find(bb)] = find(bases[0])
+        units = OrderedDict()
+        for bb in a_bases:
+            units.setdefault(find(bb), []).append(bb)
+        for root, unit in units.items():
+            if any(bb in written or bb in other
+                   or bb in self.weights_only_bases for bb in unit):
+                del units[root]
+        movable = set(bb for unit in units.values() for bb in unit)
+
+        size = lambda bb: int(self.all_data.shape0s[self.sidx[bb]]
+                              * self.all_data.shape1s[self.sidx[bb]])
+        buffers = [[bb for bb in sorted(self.sidx, key=self.sidx.get)
+                    if not sim_npy.isview(bb)
+                    and bb not in self.base_aliases
+                    and bb not in self.weights_only_bases
+                    and bb not in movable]]
+        n_filled = max_size
+        for unit in units.values():
+            n = sum(map(size, unit))
+            if n > max_size:
+                raise MemoryError('the A matrices of one gemv op need %i'
+                                  ' elements, but a buffer holds %i' %
+                                  (n, max_size))
+            if n_filled + n > max_size:
+                buffers.append([])
+                n_filled = 0
+            buffers[-1].extend(unit)
+            n_filled += n
+
+        loc = {}
+        host_bufs = []
+        for buf_id, bases in enumerate(buffers):
+            ra = RaggedArray([self.all_data[self.sidx[bb]] for bb in bases],
+                             dtype=self.all_data.dtype,
+                             offset_dtype=self.all_data.starts.dtype)
+            for bb, start in zip(bases, ra.starts):
+                loc[bb] = (buf_id, start)
+            host_bufs.append(ra.buf)
+
+        starts = np.zeros_like(self.all_data.starts)
+        buf_ids = np.zeros_like(self.all_data.starts)
+        for sig, idx in self.sidx.items():
+            base = stored_base(sig)
+            if base not in loc:
+                # -- a base only in weight_data (see _drop_bases)
+                continue
+            buf_id, start = loc[base]
+            starts[idx] = start + (self.all_data.starts[idx]
+                                   - self.all_data.starts[self.sidx[base]])
+            buf_ids[idx] = buf_id
+
+        rval = copy.copy(self.all_data)
+        rval.starts = starts
+        rval.buf = host_bufs[0]
+        return rval, host_bufs[1:], buf_ids
+
+    def _weight_data(self):
+        """Copy the read-only gemv A matrices into a weights_dtype array.
+
+        The copy has the same items as all_data, so A_js index it the same
+        way, but only the items viewing one of the copied bases point at
+        valid data.  Returns it and the set of those items.
+        """
+        written = set(sig.base for op in self.operators
+                      for sig in op.sets + op.incs + op.updates)
+        stored_base = lambda sig: self.base_aliases.get(sig.base, sig.base)
+        bases = sim_npy.stable_unique(
+            stored_base(sig) for op_type, ops in self.op_groups for op in ops
+            if op in self._AX_views
+            for sig in self._AX_views[op][0::2]
+            if sig.base not in written)
+        if not bases:
+            return None, set()
+        weights = RaggedArray([self.all_data[self.sidx[bb]] for bb in bases],
+                              offset_dtype=self.all_data.starts.dtype)
+        new_base_starts = dict(zip(bases, weights.starts))
+
+        starts = np.zeros_like(self.all_data.starts)
+        items = set()
+        for sig, idx in self.sidx.items():
+            base = stored_base(sig)
+            if base in new_base_starts:
+                offset = (self.all_data.starts[idx]
+                          - self.all_data.starts[self.sidx[base]])
+                starts[idx] = new_base_starts[base] + offset
+                items.add(idx)
+
+        rval = copy.copy(self.all_data)
+        rval.starts = starts
+        rval.buf = weights.buf
+        return CLRaggedArray(self.queue, rval,
+                             dtype=self.weights_dtype), items
+
+    def _plain_gemv(self, op):
+        """True if MultiProdUpdate `op` has no sparse terms and reads its
+        A matrices from all_data buffer 0 (not a shard or weight_data),
+        as fused plans and megakernels need"""
+        return not (op in self._sparse_AX or self.op_shard(op) != 0
+                    or self._reads_weights(op))
+
+    def _reads_weights(self, op):
+        """True if the gemv terms of `op` read their A matrices from
+        weight_data (see plan_MultiProdUpdate)"""
+        As = self._AX_views.get(op, [])[0::2]
+        return bool(As) and self._weight_items.issuperset(
+            self.sidx[A] for A in As)
+
+    def _weights_only_bases(self):
+        """Return the bases copied to weight_data that nothing reads from
+        all_data: only the A terms of ops that _reads_weights."""
+        stored_base = lambda sig: self.base_aliases.get(sig.base, sig.base)
+        copied = set(stored_base(sig) for sig, idx in self.sidx.items()
+                     if idx in self._weight_items)
+        other = set(stored_base(p.sig) for p in self.model.probes)
+        for op in self.operators:
+            if op in self._AX_views:
+                sigs = self._AX_views[op][1::2] + self._YYB_views[op]
+                sigs += [X for rows, cols, vals, X in
+                         self._sparse_AX.get(op, [])]
+                if not self._reads_weights(op):
+                    sigs += self._AX_views[op][0::2]
+            else:
+                sigs = op.all_signals
+            other.update(stored_base(sig) for sig in sigs)
+        return copied - other
+
+    def _drop_bases(self, bases):
+        """Return all_data without `bases` (on the host, before the upload).
+
+        The items viewing them are left pointing at element 0, so only
+        weight_data can be used for them.
+        """
+        kept = [bb for bb in sorted(self.sidx, key=self.sidx.get)
+                if not sim_npy.isview(bb)
+                and bb not in self.base_aliases and bb not in bases]
+        kept.sort(key=lambda bb: self.all_data.starts[self.sidx[bb]])
+        ra = RaggedArray(
+            [self.all_data[self.sidx[bb]] for bb in kept],
+            dtype=self.all_data.dtype,
+            align=[self.layout_align if bb in self.aligned_bases else 1
+                   for bb in kept],
+            offset_dtype=self.all_data.starts.dtype)
+        new_base_starts = dict(zip(kept, ra.starts))
+        stored_base = lambda sig: self.base_aliases.get(sig.base, sig.base)
+        starts = np.zeros_like(self.all_data.starts)
+        for sig, idx in self.sidx.items():
+            base = stored_base(sig)
+            if base in new_base_starts:
+                starts[idx] = new_base_starts[base] + (
+                    self.all_data.starts[idx]
+                    - self.all_data.starts[self.sidx[base]])
+        rval = copy.copy(self.all_data)
+        rval.starts = starts
+        rval.buf = ra.buf
+        return rval
+
+    def _save_initial_data(self):
+        self._initial_buf = self.all_data.cl_buf.empty_like()
+        cl.enqueue_copy(self.queue, self._initial_buf.data,
+                        self.all_data.cl_buf.data).wait()
+
+    def _copy_all_data(self):
+        # -- the copy shares the device-side views (starts, shapes, etc.)
+        #    and gets a device-to-device copy of the signal data.
+        rval = self.all_data.shallow_copy()
+        rval.cl_buf = self.all_data.cl_buf.empty_like()
+        cl.enqueue_copy(self.queue, rval.cl_buf.data,
+                        self.all_data.cl_buf.data).wait()
+        return rval
+
+    def reset(self):
+        """Restore all signals to their values at the end of the build.
+
+        This is one device-to-device buffer copy: nothing is rebuilt,
+        uploaded or recompiled.
+        """
+        self.queue.finish()
+        cl.enqueue_copy(self.queue, self.all_data.cl_buf.data,
+                        self._initial_buf.data).wait()
+        if hasattr(self, '_cl_probe_plan'):
+            self._cl_probe_plan.cl_countdowns.fill(0)
+            self._cl_probe_plan.cl_bufpositions.fill(0)
+            self.queue.finish()
+        if not self.closed:
+            for plan in self._lookahead_plans:
+                plan.restart(0)
+        self.n_steps = 0
+        self.probe_outputs = dict((probe, []) for probe in self.model.probes)
+
+    def fork(self):
+        """Return a second simulator that continues from the current state.
+
+        The fork shares this simulator's context, queue, view metadata,
+        compiled programs, weight_data and sparse gemv tables.  It owns a
+        copy of buffer 0 of all_data, its own probe buffers and its own
+        kernels and gemv index tables (planned again, for its buffers).
+
+        By default, the A matrices are in buffer 0, so they are copied
+        too.  Build with shared_weights=True to keep the read-only ones in
+        shards, which forks share; the gemvs reading them are then not
+        fused or put into megakernels.
+        """
+        self.queue.finish()
+        return sim_npy.Simulator.fork(self)
+
+    def close(self):
+        """Stop the worker threads of the lookahead plans (see
+        LookaheadPlan) and of sim_npy.Simulator.close."""
+        for plan in self._lookahead_plans:
+            plan.close()
+        sim_npy.Simulator.close(self)
+
+    def memory_report(self):
+        """Return the device bytes allocated by this simulator, by category
+        (see nengo_ocl.memory), and their 'total'.
+
+        `self.memory_estimate` holds the estimate made before the upload.
+        """
+        self.queue.finish()
+        return memory.device_memory(self)
 
     def plan_ragged_gather_gemv(self, *args, **kwargs):
+        A_js = kwargs.get('A_js')
+        if (self._weight_items and kwargs.get('A') is self.all_data
+                and A_js is not None
+                and self._weight_items.issuperset(A_js.buf.ravel())):
+            kwargs['A'] = self.weight_data
+        elif (self.all_data.buf_ids is not None
+                and kwargs.get('A') is self.all_data and A_js is not None):
+            # -- plan_MultiProdUpdate groups ops by shard (see op_shard)
+            buf_id, = set(self.all_data.buf_ids[A_js.buf.ravel()])
+            kwargs['A'] = self.all_data.shard(buf_id)
         return plan_ragged_gather_gemv(self.queue, *args, **kwargs)
 
+    def op_shard(self, op):
+        """The all_data buffer holding the dense A terms of `op`"""
+        if self.all_data.buf_ids is None:
+            return 0
+        return max([self.all_data.buf_ids[self.sidx[A]]
+                    for A in self._AX_views[op][0::2]] + [0])
+
+    def plan_MultiProdUpdate(self, ops):
+        # -- ops left without dense terms only increment Y by sparse ones
+        #    (ops that never had any terms, like Resets, still need a gemv)
+        dense_ops = [op for op in ops
+                     if self._AX_views[op] or op not in self._sparse_AX]
+        plans = []
+        # -- one gemv per buffer the A matrices are read from (see
+        #    plan_ragged_gather_gemv)
+        by_shard = OrderedDict()
+        for op in dense_ops:
+            by_shard.setdefault((self.op_shard(op), self._reads_weights(op)),
+                                []).append(op)
+        for shard_ops in by_shard.values():
+            plans.extend(self.plan_dense_AX(shard_ops))
+        sparse_ops = [op for op in ops if op in self._sparse_AX]
+        if sparse_ops:
+            # -- N.B. these must follow the gemv plans, which may set Y;
+            #    they do, on the in-order queue
+            plans.extend(self.plan_sparse_AX(sparse_ops))
+        return plans
+
+    def plan_sparse_AX(self, ops):
+        """Plan Y += A X for the sparse terms of MultiProdUpdate `ops`.
+
+        Each op's rows go into a CSR or an ELL plan, chosen by the regularity
+        of its row lengths (see clra_sparse_gemv.choose_format).
+        """
+        def elem_indices(sig):
+            idx = self.sidx[sig]
+            return (self.all_data.starts[idx]
+                    + self.all_data.stride0s[idx]
+                    * np.arange(self.all_data.shape0s[idx]))
+
+        by_fmt = {'csr': ([], []), 'ell': ([], [])}
+        for op in ops:
+            y_idx = elem_indices(self._YYB_views[op][0])
+            rows = [([], []) for ii in y_idx]
+            for indptr, cols, vals, X_view in self._sparse_AX[op]:
+                x_idx = elem_indices(X_view)[cols]
+                for rr in range(len(indptr) - 1):
+                    row = slice(indptr[rr], indptr[rr + 1])
+                    rows[rr][0].extend(x_idx[row])
+                    rows[rr][1].extend(vals[row])
+            fmt = choose_format([len(cols) for cols, vals in rows])
+            by_fmt[fmt][0].extend(y_idx)
+            by_fmt[fmt][1].extend(rows)
+
+        plans = []
+        for fmt in ['csr', 'ell']:
+            y_idx, rows = by_fmt[fmt]
+            if rows:
+                key = (fmt,) + tuple(ops)
+                plans.append(plan_sparse_gemv(
+                    self.queue, self.all_data.cl_buf, y_idx,
+                    [(np.asarray(cols, dtype='int64'), np.asarray(vals))
+                     for cols, vals in rows],
+                    fmt, tag='sparse-ProdUpdate-%i' % len(ops),
+                    tables=self._sparse_tables.get(key)))
+                self._sparse_tables[key] = plans[-1].tables
+        return plans
+
     def plan_SimDirect(self, ops):
         ### TODO: test with a hybrid program (Python and OCL)
 
@@ -136,10 +979,11 @@ class Simulator(sim_npy.Simulator):
                     signals_in = signals['in'][:]
                     signals_out = signals['out'][:]
                     def temp_fn():
+                        data = self.all_data
                         for sin, sout in zip(signals_in, signals_out):
-                            x = self.all_data[self.sidx[sin]]
+                            x = data[self.sidx[sin]]
                             y = np.asarray(f(x)).reshape((out_dim, 1))
-                            self.all_data[self.sidx[sout]] = y
+                            data[self.sidx[sout]] = y
                     return temp_fn
 
                 plans.append(PythonPlan(make_temp(), name=fn_name, tag=fn_name))
@@ -150,6 +994,28 @@ class Simulator(sim_npy.Simulator):
         ### TODO: test with a hybrid program (Python and OCL)
         ### TODO: consolidate this logic with plan_Direct above
 
+        # -- constant nodes are folded into the initial signal values
+        is_time_only = lambda op: (
+            op.n_args == 1 and not getattr(op.fn, 'vectorized', False))
+        nonconstant_ops = []
+        for op in ops:
+            value = constant_output(op.fn) if is_time_only(op) else None
+            if value is None:
+                nonconstant_ops.append(op)
+            else:
+                self.all_data[self.sidx[op.output]] = value.reshape(
+                    (op.output.size, 1))
+        ops = nonconstant_ops
+
+        plans = []
+        if self.lookahead or self.stimulus_steps:
+            time_ops = [op for op in ops if is_time_only(op)]
+            ops = [op for op in ops if not is_time_only(op)]
+            if time_ops and self.lookahead:
+                plans.append(self.plan_time_lookahead(time_ops))
+            elif time_ops:
+                plans.append(self.plan_time_table(time_ops))
+
         ### group nonlinearities
         unique_ops = collections.OrderedDict()
         for op in ops:
@@ -162,7 +1028,6 @@ class Simulator(sim_npy.Simulator):
             unique_ops[op_key]['out'].append(op.output)
 
         ### make plans
-        plans = []
         for (fn, n_args), signals in unique_ops.items():
             fn_name = fn.__name__
             if fn_name == "<lambda>":
@@ -174,31 +1039,39 @@ class Simulator(sim_npy.Simulator):
 
             ### Need wrapper function so that variables get copied
             dt = self.model.dt
-            if n_args == 1:
+            if getattr(fn, 'vectorized', False):
+                make_temp = self._vectorized_pyfunc(fn, n_args, signals)
+            elif n_args == 1:
                 def make_temp():
                     f = fn
                     signals_out = signals['out'][:]
+                    clock = self._node_clock()
                     def temp_fn():
-                        t = self.all_data[self.sidx[self._time]][0, 0]
+                        data = self.all_data
+                        t = clock[0] * dt
+                        clock[0] += 1
                         for sout in signals_out:
-                            y = np.asarray(f(t - dt))
+                            y = np.asarray(f(t))
                             if y.ndim == 1:
                                 y = y[:, None]
-                            self.all_data[self.sidx[sout]] = y
+                            data[self.sidx[sout]] = y
                     return temp_fn
             else:
                 def make_temp():
                     f = fn
                     signals_in = signals['in'][:]
                     signals_out = signals['out'][:]
+                    clock = self._node_clock()
                     def temp_fn():
-                        t = self.all_data[self.sidx[self._time]][0, 0]
+                        data = self.all_data
+                        t = clock[0] * dt
+                        clock[0] += 1
                         for sin, sout in zip(signals_in, signals_out):
-                            x = self.all_data[self.sidx[sin]]
-                            y = np.asarray(f(t - dt, x))
+                            x = data[self.sidx[sin]]
+                            y = np.asarray(f(t, x))
                             if y.ndim == 1:
                                 y = y[:, None]
-                            self.all_data[self.sidx[sout]] = y
+                            data[self.sidx[sout]] = y
                     return temp_fn
 
             plans.append(PythonPlan(make_temp(), name=fn_name, tag=fn_name))
@@ -206,6 +1079,101 @@ class Simulator(sim_npy.Simulator):
         return plans
 
 
+    def _node_clock(self):
+        """Return a new step counter ([step]) for a PythonPlan of nodes.
+
+        Nodes get t = step * dt in float64, whatever the dtype of the
+        device's time signal; run_steps sets every counter to n_steps
+        before each batch of steps, and the plan counts the steps in it.
+        """
+        clock = [self.n_steps]
+        self._node_clocks.append(clock)
+        return clock
+
+    def time_function_values(self, ops):
+        """Return produce(step0, n_steps) -> values of SimPyFuncs of time.
+
+        Row `ii` of the returned (n_steps, D) array holds the outputs of all
+        `ops` (concatenated) at step step0 + ii.  N.B. the functions are
+        called with t = step * dt computed on the host in float64, rather
+        than from the device's time signal.
+        """
+        dt = self.model.dt
+        fns = [op.fn for op in ops]
+        D = sum(op.output.size for op in ops)
+
+        def produce(step0, n_steps):
+            rval = np.empty((n_steps, D))
+            for ii in xrange(n_steps):
+                t = (step0 + ii) * dt
+                rval[ii] = np.concatenate(
+                    [np.asarray(fn(t), dtype=np.float64).ravel()
+                     for fn in fns])
+            return rval
+        return produce
+
+    def _vectorized_pyfunc(self, fn, n_args, signals):
+        # -- one read of the time and all inputs, one call, one write
+        dt = self.model.dt
+        in_idxs = [self.sidx[sig] for sig in signals['in']]
+        out_idxs = [self.sidx[sig] for sig in signals['out']]
+        out_shapes = [(sig.size, 1) for sig in signals['out']]
+        def make_temp():
+            clock = self._node_clock()
+            def temp_fn():
+                data = self.all_data
+                t = clock[0] * dt
+                clock[0] += 1
+                if n_args == 2:
+                    X = np.vstack([x.ravel() for x in
+                                   data.get_items(in_idxs)])
+                    Y = fn(t, X)
+                else:
+                    Y = fn(t)
+                Y = np.asarray(Y).reshape((len(out_idxs), -1))
+                data.set_items(
+                    out_idxs,
+                    [y.reshape(shape) for y, shape in zip(Y, out_shapes)])
+            return temp_fn
+        return make_temp
+
+    def plan_time_lookahead(self, ops):
+        """Plan SimPyFuncs of time alone, evaluated ahead on a worker thread.
+        """
+        Y = self.all_data[[self.sidx[op.output] for op in ops]]
+        produce = self.time_function_values(ops)
+        plan = plan_lookahead(self.queue, Y, produce, self.lookahead,
+                              first_step=self.n_steps, tag="lookahead")
+        self._lookahead_plans.append(plan)
+        return plan
+
+    def plan_time_table(self, ops):
+        """Plan SimPyFuncs of time alone, read from a precomputed table.
+        """
+        Y = self.all_data[[self.sidx[op.output] for op in ops]]
+        plan = plan_stimulus_table(self.queue, Y, self.stimulus_steps,
+                                   tag="stimulus_table")
+        self._stimulus_tables.append(
+            (plan, self.time_function_values(ops)))
+        return plan
+
+    def fill_stimulus_tables(self, n_steps):
+        """Make sure the stimulus tables hold the next `n_steps` steps.
+
+        A table that doesn't is refilled from the current step, with as
+        many of the following steps as fit.
+        """
+        step0 = self.n_steps
+        for plan, produce in self._stimulus_tables:
+            if plan.table_range is not None:
+                first, stop = plan.table_range
+                if first <= step0 and step0 + n_steps <= stop:
+                    # -- e.g. after a reset
+                    plan.pos = step0
+                    continue
+            n_rows = max(min(plan.n_rows, n_steps), 1)
+            fill_stimulus_table(plan, step0, produce(step0, n_rows))
+
     def plan_SimLIF(self, ops):
         J = self.all_data[[self.sidx[op.J] for op in ops]]
         V = self.all_data[[self.sidx[op.voltage] for op in ops]]
@@ -215,7 +1183,7 @@ class Simulator(sim_npy.Simulator):
         tau = self.RaggedArray([op.nl.tau_rc for op in ops])
         dt = self.model.dt
         return [plan_lif(self.queue, J, V, W, V, W, S, ref, tau, dt,
-                        tag="lif", upsample=1)]
+                        tag="lif", upsample=sim_npy.lif_upsample(ops))]
 
     def plan_SimLIFRate(self, ops):
         J = self.all_data[[self.sidx[op.J] for op in ops]]
@@ -324,7 +1292,25 @@ class Simulator(sim_npy.Simulator):
     def step(self):
         return self.run_steps(1)
 
+    def _call_n_times(self, n):
+        """Run `n` steps: `steps_per_launch` at a time if the step is one
+        megakernel, otherwise through the DAG"""
+        plan = self._loop_plan
+        if plan is None or self.steps_per_launch == 1:
+            self._dag.call_n_times(n)
+            return
+        while n:
+            plan.set_n_steps(min(n, self.steps_per_launch))
+            ev = plan.enqueue()
+            n -= plan.n_steps
+        ev.wait()
+        plan.set_n_steps(1)
+        if self.profiling:
+            plan.update_from_enqueued_events(self.profiling)
+
     def run_steps(self, N, verbose=False):
+        if self.closed:
+            raise RuntimeError('simulator is closed')
         has_probes = hasattr(self, '_cl_probe_plan')
 
         if has_probes:
@@ -336,7 +1322,12 @@ class Simulator(sim_npy.Simulator):
         #    the probe buffers after each group of B
         while N:
             B = min(N, self._max_steps_between_probes) if has_probes else N
-            self._dag.call_n_times(B)
+            if self._stimulus_tables:
+                B = min(B, self.stimulus_steps)
+                self.fill_stimulus_tables(min(N, self.stimulus_steps))
+            for clock in self._node_clocks:
+                clock[0] = self.n_steps
+            self._call_n_times(B)
             if has_probes:
                 self.drain_probe_buffers()
             N -= B
@@ -0,0 +1,185 @@
+"""
+Run many sim_ocl simulations (e.g. seeds x parameters) in a process pool.
+
+    def make_model(seed, n_neurons):
+        model = nengo.Model('m', seed=seed)
+        ...
+        model.probe(A, filter=0.01)
+        return model, {'A': A}
+
+    for params, data in sweep(make_model,
+                              {'seed': range(10), 'n_neurons': [50, 100]},
+                              run_time=1.0):
+        print params, data['A'].mean()
+
+Each worker process creates one OpenCL context, on one device (or one
+sub-device) from `devices`, and keeps it for all the jobs it runs.  Workers
+share pyopencl's on-disk binary cache through `cache_dir`, so each kernel
+is compiled from source once for the whole sweep, and other workers load
+the binary.  Probe data comes back through numpy memmaps in
+shared memory (/dev/shm where available) instead of being pickled; the
+files are in a directory of their own, removed when the sweep ends.
+
+"""
+import itertools
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pyopencl as cl
+
+from . import plan
+from . import sim_ocl
+
+# -- the context of this worker process (see _init_worker)
+_context = None
+
+
+def expand_grid(grid):
+    """Return a list of parameter dicts.
+
+    `grid` is either a dict mapping names to lists of values (all
+    combinations are returned, in itertools.product order) or a list of
+    parameter dicts (returned as-is).
+    """
+    if isinstance(grid, dict):
+        names = sorted(grid)
+        return [dict(zip(names, values))
+                for values in itertools.product(*[grid[n] for n in names])]
+    return list(grid)
+
+
+def select_devices(devices=None, sub_device_units=None):
+    """Return the list of cl.Devices that workers are spread over.
+
+    `devices` is a list of (platform index, device index) pairs (default:
+    every device of every platform).  If `sub_device_units` is given, each
+    device is partitioned into sub-devices of that many compute units
+    (OpenCL 1.2), e.g. to run several workers side by side on one CPU.
+    """
+    if devices is None:
+        rval = [dev for platform in cl.get_platforms()
+                for dev in platform.get_devices()]
+    else:
+        rval = [cl.get_platforms()[pp].get_devices()[dd]
+                for pp, dd in devices]
+    if sub_device_units:
+        rval = [sub for dev in rval
+                for sub in dev.create_sub_devices(
+                    [cl.device_partition_property.EQUALLY,
+                     sub_device_units])]
+    return rval
+
+
+def _init_worker(devices, sub_device_units, cache_dir, counter):
+    global _context
+    with counter.get_lock():
+        worker_idx = counter.value
+        counter.value += 1
+    all_devices = select_devices(devices, sub_device_units)
+    _context = cl.Context([all_devices[worker_idx % len(all_devices)]])
+    plan.build_cache_dir = cache_dir
+
+
+def _run_job(args):
+    """Run one job, and write its probe data to files in `out_dir`"""
+    (job_idx, params, model_factory, run_time, dt, sim_kwargs,
+     out_dir) = args
+    model, probes = model_factory(**params)
+    sim = sim_ocl.Simulator(model, dt=dt, context=_context, **sim_kwargs)
+    sim.run(run_time)
+    outputs = {}
+    for name, probe in probes.items():
+        data = np.asarray(sim.data(probe))
+        fd, filename = tempfile.mkstemp(
+            prefix='nengo_ocl_sweep_', suffix='.dat', dir=out_dir)
+        os.close(fd)
+        if data.size:
+            buf = np.memmap(filename, dtype=data.dtype, mode='w+',
+                            shape=data.shape)
+            buf[...] = data
+            buf.flush()
+            del buf
+        outputs[name] = (filename, data.shape, data.dtype.str)
+    return job_idx, outputs
+
+
+def _load_outputs(outputs):
+    """Map the files written by _run_job, and unlink them"""
+    rval = {}
+    for name, (filename, shape, dtype) in outputs.items():
+        try:
+            if np.prod(shape):
+                # -- the mapping outlives the file, so unlink it right away
+                rval[name] = np.memmap(filename, dtype=dtype, mode='r',
+                                       shape=shape)
+            else:
+                rval[name] = np.zeros(shape, dtype=dtype)
+        finally:
+            os.unlink(filename)
+    return rval
+
+
+def _imap_jobs(model_factory, points, run_time, dt, devices,
+               sub_device_units, n_workers, cache_dir, shm_dir, sim_kwargs):
+    if n_workers is None:
+        n_workers = len(select_devices(devices, sub_device_units))
+    if shm_dir is None and os.path.isdir('/dev/shm'):
+        shm_dir = '/dev/shm'
+    # -- outputs that are never loaded (the caller stopped early, a job
+    #    failed) are removed with the whole directory at the end
+    out_dir = tempfile.mkdtemp(prefix='nengo_ocl_sweep_', dir=shm_dir)
+    counter = multiprocessing.Value('i', 0)
+    pool = multiprocessing.Pool(
+        n_workers, initializer=_init_worker,
+        initargs=(devices, sub_device_units, cache_dir, counter))
+    try:
+        jobs = [(ii, params, model_factory, run_time, dt, sim_kwargs, out_dir)
+                for ii, params in enumerate(points)]
+        for job_idx, outputs in pool.imap_unordered(_run_job, jobs):
+            yield job_idx, _load_outputs(outputs)
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def isweep(model_factory, grid, run_time, dt=0.001,
+           devices=None, sub_device_units=None, n_workers=None,
+           cache_dir=None, shm_dir=None, **sim_kwargs):
+    """Yield (params, data) for each point of `grid`, as jobs finish.
+
+    `model_factory(**params)` must return (model, probes), where `probes`
+    maps names to probed objects (anything that can be passed to
+    `sim.data`); `data` maps the same names to (read-only, memmapped)
+    arrays of probe data.
+    It must be picklable, i.e. defined at the top level of a module.
+
+    n_workers defaults to one per device (or sub-device).  cache_dir is
+    pyopencl's binary cache directory (default: pyopencl's own), and
+    shm_dir where probe data is staged (default: /dev/shm if it exists).
+    Extra keyword arguments are passed to sim_ocl.Simulator.
+    """
+    points = expand_grid(grid)
+    for job_idx, data in _imap_jobs(
+            model_factory, points, run_time, dt, devices, sub_device_units,
+            n_workers, cache_dir, shm_dir, sim_kwargs):
+        yield points[job_idx], data
+
+
+def sweep(model_factory, grid, run_time, dt=0.001,
+          devices=None, sub_device_units=None, n_workers=None,
+          cache_dir=None, shm_dir=None, **sim_kwargs):
+    """Return a list of (params, data), in the order of expand_grid(grid).
+
+    See isweep for the arguments.
+    """
+    points = expand_grid(grid)
+    results = [None] * len(points)
+    for job_idx, data in _imap_jobs(
+            model_factory, points, run_time, dt, devices, sub_device_units,
+            n_workers, cache_dir, shm_dir, sim_kwargs):
+        results[job_idx] = (points[job_idx], data)
+    return results
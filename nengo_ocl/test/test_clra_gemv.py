@@ -10,6 +10,7 @@ from nengo_ocl.clra_gemv import plan_ragged_gather_gemv
 from nengo_ocl.clra_gemv import plan_many_dots
 from nengo_ocl.clra_gemv import plan_reduce
 from nengo_ocl.clra_gemv import plan_ref
+from nengo_ocl.clra_gemv import bw_from_geometry
 
 import pyopencl as cl
 import logging
@@ -118,6 +119,12 @@ class TestStuff(unittest.TestCase):
             sim = clY[i]
             assert np.allclose(ref, sim, atol=1e-3, rtol=1e-3)
 
+    def test_bw_from_geometry(self):
+        geometry = {0: {'y_len': 3, 'dots': [{'a_shape1': 5}]}}
+        # -- 15 elements of A, then 5 of X, 2 scalars, 3 of Y_in and Y each
+        assert bw_from_geometry(geometry, [0]) == 4 * 15 + 4 * 13
+        assert bw_from_geometry(geometry, [0], elemsize=8) == 4 * 15 + 8 * 13
+
     def test_random_small(self):
         self._test_random(k=4, m=10, n=10)
 
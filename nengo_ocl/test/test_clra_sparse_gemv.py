@@ -0,0 +1,47 @@
+
+import numpy as np
+
+from nengo_ocl.tricky_imports import unittest
+from nengo_ocl.clarray import to_device
+from nengo_ocl.clra_sparse_gemv import plan_sparse_gemv, choose_format
+
+import pyopencl as cl
+
+ctx = cl.create_some_context()
+
+
+class TestSparseGemv(unittest.TestCase):
+
+    def check(self, fmt):
+        rng = np.random.RandomState(5)
+        # -- X is data[0:30], Y is data[40:60]
+        data = rng.randn(60).astype('float32')
+        A = rng.randn(20, 30) * (rng.rand(20, 30) < 0.2)
+        A[3] = 0  # -- an empty row
+        rows = [(np.nonzero(a)[0].astype('int32'), a[np.nonzero(a)[0]])
+                for a in A]
+        y_idx = np.arange(40, 60)
+
+        queue = cl.CommandQueue(ctx)
+        cl_data = to_device(queue, data)
+        plan = plan_sparse_gemv(queue, cl_data, y_idx, rows, fmt)
+        assert plan.nnz == np.count_nonzero(A)
+        plan()
+
+        expected = data.copy()
+        expected[40:60] += np.dot(A, data[:30])
+        assert np.allclose(cl_data.get(queue), expected, atol=1e-5)
+
+    def test_csr(self):
+        self.check('csr')
+
+    def test_ell(self):
+        self.check('ell')
+
+    def test_choose_format(self):
+        assert choose_format([3, 3, 2, 3]) == 'ell'
+        assert choose_format([30, 1, 1, 1]) == 'csr'
+
+
+if __name__ == '__main__':
+   unittest.main()
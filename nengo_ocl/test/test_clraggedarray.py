@@ -60,6 +60,54 @@ class TestCLRaggedArray(unittest.TestCase):
         A, clA = make_random_pair(10, 2)
         s = [1,3,7,8]
         assert ra.allclose(A[s], clA[s].to_host())
+    def test_shards(self):
+        """Items in a second buffer, with (buffer id, offset) addressing"""
+        vals = [np.random.randn(3), np.random.randn(2, 2), np.random.randn(4)]
+        A = RA(vals)
+        A.starts = [0, 3, 1]
+        A.buf = A.buf[:7]
+        shard = np.concatenate([[9.], vals[2]])
+
+        queue = cl.CommandQueue(ctx)
+        clA = CLRA(queue, A, shards=[shard], buf_ids=[0, 0, 1])
+        for ii in range(3):
+            assert np.allclose(np.ravel(vals[ii]), clA[ii].ravel())
+        clA[2] = np.ones((4, 1))
+        got = clA.get_items([0, 2])
+        assert np.allclose(got[0].ravel(), vals[0])
+        assert np.allclose(got[1], 1)
+        assert np.allclose(clA.shard(1).buf, [9, 1, 1, 1, 1])
+        assert np.allclose(clA[[2]].shard(0).buf, clA.buf)
+        assert clA[[1, 2]].buf_ids.tolist() == [0, 1]
+    def test_get_set_items(self):
+        """Several items, one of them strided, in one gather / scatter"""
+        A, clA = make_random_pair(5, 2)
+        m, n = A[1].shape
+        shape1s = clA.shape1s.copy()
+        shape1s[1] = n - 1
+        clA.shape1s = shape1s
+        got = clA.get_items([3, 1])
+        assert np.allclose(got[0], A[3])
+        assert np.allclose(got[1], A[1][:, :-1])
+        clA.set_items([3, 1], [1.0, 2 * np.ones((m, n - 1))])
+        assert np.allclose(clA[3], 1)
+        start = clA.starts[1]
+        full = clA.buf[start:start + m * n].reshape(m, n)
+        assert np.allclose(full[:, :-1], 2)
+        assert np.allclose(full[:, -1], A[1][:, -1])
+        # -- one cached gather and one scatter
+        assert len(clA._gathers) == 2
+        clA.get_items([3, 1])
+        assert len(clA._gathers) == 2
+
+    def test_int64_offsets(self):
+        A, clA = make_random_pair(5, 2)
+        clA = CLRA(clA.queue, A, offset_dtype='int64')
+        assert clA.starts.dtype == np.int64
+        assert clA.ocl_offset_t == 'long'
+        assert clA[[1, 3]].ocl_offset_t == 'long'
+        assert np.allclose(A[3], clA[3])
+        assert np.all(clA.cl_starts.get() == A.starts)
 
 if __name__ == '__main__':
    unittest.main()
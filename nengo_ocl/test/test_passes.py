@@ -0,0 +1,138 @@
+import numpy as np
+
+from nengo_ocl.tricky_imports import unittest
+import nengo
+from nengo_ocl import passes
+from nengo_ocl import sim_npy
+
+
+def make_low_rank_model(rank, n=40):
+    rng = np.random.RandomState(1)
+    transform = np.dot(rng.randn(n, rank), rng.randn(rank, n)) / n
+    model = nengo.Model('low_rank')
+    model.make_node('in', output=lambda t: np.sin(t * np.arange(n)))
+    model.make_node('out', output=lambda t, x: x)
+    model.connect('in', 'out', transform=transform)
+    model.probe('out')
+    return model
+
+
+class TestLowRank(unittest.TestCase):
+    def test_low_rank_factor(self):
+        rng = np.random.RandomState(0)
+        A = np.dot(rng.randn(100, 3), rng.randn(3, 80))
+        U, V = passes.low_rank_factor(A, 1e-6)
+        assert U.shape == (100, 3) and V.shape == (3, 80)
+        assert np.allclose(np.dot(U, V), A)
+        assert passes.low_rank_factor(rng.randn(50, 50), 1e-6) is None
+
+    def test_factored_model_matches(self):
+        model = make_low_rank_model(rank=2)
+        sim = sim_npy.Simulator(model, low_rank_tol=1e-6)
+        report, = sim.low_rank_report
+        assert report['rank'] == 2
+        assert report['elements_after'] == 2 * (40 + 40)
+        sim.run(0.05)
+        ref = sim_npy.Simulator(model)
+        assert ref.low_rank_report is None
+        ref.run(0.05)
+        assert np.allclose(sim.data('out'), ref.data('out'))
+
+
+    def test_column_signal(self):
+        Signal = nengo.builder.Signal
+        rng = np.random.RandomState(3)
+        A = Signal(np.dot(rng.randn(40, 2), rng.randn(2, 40)), name='A')
+        X = Signal(np.ones((40, 1)), name='X')
+        Y = Signal(np.zeros((40, 1)), name='Y')
+        op = sim_npy.MultiProdUpdate(Y, Y, beta=0, gamma=0, tag='',
+                                     as_update=False)
+        op.add_AX(A, X)
+        ops, report = passes.factor_low_rank([op], tol=1e-6, min_size=100)
+        z_op, op2 = ops
+        assert op2 is op and report[0]['rank'] == 2
+        Z = z_op.Y
+        assert Z.shape == (2, 1)
+        assert np.dot(op.As[0].value, Z.value).shape == Y.shape
+        assert np.allclose(
+            np.dot(op.As[0].value, np.dot(z_op.As[0].value, X.value)),
+            np.dot(A.value, X.value))
+
+
+class TestDedupe(unittest.TestCase):
+    def test_dedupe_bases(self):
+        values = {'a': np.ones((2, 3)), 'b': np.ones((2, 3)),
+                  'c': np.ones((3, 2)), 'd': np.ones((2, 3)),
+                  'e': np.zeros((2, 3))}
+        stored, aliases, report = passes.dedupe_bases(
+            ['a', 'b', 'c', 'd', 'e'], values, written=set(['d']))
+        assert stored == ['a', 'c', 'd', 'e']
+        assert aliases == {'b': 'a'}
+        assert report == {'n_merged': 1, 'bytes_saved': 48}
+
+    def test_deduped_model_matches(self):
+        transform = np.random.RandomState(2).randn(10, 10)
+        model = nengo.Model('dedupe')
+        model.make_node('in', output=lambda t: np.sin(t * np.arange(10)))
+        for name in ['out1', 'out2']:
+            model.make_node(name, output=lambda t, x: x)
+            model.connect('in', name, transform=transform)
+            model.probe(name)
+        sim = sim_npy.Simulator(model, dedupe_bases=True)
+        assert sim.dedupe_report['n_merged'] >= 1
+        sim.run(0.05)
+        ref = sim_npy.Simulator(model)
+        ref.run(0.05)
+        assert len(sim.all_data.buf) < len(ref.all_data.buf)
+        for name in ['out1', 'out2']:
+            assert np.allclose(sim.data(name), ref.data(name))
+
+
+class TestLayout(unittest.TestCase):
+    def test_layout_bases(self):
+        Signal = nengo.builder.Signal
+        X = Signal(np.ones(4), name='X')
+        Y1, Y2 = [Signal(np.zeros(3), name=n) for n in ['Y1', 'Y2']]
+        A1, A2 = [Signal(np.ones((3, 4)), name=n) for n in ['A1', 'A2']]
+        ops = []
+        for Y, A in [(Y1, A1), (Y2, A2)]:
+            op = sim_npy.MultiProdUpdate(Y, Y, beta=0, gamma=0, tag='',
+                                         as_update=False)
+            op.add_AX(A, X)
+            ops.append(op)
+        groups = [(sim_npy.MultiProdUpdate, ops)]
+        bases = [A1, Y1, X, A2, Y2]
+        order, aligned = passes.layout_bases(bases, groups,
+                                             written=set([Y1, Y2]))
+        # -- read-only Xs then As, then the written Ys
+        assert order == [X, A1, A2, Y1, Y2]
+        assert aligned == set([X, A1, Y1])
+
+        def packed(bases):
+            sizes = [bb.size for bb in bases]
+            return dict(zip(bases, np.cumsum(sizes) - sizes))
+        assert passes.contiguous_gemv_items(groups, packed(bases)) == (2, 1)
+        assert passes.contiguous_gemv_items(groups, packed(order)) == (2, 2)
+
+    def test_layout_model_matches(self):
+        model = nengo.Model('layout')
+        model.make_node('in', output=np.sin)
+        for name in ['A', 'B', 'C']:
+            model.make_ensemble(name, nengo.LIF(30), 1)
+            model.probe(name, filter=0.01)
+        model.connect('in', 'A')
+        model.connect('A', 'B')
+        model.connect('A', 'C')
+        sim = sim_npy.Simulator(model, optimize_layout=True)
+        report = sim.layout_report
+        assert report['contiguous_after'] >= report['contiguous_before']
+        assert sim_npy.Simulator(model).layout_report is None
+        sim.run(0.05)
+        ref = sim_npy.Simulator(model)
+        ref.run(0.05)
+        for name in ['A', 'B', 'C']:
+            assert np.allclose(sim.data(name), ref.data(name))
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,55 @@
+import numpy as np
+from nengo_ocl.tricky_imports import unittest
+
+from nengo_ocl.ra_gemv import ragged_gather_gemv, sparse_ragged_gather_gemv
+from nengo_ocl.raggedarray import RaggedArray as RA
+
+
+def make_gemv_problem(rng, n_items=5, max_dots=3):
+    """Views of one buffer (like Simulator.all_data), for Y <- AX + bY"""
+    arrays = []
+    A_js, X_js, Y_idxs = [], [], []
+    for ii in range(n_items):
+        M, N = rng.randint(1, 6), rng.randint(1, 3)
+        A_js_i, X_js_i = [], []
+        for jj in range(rng.randint(0, max_dots + 1)):
+            K = rng.randint(1, 6)
+            A_js_i.append(len(arrays))
+            arrays.append(rng.randn(M, K))
+            X_js_i.append(len(arrays))
+            arrays.append(rng.randn(K, N))
+        A_js.append(A_js_i)
+        X_js.append(X_js_i)
+        Y_idxs.append(len(arrays))
+        arrays.append(rng.randn(M, N))
+    data = RA(arrays)
+    # -- Y_in reads each Y base through a strided (column-major) view
+    Y_in_idxs = []
+    for ii in Y_idxs:
+        M, N = data.shape0s[ii], data.shape1s[ii]
+        data.add_views([data.starts[ii]], [M], [N], [1], [M])
+        Y_in_idxs.append(len(data) - 1)
+    return data, RA(A_js), RA(X_js), data[Y_idxs], data[Y_in_idxs]
+
+
+class TestSparseGemv(unittest.TestCase):
+    def test_matches_loop(self):
+        rng = np.random.RandomState(3)
+        for trial in range(10):
+            data, A_js, X_js, Y, Y_in = make_gemv_problem(rng)
+            n = len(Y)
+            beta = rng.randn(n).tolist()
+            gamma = rng.randn(n).tolist()
+            fn = sparse_ragged_gather_gemv(1.0, data, A_js, data, X_js,
+                                           beta, Y, Y_in=Y_in, gamma=gamma)
+            buf0 = data.buf.copy()
+            fn()
+            sparse_buf = data.buf.copy()
+            data.buf[...] = buf0
+            ragged_gather_gemv(1.0, data, A_js, data, X_js,
+                               beta, Y, Y_in=Y_in, gamma=gamma)
+            assert np.allclose(sparse_buf, data.buf)
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,67 @@
+import numpy as np
+from nengo_ocl.tricky_imports import unittest
+
+from nengo_ocl.ra_nonlinearities import lif_step, lif_rate
+
+
+class TestRaNonlinearities(unittest.TestCase):
+    def test_lif_step_vector_params(self):
+        """One call with per-neuron taus matches one call per population"""
+        dt = 1e-3
+        rng = np.random.RandomState(0)
+        sizes = [5, 40, 13]
+        taus = [0.02, 0.05, 0.03]
+        refs = [0.002, 0.001, 0.004]
+        n = sum(sizes)
+        J = rng.normal(scale=3, size=n)
+        V = rng.uniform(size=n)
+        W = rng.uniform(-5 * dt, 5 * dt, size=n)
+        J[0] = V[0]     # -- dV == 0 must not produce nans
+
+        V1, W1, S1 = V.copy(), W.copy(), np.zeros(n)
+        lif_step(dt, J, V1, W1, S1, np.repeat(refs, sizes),
+                 np.repeat(taus, sizes), upsample=1)
+        assert np.all(np.isfinite(W1))
+        assert S1.sum() > 0
+
+        start = 0
+        for size, tau, ref in zip(sizes, taus, refs):
+            sl = slice(start, start + size)
+            V2, W2, S2 = V[sl].copy(), W[sl].copy(), np.zeros(size)
+            lif_step(dt, J[sl], V2, W2, S2, ref, tau, upsample=1)
+            assert np.allclose(V1[sl], V2)
+            assert np.allclose(W1[sl], W2)
+            assert np.all(S1[sl] == S2)
+            start += size
+
+    def test_lif_step_upsample(self):
+        """upsample substeps of dt / upsample, spiking if any of them did"""
+        dt = 1e-3
+        rng = np.random.RandomState(1)
+        n = 50
+        J = rng.normal(loc=5, scale=5, size=n)
+        V = rng.uniform(size=n)
+        W = rng.uniform(-5 * dt, 5 * dt, size=n)
+
+        V1, W1, S1 = V.copy(), W.copy(), np.zeros(n)
+        lif_step(dt, J, V1, W1, S1, 0.002, 0.02, upsample=4)
+
+        V2, W2, S2, any_spike = V.copy(), W.copy(), np.zeros(n), np.zeros(n)
+        for ii in range(4):
+            lif_step(dt / 4, J, V2, W2, S2, 0.002, 0.02, upsample=1)
+            any_spike = np.maximum(any_spike, S2)
+        assert any_spike.sum() > 0
+        assert np.allclose(V1, V2)
+        assert np.allclose(W1, W2)
+        assert np.all(S1 == any_spike)
+
+    def test_lif_rate(self):
+        J = np.array([-1., 0.5, 1., 1.5, 10.])
+        r = lif_rate(1e-3, J, 0.002, 0.02)
+        assert np.all(r[:3] == 0)
+        expected = 1e-3 / (0.002 + 0.02 * np.log1p(1. / (J[3:] - 1)))
+        assert np.allclose(r[3:], expected)
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,59 @@
+import numpy as np
+from nengo_ocl.tricky_imports import unittest
+
+from nengo_ocl import raggedarray as ra
+RA = ra.RaggedArray
+
+
+class TestRaggedArray(unittest.TestCase):
+    def test_construction(self):
+        vals = [np.random.randn(), np.random.randn(5),
+                np.random.randn(3, 4), [], np.random.randn(2, 1)]
+        A = RA(vals)
+        assert A.dtype == np.float64
+        assert A.starts.tolist() == [0, 1, 6, 18, 18]
+        assert len(A.buf) == 20
+        for ii in [0, 1, 2, 4]:
+            assert np.all(np.asarray(vals[ii]).reshape(A[ii].shape) == A[ii])
+        assert A[3] == []
+
+    def test_dtype(self):
+        """Construction in a target dtype, and promotion without one"""
+        vals = [np.random.randn(3, 4), np.random.randn(7)]
+        A = RA(vals, dtype=np.float32)
+        assert A.dtype == np.float32
+        assert np.allclose(A[0], vals[0])
+        assert RA([[1, 2], [3]]).dtype.kind == 'i'
+        assert RA([[], [1, 2]]).dtype.kind == 'i'
+        assert RA([[1], [1.5]]).dtype == np.float64
+
+    def test_add_views(self):
+        A = RA([np.arange(12.).reshape(3, 4), np.arange(5.)])
+        A.add_views(starts=[1, 12], shape0s=[3, 2], shape1s=[1, 1],
+                    stride0s=[4, 2], stride1s=[1, 1], names=['col1', 'ev'])
+        assert len(A) == 4
+        assert A.starts.dtype == np.int32
+        assert np.all(A[2].ravel() == [1, 5, 9])
+        assert np.all(A[3].ravel() == [0, 2])
+        B = A[[3, 0]]
+        assert B.names == ['ev', '']
+        assert np.all(B[0] == A[3])
+
+    def test_align(self):
+        vals = [np.ones(3), np.ones((2, 2)), np.ones(5), np.ones(1)]
+        A = RA(vals, align=[1, 4, 1, 8])
+        assert A.starts.tolist() == [0, 4, 8, 16]
+        assert len(A.buf) == 17
+        assert A.buf.sum() == 13
+        for ii in range(4):
+            assert np.all(np.asarray(vals[ii]).reshape(A[ii].shape) == A[ii])
+    def test_offset_dtype(self):
+        A = RA([np.ones(3), np.ones(2)], offset_dtype='int64')
+        assert A.starts.dtype == np.int64
+        A.add_views(starts=[1], shape0s=[2], shape1s=[1],
+                    stride0s=[1], stride1s=[1])
+        assert A.starts.dtype == np.int64
+        assert RA([np.ones(3)]).starts.dtype == np.int32
+
+if __name__ == '__main__':
+   unittest.main()
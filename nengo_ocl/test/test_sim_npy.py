@@ -9,9 +9,14 @@ $ python test/test_sim_npy.py test_ensemble.TestEnsemble.test_lifrate
 
 """
 
-from nengo_ocl.tricky_imports import unittest
+import time
+
+import numpy as np
+
+from nengo_ocl.tricky_imports import unittest, OrderedDict
 from nengo.tests.helpers import NengoTestLoader
 from nengo.tests.helpers import load_nengo_tests
+import nengo
 import nengo.tests.test_simulator
 from nengo_ocl import sim_npy
 
@@ -31,6 +36,158 @@ class TestNonlinear(nengo.tests.test_simulator.TestNonlinear):
     Simulator = sim_npy.Simulator
 
 
+def make_trial_model():
+    model = nengo.Model('trial')
+    model.make_node('in', output=np.sin)
+    A = model.make_ensemble('A', nengo.LIF(40), 1)
+    model.connect('in', 'A')
+    model.probe(A, filter=0.01)
+    return model, A
+
+
+class TestReset(unittest.TestCase):
+    Simulator = sim_npy.Simulator
+
+    def test_reset(self):
+        model, A = make_trial_model()
+        sim = model.simulator(sim_class=self.Simulator)
+        sim.run(0.1)
+        first = sim.data(A)
+        sim.reset()
+        assert sim.n_steps == 0
+        sim.run(0.1)
+        assert np.allclose(first, sim.data(A))
+
+    def test_fork(self):
+        model, A = make_trial_model()
+        sim = model.simulator(sim_class=self.Simulator)
+        sim.run(0.05)
+        sim2 = sim.fork()
+        sim.run(0.05)
+        sim2.run(0.05)
+        assert np.allclose(sim.data(A), sim2.data(A))
+
+
+class TestBuildReport(unittest.TestCase):
+    Simulator = sim_npy.Simulator
+
+    def test_build_report(self):
+        model, A = make_trial_model()
+        sim = self.Simulator(model, build_report=True)
+        report = sim.build_report
+        for phase in ['builder', 'convert', 'dependency_graph', 'planner',
+                      'allocate', 'views', 'prep_all_data', 'plan']:
+            assert report['phases'][phase]['time'] >= 0
+            assert report['phases'][phase]['maxrss_mb'] > 0
+        assert 'probes' in report['op_types']
+        assert report['total_time'] >= report['phases']['plan']['time']
+        assert self.Simulator(model).build_report is None
+
+
+class TestSparseGemvEngine(unittest.TestCase):
+    def test_matches_loop(self):
+        model, A = make_trial_model()
+        sim = sim_npy.Simulator(model)
+        sim_sparse = sim_npy.Simulator(model, gemv_engine='sparse')
+        sim.run(0.1)
+        sim_sparse.run(0.1)
+        assert np.allclose(sim.data(A), sim_sparse.data(A))
+
+
+def make_sparse_model():
+    # -- a 20x20 transform with about 10% nonzeros
+    rng = np.random.RandomState(3)
+    transform = rng.randn(20, 20) * (rng.rand(20, 20) < 0.1)
+    model = nengo.Model('sparse')
+    model.make_node('in', output=lambda t: np.sin(t * np.arange(20)))
+    model.make_node('out', output=lambda t, x: x)
+    model.connect('in', 'out', transform=transform)
+    model.probe('out')
+    return model
+
+
+class TestSparseTerms(unittest.TestCase):
+    def test_matches_dense(self):
+        class SparseSimulator(sim_npy.Simulator):
+            sparse_density = 0.2
+
+        model = make_sparse_model()
+        sim = SparseSimulator(model, n_threads=2)
+        assert len(sim._sparse_AX) > 0
+        for terms in sim._sparse_AX.values():
+            for indptr, cols, vals, X_view in terms:
+                assert indptr.dtype == cols.dtype == np.int32
+                assert indptr[-1] == len(cols) == len(vals)
+        with sim:
+            sim.run(0.05)
+        ref = sim_npy.Simulator(model)
+        ref.run(0.05)
+        assert np.allclose(sim.data('out'), ref.data('out'))
+
+
+class TestThreads(unittest.TestCase):
+    def test_op_group_dependencies(self):
+        class Op(object):
+            def __init__(self, reads=(), sets=(), incs=(), updates=()):
+                self.reads, self.sets = list(reads), list(sets)
+                self.incs, self.updates = list(incs), list(updates)
+        a, b, c = [nengo.builder.Signal(np.zeros(2)) for ii in range(3)]
+        groups = [(Op, [Op(reads=[a], sets=[b])]),
+                  (Op, [Op(reads=[a], sets=[c])]),
+                  (Op, [Op(incs=[b]), Op(reads=[c])]),
+                  (Op, [Op(updates=[a])])]
+        deps = sim_npy.op_group_dependencies(groups)
+        assert deps == [[], [], [0, 1], [0, 1]]
+
+    def test_matches_sequential(self):
+        model, A = make_trial_model()
+        sim = sim_npy.Simulator(model)
+        with sim_npy.Simulator(model, n_threads=3) as sim_threaded:
+            sim.run(0.1)
+            sim_threaded.run(0.1)
+            assert np.all(sim.data(A) == sim_threaded.data(A))
+            assert len(sim_threaded.thread_utilization()) == 3
+            threads = sim_threaded._executor._threads
+        assert not any(thread.is_alive() for thread in threads)
+        self.assertRaises(RuntimeError, sim_threaded.run, 0.01)
+
+    def test_nodes_do_not_wait_for_time(self):
+        # -- nodes take their time from the host, not the time signal
+        model, A = make_trial_model()
+        sim = sim_npy.Simulator(model)
+        deps = sim_npy.op_group_dependencies(sim.op_groups, sim.extra_reads)
+        time_writers = set(
+            ii for ii, (op_type, ops) in enumerate(sim.op_groups)
+            if any(sig.base is sim._time.base
+                   for op in ops for sig in op.sets + op.incs))
+        assert time_writers
+        for ii, (op_type, ops) in enumerate(sim.op_groups):
+            if op_type.__name__ == 'SimPyFunc':
+                assert not time_writers.intersection(deps[ii])
+
+    def test_error_waits_for_running_plans(self):
+        log = []
+        def fail(profiling):
+            # -- (after `slow` has started on the other thread)
+            time.sleep(0.05)
+            raise ValueError('fail')
+        def slow(profiling):
+            time.sleep(0.2)
+            log.append('slow')
+        def after(profiling):
+            log.append('after')
+        dag = sim_npy.ThreadedDAG(
+            OrderedDict([(fail, []), (slow, []), (after, [slow])]), 2)
+        try:
+            self.assertRaises(ValueError, dag)
+            # -- the running plan finished, and its client never started
+            assert log == ['slow']
+            time.sleep(0.1)
+            assert log == ['slow']
+        finally:
+            dag.close()
+
+
 load_tests = load_nengo_tests(sim_npy.Simulator)
 
 if __name__ == '__main__':
@@ -9,10 +9,17 @@ $ python test/test_sim_ocl.py test_ensemble.TestEnsemble.test_lifrate
 
 """
 
+import numpy as np
+
 from nengo_ocl.tricky_imports import unittest
 from nengo.tests.helpers import NengoTestLoader
 from nengo.tests.helpers import load_nengo_tests
+from nengo_ocl import megakernel
+from nengo_ocl import memory
+from nengo_ocl import plan as plan_module
+from nengo_ocl import sim_npy
 from nengo_ocl import sim_ocl
+from nengo_ocl.plan import PythonPlan
 
 import pyopencl as cl
 
@@ -28,6 +35,473 @@ from nengo.tests.test_simulator import TestSimulator, TestNonlinear
 TestSimulator.Simulator = staticmethod(Ocl2Simulator)
 TestNonlinear.Simulator = staticmethod(Ocl2Simulator)
 
+from nengo_ocl.test import test_sim_npy
+
+# -- state read by node functions, which must not be folded as constants
+_state = {'x': 0.0}
+
+
+def plan_args(sim):
+    """The device arrays bound to the kernels of `sim`'s plans"""
+    return [arr for p in sim._plandict for arr in getattr(p, 'full_args', ())]
+
+
+def assert_runs_match(sim, ref, probes, t=0.1, atol=1e-4):
+    """Run `sim` and the reference simulator `ref` for `t` seconds, and
+    check that the data of `probes` (probes or their targets) agree"""
+    sim.run(t)
+    ref.run(t)
+    for probe in probes:
+        assert np.allclose(sim.data(probe), ref.data(probe), atol=atol), probe
+
+
+class TestReset(test_sim_npy.TestReset):
+    Simulator = staticmethod(Ocl2Simulator)
+
+    def test_fork_reuses_programs(self):
+        model, A = test_sim_npy.make_trial_model()
+        sim = Ocl2Simulator(model)
+        assert sim._programs
+        log = []
+        old_log, plan_module.compile_log = plan_module.compile_log, log
+        try:
+            sim.fork()
+        finally:
+            plan_module.compile_log = old_log
+        assert log and all(k['cached'] for k in log)
+        # -- the cache belongs to the simulators, not the module
+        assert plan_module.program_cache is None
+
+    def test_fork_shares_weights(self):
+        model, A = test_sim_npy.make_trial_model()
+        sim = Ocl2Simulator(model, shared_weights=True)
+        assert sim.all_data.shard_bufs
+        sim.run(0.05)
+        sim2 = sim.fork()
+        assert sim2.all_data.cl_buf is not sim.all_data.cl_buf
+        for buf, buf2 in zip(sim.all_data.shard_bufs,
+                             sim2.all_data.shard_bufs):
+            assert buf is buf2
+        sim.run(0.05)
+        sim2.run(0.05)
+        assert np.allclose(sim.data(A), sim2.data(A))
+        ref = Ocl2Simulator(model)
+        ref.run(0.1)
+        assert np.allclose(sim.data(A), ref.data(A), atol=1e-5)
+
+
+class TestBuildReport(test_sim_npy.TestBuildReport):
+    Simulator = staticmethod(Ocl2Simulator)
+
+
+class TestHybrid(unittest.TestCase):
+    def test_python_node_matches_sim_npy(self):
+        # -- np.sin runs as a PythonPlan between OCL kernels
+        model, A = test_sim_npy.make_trial_model()
+        sim = model.simulator(sim_class=Ocl2Simulator)
+        assert any(isinstance(p, PythonPlan) for p in sim._plandict)
+        ref = model.simulator(sim_class=test_sim_npy.sim_npy.Simulator)
+        assert_runs_match(sim, ref, [A])
+        # -- the host transfers are ordered with the kernels by the queue
+        assert sim.all_data.queue is sim.queue
+
+    def test_node_time_is_float64(self):
+        ts = []
+        def record(t):
+            ts.append(t)
+            return [np.sin(t)]
+        model = test_sim_npy.nengo.Model('time')
+        model.make_node('in', output=record)
+        model.probe('in')
+        sim = Ocl2Simulator(model)
+        del ts[:]
+        sim.run(0.1)
+        sim.run(0.1)
+        # -- exactly, although the device's time signal is float32
+        assert ts == [ii * sim.model.dt for ii in range(200)]
+
+
+class TestLookahead(unittest.TestCase):
+    def test_matches_synchronous(self):
+        model, A = test_sim_npy.make_trial_model()
+        sim = Ocl2Simulator(model, lookahead=7)
+        assert len(sim._lookahead_plans) == 1
+        assert not any(isinstance(p, PythonPlan) for p in sim._plandict)
+        ref = Ocl2Simulator(model)
+        assert_runs_match(sim, ref, [A])
+
+        sim.reset()
+        sim.run(0.1)
+        assert np.allclose(sim.data(A), ref.data(A), atol=1e-4)
+
+        fork = sim.fork()
+        threads = [plan._thread for s in [sim, fork]
+                   for plan in s._lookahead_plans]
+        assert len(threads) == 2
+        for s in [sim, fork]:
+            s.close()
+        assert not any(thread.is_alive() for thread in threads)
+        self.assertRaises(RuntimeError, sim.run, 0.01)
+
+
+class TestStimulus(unittest.TestCase):
+    def test_constant_output(self):
+        assert np.all(sim_ocl.constant_output(lambda t: [0., 1., -2.])
+                      == [0., 1., -2.])
+        # -- a closure variable could be changed between steps
+        a = np.arange(3.)
+        assert sim_ocl.constant_output(lambda t: a) is None
+        assert sim_ocl.constant_output(lambda t: _state['x']) is None
+        assert sim_ocl.constant_output(lambda t: np.sin(t)) is None
+        assert sim_ocl.constant_output(lambda t: t) is None
+        assert sim_ocl.constant_output(np.sin) is None
+
+    def test_constant_node_is_folded(self):
+        model = test_sim_npy.nengo.Model('constant')
+        model.make_node('in', output=lambda t: [0.5])
+        A = model.make_ensemble('A', test_sim_npy.nengo.LIF(40), 1)
+        model.connect('in', 'A')
+        model.probe(A, filter=0.01)
+        sim = model.simulator(sim_class=Ocl2Simulator)
+        assert not any(isinstance(p, PythonPlan) for p in sim._plandict)
+        ref = model.simulator(sim_class=test_sim_npy.sim_npy.Simulator)
+        assert_runs_match(sim, ref, [A])
+
+    def test_global_state_is_not_folded(self):
+        model = test_sim_npy.nengo.Model('global')
+        model.make_node('in', output=lambda t: [_state['x']])
+        model.probe('in')
+        _state['x'] = 0.5
+        sim = model.simulator(sim_class=Ocl2Simulator)
+        sim.run(0.05)
+        _state['x'] = -1.0
+        sim.run(0.05)
+        data = sim.data('in')
+        assert np.allclose(data[40:50], 0.5, atol=0.05)
+        assert np.allclose(data[-10:], -1.0, atol=0.05)
+
+    def test_table_matches_synchronous(self):
+        # -- 100 steps with a 30-step table: refilled 3 times
+        model, A = test_sim_npy.make_trial_model()
+        sim = Ocl2Simulator(model, stimulus_steps=30)
+        assert len(sim._stimulus_tables) == 1
+        assert not any(isinstance(p, PythonPlan) for p in sim._plandict)
+        ref = Ocl2Simulator(model)
+        assert_runs_match(sim, ref, [A])
+
+    def test_table_with_step_update_first(self):
+        # -- the table's row must not depend on whether the step counter
+        #    was updated earlier in the step
+        def step_first(operators, *args, **kwargs):
+            groups = sim_npy.greedy_planner(operators, *args, **kwargs)
+            rval = []
+            for op_type, ops in groups:
+                is_step = [getattr(op.Y.base, 'name', '') == 'step'
+                           if hasattr(op, 'Y') else False for op in ops]
+                if any(is_step):
+                    rval.insert(0, (op_type, [op for op, s in
+                                              zip(ops, is_step) if s]))
+                    ops = [op for op, s in zip(ops, is_step) if not s]
+                if ops:
+                    rval.append((op_type, ops))
+            return rval
+
+        model, A = test_sim_npy.make_trial_model()
+        sim = Ocl2Simulator(model, stimulus_steps=30, planner=step_first)
+        assert getattr(sim.op_groups[0][1][0].Y.base, 'name', '') == 'step'
+        assert len(sim._stimulus_tables) == 1
+        ref = Ocl2Simulator(model)
+        assert_runs_match(sim, ref, [A])
+
+
+class TestVectorized(unittest.TestCase):
+    def make_model(self, square):
+        nengo = test_sim_npy.nengo
+        model = nengo.Model('vectorized')
+        model.make_node('in', output=np.sin)
+        probes = []
+        for ii in range(3):
+            A = model.make_ensemble('A%d' % ii, nengo.LIF(40), 1)
+            model.make_node('sq%d' % ii, output=square)
+            model.connect('in', 'A%d' % ii)
+            model.connect('A%d' % ii, 'sq%d' % ii)
+            probes.append(model.probe('sq%d' % ii, filter=0.01))
+        return model
+
+    def test_matches_plain_function(self):
+        calls = []
+        @sim_ocl.vectorized
+        def square(t, X):
+            calls.append(X.shape)
+            return X ** 2
+        model = self.make_model(square)
+        sim = model.simulator(sim_class=Ocl2Simulator)
+        del calls[:]
+        ref_model = self.make_model(lambda t, x: x ** 2)
+        ref = ref_model.simulator(sim_class=Ocl2Simulator)
+        assert_runs_match(sim, ref, ['sq%d' % ii for ii in range(3)])
+        # -- one call per step, for all three nodes
+        assert calls == [(3, 1)] * 100
+
+
+class TestFloat64(unittest.TestCase):
+    def test_matches_sim_npy(self):
+        if not all('cl_khr_fp64' in dev.extensions for dev in ctx.devices):
+            raise unittest.SkipTest('no float64 support')
+        model, A = test_sim_npy.make_trial_model()
+        sim = Ocl2Simulator(model, dtype=np.float64)
+        assert sim.all_data.dtype == np.float64
+        assert all(arr.dtype != np.float32 for arr in plan_args(sim))
+        ref = model.simulator(sim_class=test_sim_npy.sim_npy.Simulator)
+        assert_runs_match(sim, ref, [A], atol=1e-8)
+
+    def test_bad_dtype(self):
+        model, A = test_sim_npy.make_trial_model()
+        self.assertRaises(ValueError, Ocl2Simulator, model, dtype=np.int32)
+
+
+class TestHalfWeights(unittest.TestCase):
+    def test_close_to_float32(self):
+        model, A = test_sim_npy.make_trial_model()
+        sim = Ocl2Simulator(model, weights_dtype=np.float16)
+        assert sim.weight_data.dtype == np.float16
+        # -- some gemv reads its A matrices from the float16 copy
+        assert any(arr is sim.weight_data.cl_buf for arr in plan_args(sim))
+        sim.run(0.1)
+        ref = Ocl2Simulator(model)
+        ref.run(0.1)
+        report = sim_ocl.probe_error_report(sim, ref)
+        assert len(report) == len(model.probes)
+        for row in report:
+            assert row['rms_err'] <= 0.05 * row['rms_ref'] + 1e-6, row
+
+        # -- the float32 weights are not kept in all_data as well
+        assert sim.weights_only_bases
+        assert sim.all_data.cl_buf.size < ref.all_data.cl_buf.size
+        assert sim.memory_report()['total'] < ref.memory_report()['total']
+
+
+class TestSparse(unittest.TestCase):
+    def test_matches_dense(self):
+        model = test_sim_npy.make_sparse_model()
+        sim = Ocl2Simulator(model, sparse_density=0.2)
+        assert len(sim._sparse_AX) > 0
+        assert any(p.name.startswith('cl_sparse_gemv') for p in sim._plandict)
+        ref = Ocl2Simulator(model)
+        assert not any(p.name.startswith('cl_sparse_gemv')
+                       for p in ref._plandict)
+        assert_runs_match(sim, ref, ['out'], t=0.05, atol=1e-5)
+        # -- a fork reuses the uploaded sparse tables
+        fork = sim.fork()
+        sparse = lambda s: [p for p in s._plandict if hasattr(p, 'tables')]
+        assert len(sparse(fork)) == len(sparse(sim)) > 0
+        for p, p2 in zip(sparse(sim), sparse(fork)):
+            assert p2.tables is p.tables
+
+
+class TestMemory(unittest.TestCase):
+    def test_report_matches_estimate(self):
+        model, A = test_sim_npy.make_trial_model()
+        sim = Ocl2Simulator(model)
+        report = sim.memory_report()
+        estimate = sim.memory_estimate
+        for cat in ['neuron_state', 'snapshot', 'probe_buffers']:
+            assert report[cat] == estimate[cat] > 0, cat
+        # -- plus e.g. the gemv plans' beta arrays
+        assert report['weights'] >= estimate['weights'] > 0
+        assert report['total'] == sum(report[cat]
+                                      for cat in memory.CATEGORIES)
+        assert report['gemv_tables'] > 0
+
+    def test_check_fits(self):
+        class Device(object):
+            name = 'tiny'
+            global_mem_size = 1000
+            max_mem_alloc_size = 100
+        estimate = dict((cat, 0) for cat in memory.CATEGORIES)
+        estimate.update(weights=90, total=90, largest_buffer=90)
+        memory.check_fits(estimate, Device())
+        estimate.update(largest_buffer=200)
+        self.assertRaises(MemoryError, memory.check_fits, estimate, Device())
+        # -- e.g. before all_data is sharded
+        memory.check_fits(estimate, Device(), largest_buffer=False)
+
+
+class TestShards(unittest.TestCase):
+    def make_model(self):
+        nengo = test_sim_npy.nengo
+        rng = np.random.RandomState(4)
+        model = nengo.Model('shards')
+        model.make_node('in', output=lambda t: np.sin(t * np.arange(20)))
+        for name in ['out1', 'out2', 'out3']:
+            model.make_node(name, output=lambda t, x: x)
+            model.connect('in', name, transform=rng.randn(20, 20))
+            model.probe(name)
+        return model
+
+    def test_matches_unsharded(self):
+        model = self.make_model()
+        # -- room for one 20x20 float32 transform per shard
+        sim = Ocl2Simulator(model, max_buffer_bytes=4 * 450)
+        assert len(sim.all_data.shard_bufs) >= 3
+        # -- the gemvs read their A matrices from the shards
+        args = plan_args(sim)
+        for buf in sim.all_data.shard_bufs:
+            assert any(arr is buf for arr in args)
+        ref = Ocl2Simulator(model)
+        assert ref.all_data.buf_ids is None
+        assert_runs_match(sim, ref, ['out1', 'out2', 'out3'], t=0.05,
+                          atol=1e-5)
+        report = sim.memory_report()
+        assert report['weights'] >= 3 * 4 * 400
+
+    def test_device_alloc_limit(self):
+        # -- the device's max_mem_alloc_size (not max_buffer_bytes) is what
+        #    all_data exceeds, so the build must shard rather than fail
+        class Device(object):
+            name = 'small-alloc'
+            global_mem_size = ctx.devices[0].global_mem_size
+            max_mem_alloc_size = 4 * 450
+
+        class SmallAllocSimulator(sim_ocl.Simulator):
+            def memory_devices(self):
+                return [Device()]
+
+        model = self.make_model()
+        sim = SmallAllocSimulator(model, context=ctx, n_prealloc_probes=5)
+        assert len(sim.all_data.shard_bufs) >= 3
+        assert sim.memory_estimate['largest_buffer'] <= 4 * 450
+        ref = Ocl2Simulator(model)
+        assert_runs_match(sim, ref, ['out1', 'out2', 'out3'], t=0.05,
+                          atol=1e-5)
+
+
+class TestOffsets(unittest.TestCase):
+    def test_64_matches_32(self):
+        model, A = test_sim_npy.make_trial_model()
+        sim = Ocl2Simulator(model, offset_bits=64)
+        assert sim.all_data.starts.dtype == np.int64
+        # -- the kernels get 64-bit starts
+        assert any(arr is sim.all_data.cl_starts for arr in plan_args(sim))
+        ref = Ocl2Simulator(model)
+        assert ref.offset_bits == 32
+        assert ref.all_data.starts.dtype == np.int32
+        assert_runs_match(sim, ref, [A], atol=1e-8)
+
+
+class TestFusion(unittest.TestCase):
+    def test_matches_unfused(self):
+        nengo = test_sim_npy.nengo
+        model = nengo.Model('fusion')
+        model.make_node('in', output=np.sin)
+        model.make_ensemble('A', nengo.LIF(200), 1)
+        model.make_ensemble('B', nengo.LIF(50), 1)
+        model.connect('in', 'A')
+        model.connect('A', 'B')
+        model.probe('A', filter=0.01)
+        model.probe('B', filter=0.01)
+        sim = Ocl2Simulator(model, fuse_lif_gemv=True)
+        assert sim.fusion_report['n_gemv_ops'] >= 2
+        assert any(p.name == 'clra_fusion.lif_gemv' for p in sim._plandict)
+        ref = Ocl2Simulator(model)
+        assert ref.fusion_report['n_gemv_ops'] == 0
+        assert_runs_match(sim, ref, ['A', 'B'], t=0.2, atol=1e-3)
+
+
+class TestMegakernel(unittest.TestCase):
+    def test_hybrid_matches(self):
+        model, A = test_sim_npy.make_trial_model()
+        sim = Ocl2Simulator(model, megakernel=True)
+        assert sim.megakernel_report['n_megakernels'] >= 1
+        assert not sim.megakernel_report['whole_step']
+        assert any(p.name == 'megakernel' for p in sim._plandict)
+        assert any(isinstance(p, PythonPlan) for p in sim._plandict)
+        ref = Ocl2Simulator(model)
+        assert ref.megakernel_report is None
+        assert_runs_match(sim, ref, [A])
+
+    def test_steps_per_launch(self):
+        nengo = test_sim_npy.nengo
+        model = nengo.Model('megakernel')
+        model.make_node('in', output=lambda t: [0.5])
+        model.make_ensemble('A', nengo.LIF(50), 1)
+        model.make_ensemble('B', nengo.LIFRate(20), 1)
+        model.connect('in', 'A')
+        model.connect('A', 'B')
+        model.probe('A', filter=0.01)
+        model.probe('B', filter=0.01)
+        ref = Ocl2Simulator(model)
+        sim = Ocl2Simulator(model, megakernel=True, steps_per_launch=7,
+                            n_prealloc_probes=50)
+        report = sim.megakernel_report
+        assert report['n_megakernels'] == 1
+        assert report['n_other_plans'] == 0
+        assert report['whole_step']
+        assert sim._loop_plan is not None
+        assert [p.name for p in sim._plandict] == ['megakernel']
+        assert_runs_match(sim, ref, ['A', 'B'], t=0.2)
+        assert sim.n_steps == 200
+
+        self.assertRaises(ValueError, Ocl2Simulator,
+                          test_sim_npy.make_trial_model()[0],
+                          megakernel=True, steps_per_launch=7)
+
+    def test_islands(self):
+        nengo = test_sim_npy.nengo
+        model = nengo.Model('islands')
+        for name in ['A', 'B']:
+            model.make_node(name + 'in', output=lambda t: [0.3])
+            model.make_ensemble(name, nengo.LIF(30), 1)
+            model.connect(name + 'in', name)
+            model.connect(name, name, filter=0.05)
+            model.probe(name, filter=0.01)
+        ref = Ocl2Simulator(model)
+        sim = Ocl2Simulator(model, megakernel=True, steps_per_launch=10)
+        # -- A, B and the step and time signals
+        assert sim.megakernel_report['n_islands'] >= 3
+        assert sim._loop_plan.n_islands == sim.megakernel_report['n_islands']
+        assert_runs_match(sim, ref, ['A', 'B'])
+
+    def test_find_islands(self):
+        class Sig(object):
+            def __init__(self):
+                self.base = self
+
+        class Op(object):
+            def __init__(self, *sigs):
+                self.all_signals = sigs
+
+        a, b, c, w = Sig(), Sig(), Sig(), Sig()
+        ops = [Op(a, w), Op(b, w), Op(a, c), Op(c)]
+        islands, base_islands = megakernel.find_islands(ops, set([a, b, c]))
+        assert islands == [[ops[0], ops[2], ops[3]], [ops[1]]]
+        assert base_islands == {a: 0, b: 1, c: 0}
+        assert megakernel.stage_levels([0, 2, 3], [[], [0], [0], [2]]) \
+            == [0, 1, 2]
+
+
+class TestSmallOps(unittest.TestCase):
+    def test_matches(self):
+        model, A = test_sim_npy.make_trial_model()
+        sim = Ocl2Simulator(model, small_ops_size=64)
+        report = sim.small_ops_report
+        assert report['n_kernels'] >= 1
+        assert report['n_groups'] > report['n_kernels']
+        small = [p for p in sim._plandict
+                 if str(getattr(p, 'tag', '')).startswith('small-ops')]
+        assert len(small) == report['n_kernels']
+        ref = Ocl2Simulator(model)
+        assert ref.small_ops_report is None
+        assert_runs_match(sim, ref, [A])
+
+    def test_small_groups(self):
+        # -- 1, 3, 4 and 5 are one layer, but 3 waits on 2, which comes
+        #    after 1, and 5 is too big
+        sizes = [None, 1, None, 1, 2, 100]
+        deps = [[], [0], [], [2], [0], [0]]
+        assert megakernel.small_groups(sizes, deps, 10) == {1: [1, 4]}
+
+
 load_tests = load_nengo_tests(Ocl2Simulator)
 
 
@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from nengo_ocl.tricky_imports import unittest
+from nengo_ocl import sim_ocl
+from nengo_ocl import sweep
+from nengo_ocl.test import test_sim_npy
+
+import pyopencl as cl
+
+ctx = cl.create_some_context()
+
+
+def make_model():
+    model, A = test_sim_npy.make_trial_model()
+    return model, {'A': A}
+
+
+class TestSweep(unittest.TestCase):
+    def test_expand_grid(self):
+        points = sweep.expand_grid({'b': [1, 2], 'a': ['x', 'y', 'z']})
+        assert len(points) == 6
+        assert points[0] == {'a': 'x', 'b': 1}
+        assert points[1] == {'a': 'x', 'b': 2}
+        assert points[-1] == {'a': 'z', 'b': 2}
+        listed = [{'a': 1}, {'a': 3, 'b': 0}]
+        assert sweep.expand_grid(listed) == listed
+        assert sweep.expand_grid({}) == [{}]
+
+    def test_outputs_round_trip(self):
+        out_dir = tempfile.mkdtemp()
+        sweep._context = ctx
+        try:
+            job_idx, outputs = sweep._run_job(
+                (3, {}, make_model, 0.1, 0.001, {}, out_dir))
+            assert job_idx == 3
+            assert len(os.listdir(out_dir)) == 1
+            data = sweep._load_outputs(outputs)
+            # -- the files are gone, the mapped data stays
+            assert os.listdir(out_dir) == []
+        finally:
+            sweep._context = None
+            shutil.rmtree(out_dir)
+
+        model, A = test_sim_npy.make_trial_model()
+        sim = sim_ocl.Simulator(model, context=ctx)
+        sim.run(0.1)
+        assert np.all(data['A'] == sim.data(A))
+
+
+if __name__ == '__main__':
+   unittest.main()